@@ -0,0 +1,351 @@
+"""Benchmarks for lsdb_macauff, run with airspeed velocity (asv).
+
+See https://asv.readthedocs.io/en/stable/writing_benchmarks.html for the
+naming conventions of the benchmark methods."""
+
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+
+import hats.pixel_math.healpix_shim as hp
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from hats_import.catalog.file_readers import CsvPyarrowReader, CsvReader
+from lsdb.core.crossmatch.crossmatch_args import CrossmatchArgs
+
+from lsdb_macauff.columns import columns_to_numpy
+from lsdb_macauff.import_pipeline.convert_metadata import apply_schema_to_reader
+from lsdb_macauff.import_pipeline.map_reduce import split_associations, split_by_pixel
+from lsdb_macauff.import_pipeline.resume_plan import write_pixel_alignment
+from lsdb_macauff.macauff_crossmatch import MacauffCrossmatch
+
+from .synthetic import PARAMS_DIR, generate_catalog_frames, generate_catalog_pair
+
+# pylint: disable=attribute-defined-outside-init, unused-argument, protected-access
+
+
+class ChunkInitialisationSuite:
+    """Extraction of the macauff input arrays from an Arrow-backed partition."""
+
+    params = (["arrow_buffers", "dataframe_to_numpy"], [100_000, 2_000_000])
+    param_names = ["method", "num_rows"]
+
+    def setup(self, method, num_rows):
+        """Build a pyarrow-backed partition with the layout of the Gaia test catalog."""
+        rng = np.random.default_rng(seed=53)
+        columns = {f"col_{index}": rng.random(num_rows) for index in range(16)}
+        self.partition = pa.table(columns).to_pandas(types_mapper=pd.ArrowDtype)
+        self.indices = [2, 3, 4, 5, 6, 7]
+
+    def _extract(self, method):
+        if method == "arrow_buffers":
+            return columns_to_numpy(self.partition, self.indices, np.float64)
+        return self.partition.iloc[:, self.indices].to_numpy(dtype=np.float64)
+
+    def time_extract_columns(self, method, num_rows):
+        """Time to build the astrometry and photometry arrays."""
+        self._extract(method)
+
+    def peakmem_extract_columns(self, method, num_rows):
+        """Peak memory while building the astrometry and photometry arrays."""
+        self._extract(method)
+
+
+class CrossmatchSuite:
+    """Matching of synthetic Gaia-like and CatWISE-like catalogs of increasing density.
+
+    ``num_sources`` is the number of left sources in the single pixel of the
+    catalogs, ``right_density_ratio`` the number of right sources per left source,
+    ``match_fraction`` the fraction of the left sources with a counterpart, and
+    ``magnitude_slope`` the slope of the logarithmic source counts of both catalogs.
+    The first value of each of the last three is that of the Gaia and CatWISE
+    catalogs; the others are only run up to ``MAX_VARIED_SOURCES`` left sources.
+    """
+
+    params = (
+        [1_000, 10_000, 100_000, 1_000_000, 10_000_000],
+        [3.6, 0.5, 20.0],
+        [0.6, 0.1, 0.95],
+        [0.3, 0.2, 0.45],
+    )
+    param_names = ["num_sources", "right_density_ratio", "match_fraction", "magnitude_slope"]
+    timeout = 4 * 3600
+
+    MAX_VARIED_SOURCES = 100_000
+
+    def setup(self, num_sources, right_density_ratio, match_fraction, magnitude_slope):
+        """Generate the catalogs, and load one partition pair for `perform_crossmatch`."""
+        is_default = (right_density_ratio, match_fraction, magnitude_slope) == tuple(
+            values[0] for values in self.params[1:]
+        )
+        if num_sources > self.MAX_VARIED_SOURCES and not is_default:
+            ## Tells asv to skip the combination.
+            raise NotImplementedError("Source distributions are only varied for the smaller catalogs")
+        self.left_catalog, self.right_catalog = generate_catalog_pair(
+            num_sources,
+            right_density_ratio=right_density_ratio,
+            match_fraction=match_fraction,
+            magnitude_slope=magnitude_slope,
+        )
+        pixel = self.left_catalog.get_healpix_pixels()[0]
+        self.crossmatch_args = CrossmatchArgs(
+            left_df=self.left_catalog.get_partition(pixel.order, pixel.pixel).compute(),
+            right_df=self.right_catalog.get_partition(pixel.order, pixel.pixel).compute(),
+            left_order=pixel.order,
+            left_pixel=pixel.pixel,
+            right_order=pixel.order,
+            right_pixel=pixel.pixel,
+            left_catalog_info=self.left_catalog.hc_structure.catalog_info,
+            right_catalog_info=self.right_catalog.hc_structure.catalog_info,
+            right_margin_catalog_info=None,
+        )
+        self.algorithm = MacauffCrossmatch(
+            PARAMS_DIR / "gaia_wise_joint_params.yaml",
+            PARAMS_DIR / "gaia_params.yaml",
+            PARAMS_DIR / "wise_params.yaml",
+        )
+
+    def time_perform_crossmatch(self, num_sources, right_density_ratio, match_fraction, magnitude_slope):
+        """Time to match one partition pair."""
+        self.algorithm.perform_crossmatch(self.crossmatch_args)
+
+    def peakmem_perform_crossmatch(self, num_sources, right_density_ratio, match_fraction, magnitude_slope):
+        """Peak memory while matching one partition pair."""
+        self.algorithm.perform_crossmatch(self.crossmatch_args)
+
+    def time_lsdb_crossmatch(self, num_sources, right_density_ratio, match_fraction, magnitude_slope):
+        """Time to match the catalogs through lsdb, reading and joining included."""
+        self.left_catalog.crossmatch(self.right_catalog, algorithm=self.algorithm).compute()
+
+    def peakmem_lsdb_crossmatch(self, num_sources, right_density_ratio, match_fraction, magnitude_slope):
+        """Peak memory while matching the catalogs through lsdb."""
+        self.left_catalog.crossmatch(self.right_catalog, algorithm=self.algorithm).compute()
+
+
+class SharedDataSuite:
+    """The arrays of concurrent chunks over the same partitions, private or shared.
+
+    ``num_chunks`` chunk contexts of the same dense partition pair are initialised
+    and kept alive at once, as on a node that runs several pairs of a partition
+    concurrently. ``private`` gives every chunk its own astrometry and photometry, and
+    ``shared_dir`` backs them with the files of a ``shared_array_dir``, so that the
+    chunks map the same pages.
+    """
+
+    params = (["private", "shared_dir"], [1, 4, 16])
+    param_names = ["method", "num_chunks"]
+
+    def setup(self, method, num_chunks):
+        """Configure the chunk contexts."""
+        self.shared_array_dir = tempfile.mkdtemp() if method == "shared_dir" else None
+        self.algorithm = MacauffCrossmatch(
+            PARAMS_DIR / "gaia_wise_joint_params.yaml",
+            PARAMS_DIR / "gaia_params.yaml",
+            PARAMS_DIR / "wise_params.yaml",
+            shared_array_dir=self.shared_array_dir,
+        )
+        left, right = generate_catalog_frames(200_000)
+        self.contexts = []
+        for _ in range(num_chunks):
+            context = self.algorithm._make_pair_context(left, right)
+            self.algorithm._configure_chunk(context, HealpixPixel(3, 512))
+            self.contexts.append(context)
+
+    def teardown(self, method, num_chunks):
+        """Remove the shared arrays."""
+        if self.shared_array_dir is not None:
+            shutil.rmtree(self.shared_array_dir)
+
+    def _initialise_chunks(self):
+        for context in self.contexts:
+            context._initialise_chunk()
+
+    def time_initialise_chunks(self, method, num_chunks):
+        """Time to initialise all the chunks."""
+        self._initialise_chunks()
+
+    def peakmem_initialise_chunks(self, method, num_chunks):
+        """Peak memory with the arrays of all the chunks alive."""
+        self._initialise_chunks()
+
+
+class SparseBatchSuite:
+    """Matching of many sparse partition pairs, one by one or coalesced into batches.
+
+    A synthetic pixel with about 50 left sources per pair is split into ``num_pairs``
+    descendant pixels, each a partition pair. ``per_pair`` matches them one by one
+    with `perform_crossmatch`, and ``batched`` with `perform_crossmatch_batch`, which
+    merges neighbouring pairs into shared macauff chunks.
+    """
+
+    params = (["per_pair", "batched"], [16, 64, 256])
+    param_names = ["method", "num_pairs"]
+    timeout = 3600
+
+    def setup(self, method, num_pairs):
+        """Generate the pairs, and an algorithm that batches all the pairs of a pixel."""
+        depth = int(round(np.log(num_pairs) / np.log(4)))
+        order = 3 + depth
+        left, right = generate_catalog_frames(50 * num_pairs)
+        left_pixels = hp.radec2pix(order, left["ra"].to_numpy(), left["dec"].to_numpy())
+        right_pixels = hp.radec2pix(order, right["ra"].to_numpy(), right["dec"].to_numpy())
+        self.pairs = [
+            CrossmatchArgs(
+                left_df=left[left_pixels == pixel],
+                right_df=right[right_pixels == pixel],
+                left_order=order,
+                left_pixel=int(pixel),
+                right_order=order,
+                right_pixel=int(pixel),
+                left_catalog_info=None,
+                right_catalog_info=None,
+                right_margin_catalog_info=None,
+            )
+            for pixel in np.unique(left_pixels)
+        ]
+        self.algorithm = MacauffCrossmatch(
+            PARAMS_DIR / "gaia_wise_joint_params.yaml",
+            PARAMS_DIR / "gaia_params.yaml",
+            PARAMS_DIR / "wise_params.yaml",
+            sparse_batch_depth=depth,
+        )
+
+    def _match(self, method):
+        if method == "batched":
+            self.algorithm.perform_crossmatch_batch(self.pairs)
+            return
+        for pair in self.pairs:
+            self.algorithm.perform_crossmatch(pair)
+
+    def time_match_pairs(self, method, num_pairs):
+        """Time to match all the pairs."""
+        self._match(method)
+
+    def peakmem_match_pairs(self, method, num_pairs):
+        """Peak memory while matching all the pairs."""
+        self._match(method)
+
+
+class SplitAssociationsSuite:
+    """Grouping of a chunk of association links into per-pixel shards.
+
+    ``per_pixel_mask`` is the former approach of `split_associations`, which scans
+    the whole chunk once for every pixel.
+    """
+
+    params = (["argsort_slices", "per_pixel_mask"], [100, 3_000, 30_000])
+    param_names = ["method", "num_pixels"]
+    num_rows = 1_000_000
+
+    def setup(self, method, num_pixels):
+        """Build a chunk of links spread over ``num_pixels`` left pixels."""
+        rng = np.random.default_rng(seed=53)
+        self.data = pd.DataFrame(
+            {
+                "left_id": rng.integers(0, 2**40, self.num_rows),
+                "right_id": rng.integers(0, 2**40, self.num_rows),
+                "ra": rng.uniform(0, 360, self.num_rows),
+                "dec": rng.uniform(-90, 90, self.num_rows),
+                "p": rng.random(self.num_rows),
+            }
+        )
+        self.pixels = rng.integers(0, num_pixels, self.num_rows)
+
+    def _split(self, method):
+        if method == "argsort_slices":
+            for _ in split_by_pixel(self.data, self.pixels):
+                pass
+            return
+        unique_pixels, unique_inverse = np.unique(self.pixels, return_inverse=True)
+        for unique_index in range(len(unique_pixels)):
+            filtered_data = self.data.iloc[unique_inverse == unique_index]
+            pa.Table.from_pandas(filtered_data, preserve_index=False).replace_schema_metadata()
+
+    def time_split(self, method, num_pixels):
+        """Time to group the links by pixel."""
+        self._split(method)
+
+    def peakmem_split(self, method, num_pixels):
+        """Peak memory while grouping the links by pixel."""
+        self._split(method)
+
+
+class SplitThroughputSuite:
+    """Splitting stage of the import of a CSV file of links, with a pandas or an Arrow reader.
+
+    ``pandas`` reads the chunks with the `CsvReader` and converts them to Arrow, while
+    ``pyarrow`` reads them with the `CsvPyarrowReader` and never builds a DataFrame.
+    Both readers are given the column types of the links.
+    """
+
+    params = (["pandas", "pyarrow"],)
+    param_names = ["reader"]
+    num_rows = 1_000_000
+    timeout = 300
+
+    def setup_cache(self):
+        """Write the CSV file of links, shared by all the benchmarks of the suite."""
+        rng = np.random.default_rng(seed=53)
+        cache_dir = Path(tempfile.mkdtemp())
+        pd.DataFrame(
+            {
+                "left_id": rng.integers(0, 2**40, self.num_rows),
+                "left_ra": rng.uniform(0, 360, self.num_rows),
+                "left_dec": np.degrees(np.arcsin(rng.uniform(-1, 1, self.num_rows))),
+                "right_name": [f"SYN-B {index}" for index in range(self.num_rows)],
+                "match_p": rng.random(self.num_rows),
+            }
+        ).to_csv(cache_dir / "links.csv", index=False)
+        write_pixel_alignment(
+            cache_dir / "left_alignment.npy", [HealpixPixel(3, pixel) for pixel in range(768)], 3
+        )
+        return cache_dir
+
+    def setup(self, cache_dir, reader):
+        """Pickle the reader, and make the directories of the splitting stage."""
+        schema = pa.schema(
+            [
+                ("left_id", pa.int64()),
+                ("left_ra", pa.float64()),
+                ("left_dec", pa.float64()),
+                ("right_name", pa.string()),
+                ("match_p", pa.float64()),
+            ]
+        )
+        file_reader = CsvReader() if reader == "pandas" else CsvPyarrowReader()
+        apply_schema_to_reader(file_reader, schema)
+        self.cache_dir = cache_dir
+        self.schema = schema
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        (self.tmp_dir / "splitting").mkdir()
+        self.reader_file = self.tmp_dir / "reader.pickle"
+        with open(self.reader_file, "wb") as pickle_file:
+            pickle.dump(file_reader, pickle_file)
+
+    def teardown(self, cache_dir, reader):
+        """Remove the shards."""
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _split(self):
+        split_associations(
+            self.cache_dir / "links.csv",
+            self.reader_file,
+            "split_0",
+            3,
+            self.cache_dir / "left_alignment.npy",
+            "left_ra",
+            "left_dec",
+            self.tmp_dir,
+            metadata_schema=self.schema,
+        )
+
+    def time_split_associations(self, cache_dir, reader):
+        """Time to split the links into shards."""
+        self._split()
+
+    def peakmem_split_associations(self, cache_dir, reader):
+        """Peak memory while splitting the links into shards."""
+        self._split()
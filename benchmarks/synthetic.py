@@ -0,0 +1,190 @@
+"""Seeded generator of paired synthetic catalogs for the benchmarks.
+
+The catalogs have the column layout of the Gaia and CatWISE test catalogs, so
+that they can be matched with the macauff parameters in ``tests/data``, and all
+of their sources lie in a single HEALPix pixel."""
+
+from pathlib import Path
+
+import hats.pixel_math.healpix_shim as hp
+import lsdb
+import numpy as np
+import pandas as pd
+
+from lsdb_macauff.spatial import pixel_bounding_circles, radec_to_xyz
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+PARAMS_DIR = Path(__file__).parent.parent / "tests" / "data"
+"""Location of the macauff parameter files that match the synthetic catalogs."""
+
+GAIA_FILTERS = ["bp_mag", "g_mag", "rp_mag"]
+CATWISE_FILTERS = ["w1mag", "w2mag"]
+
+
+def random_points_in_pixel(rng, order, pixel, num_points):
+    """Points uniformly distributed on the sky within a HEALPix pixel.
+
+    Points are drawn uniformly in a spherical cap that encloses the pixel, and
+    the ones outside of the pixel are rejected.
+
+    Returns:
+        Tuple of the right ascension and declination of the points, in degrees.
+    """
+    centers, radii = pixel_bounding_circles(order, [pixel])
+    center = centers[0]
+    cos_radius = np.cos(np.radians(radii[0] / 3600))
+    ## Orthonormal basis around the cap center.
+    helper = np.array([0.0, 0.0, 1.0]) if abs(center[2]) < 0.9 else np.array([1.0, 0.0, 0.0])
+    east = np.cross(helper, center)
+    east /= np.linalg.norm(east)
+    north = np.cross(center, east)
+
+    ra, dec = np.empty(0), np.empty(0)
+    while len(ra) < num_points:
+        batch = 2 * (num_points - len(ra)) + 16
+        cos_theta = rng.uniform(cos_radius, 1, batch)
+        sin_theta = np.sqrt(1 - cos_theta**2)
+        phi = rng.uniform(0, 2 * np.pi, batch)
+        xyz = (
+            cos_theta[:, np.newaxis] * center
+            + (sin_theta * np.cos(phi))[:, np.newaxis] * east
+            + (sin_theta * np.sin(phi))[:, np.newaxis] * north
+        )
+        batch_ra = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+        batch_dec = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1, 1)))
+        in_pixel = hp.radec2pix(order, batch_ra, batch_dec) == pixel
+        ra = np.concatenate([ra, batch_ra[in_pixel]])
+        dec = np.concatenate([dec, batch_dec[in_pixel]])
+    return ra[:num_points], dec[:num_points]
+
+
+def _magnitudes(rng, num_sources, bright, faint, slope):
+    """Magnitudes with differential counts rising as 10^(slope * m) between two limits."""
+    low, high = 10 ** (slope * bright), 10 ** (slope * faint)
+    return np.log10(rng.uniform(low, high, num_sources)) / slope
+
+
+def _offset_positions(rng, ra, dec, sigma_arcsec):
+    """Move each position by a 2-d gaussian offset of ``sigma_arcsec`` per axis."""
+    xyz = radec_to_xyz(ra, dec)
+    east = np.stack([-np.sin(np.radians(ra)), np.cos(np.radians(ra)), np.zeros(len(ra))], axis=-1)
+    north = np.cross(xyz, east)
+    offsets = np.radians(rng.normal(0, 1, (len(ra), 2)) * np.reshape(sigma_arcsec, (-1, 1)) / 3600)
+    xyz = xyz + offsets[:, :1] * east + offsets[:, 1:] * north
+    xyz /= np.linalg.norm(xyz, axis=1)[:, np.newaxis]
+    return np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360, np.degrees(np.arcsin(xyz[:, 2]))
+
+
+def generate_catalog_frames(
+    num_sources,
+    order=3,
+    pixel=512,
+    right_density_ratio=3.6,
+    match_fraction=0.6,
+    magnitude_slope=0.3,
+    seed=53,
+):
+    """Generate a Gaia-like left frame and a CatWISE-like right frame in one pixel.
+
+    Args:
+        num_sources (int): number of left sources.
+        order (int): HEALPix order of the pixel.
+        pixel (int): the HEALPix pixel that holds all the sources.
+        right_density_ratio (float): number of right sources per left source.
+        match_fraction (float): fraction of the left sources with a right counterpart.
+        magnitude_slope (float): slope of the logarithmic differential source counts.
+        seed (int): seed of the random generator.
+
+    Returns:
+        Tuple of the left and right pd.DataFrame.
+    """
+    rng = np.random.default_rng(seed)
+    num_right = max(int(num_sources * right_density_ratio), 1)
+    num_matched = min(int(num_sources * match_fraction), num_right)
+
+    ra, dec = random_points_in_pixel(rng, order, pixel, num_sources)
+    g_mag = _magnitudes(rng, num_sources, 12, 21, magnitude_slope)
+    left_mags = np.stack([g_mag + rng.normal(0.4, 0.2, num_sources), g_mag, g_mag - 0.6], axis=1)
+    left_mags[rng.random(num_sources) < 0.2, 0] = np.nan
+    left = pd.DataFrame(
+        {
+            "source_id": np.arange(num_sources, dtype=np.int64),
+            "designation": [f"SYN-A {index}" for index in range(num_sources)],
+            "ra": ra,
+            "dec": dec,
+            "pos_err": rng.uniform(0.0002, 0.002, num_sources),
+            **{name: left_mags[:, index] for index, name in enumerate(GAIA_FILTERS)},
+            "bestIndex": np.full(num_sources, 1, dtype=np.int64),
+            **{
+                name.replace("mag", "snr"): 10 ** (0.4 * (22 - left_mags[:, i]))
+                for i, name in enumerate(GAIA_FILTERS)
+            },
+            "pmra": np.zeros(num_sources),
+            "pmdec": np.zeros(num_sources),
+            "pm_err": np.full(num_sources, 0.001),
+            "chunkId": np.zeros(num_sources, dtype=np.int64),
+            "isOverlap": np.zeros(num_sources, dtype=np.int64),
+        }
+    )
+
+    ## Counterparts of the first sources, then unrelated field sources.
+    matched = rng.permutation(num_sources)[:num_matched]
+    right_pos_err = rng.uniform(0.02, 0.2, num_right)
+    right_ra, right_dec = random_points_in_pixel(rng, order, pixel, num_right)
+    matched_ra, matched_dec = _offset_positions(
+        rng, ra[matched], dec[matched], np.hypot(right_pos_err[:num_matched], 0.3)
+    )
+    ## Keep every source in the pixel, so that each catalog is a single partition.
+    outside = hp.radec2pix(order, matched_ra, matched_dec) != pixel
+    matched_ra[outside], matched_dec[outside] = ra[matched][outside], dec[matched][outside]
+    right_ra[:num_matched], right_dec[:num_matched] = matched_ra, matched_dec
+    w1_mag = _magnitudes(rng, num_right, 8, 17, magnitude_slope)
+    w1_mag[:num_matched] = g_mag[matched] - rng.normal(3, 0.5, num_matched)
+    right_mags = np.stack([w1_mag, w1_mag + rng.normal(0, 0.1, num_right)], axis=1)
+    right = pd.DataFrame(
+        {
+            "cntr": np.arange(num_right, dtype=np.int64),
+            "designation": [f"SYN-B {index}" for index in range(num_right)],
+            "ra": right_ra,
+            "dec": right_dec,
+            "pos_err": right_pos_err,
+            **{name: right_mags[:, index] for index, name in enumerate(CATWISE_FILTERS)},
+            "bestIndex": np.zeros(num_right, dtype=np.int64),
+            **{
+                name.replace("mag", "snr"): 10 ** (0.4 * (18 - right_mags[:, i]))
+                for i, name in enumerate(CATWISE_FILTERS)
+            },
+            "chunkId": np.zeros(num_right, dtype=np.int64),
+            "isOverlap": np.zeros(num_right, dtype=np.int64),
+        }
+    )
+    return left, right
+
+
+def generate_catalog_pair(num_sources, order=3, pixel=512, margin_threshold=5.0, **kwargs):
+    """Generate paired synthetic HATS catalogs, each made of a single partition.
+
+    Args:
+        num_sources (int): number of left sources.
+        order (int): HEALPix order of the partitions.
+        pixel (int): the HEALPix pixel of the partitions.
+        margin_threshold (float): size of the margin of the right catalog, in arcseconds.
+        **kwargs: further arguments of `generate_catalog_frames`.
+
+    Returns:
+        Tuple of the left and right lsdb catalogs.
+    """
+    left, right = generate_catalog_frames(num_sources, order=order, pixel=pixel, **kwargs)
+    left_catalog = lsdb.from_dataframe(
+        left, ra_column="ra", dec_column="dec", lowest_order=order, highest_order=order, margin_threshold=None
+    )
+    right_catalog = lsdb.from_dataframe(
+        right,
+        ra_column="ra",
+        dec_column="dec",
+        lowest_order=order,
+        highest_order=order,
+        margin_threshold=margin_threshold,
+    )
+    return left_catalog, right_catalog
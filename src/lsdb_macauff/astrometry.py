@@ -0,0 +1,308 @@
+"""Astrometric corrections precomputed per sky region.
+
+macauff fits astrometric corrections from the sources around each chunk, which
+is far too slow to repeat in every partition task. The corrections only vary
+slowly across the sky, so they are fitted once per HEALPix region of a coarse
+order and kept in a small table. Each chunk then looks up the region of each
+of its sources and rescales their uncertainties as
+
+    sig' = sqrt((m * sig)^2 + n^2)
+
+`MacauffAstrometryFit` fits the regions with macauff's own astrometric correction.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import hats.pixel_math.healpix_shim as hp
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cdshealpix.nested import healpix_to_lonlat
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from macauff import AstrometricCorrections
+
+CORRECTIONS_FILE = "astrometric_corrections.parquet"
+"""Name of the consolidated table in the output directory of `build_astrometric_corrections`."""
+
+REGIONS_DIRECTORY = "regions"
+"""Directory of the per-region fits, kept so that an interrupted build can resume."""
+
+
+class AstrometricCorrectionTable:
+    """The (m, n) astrometric correction of each region of a HEALPix order.
+
+    Args:
+        order (int): HEALPix order of the regions.
+        pixels (np.ndarray): pixel of each region.
+        m (np.ndarray): the multiplicative correction of each region.
+        n (np.ndarray): the additive correction of each region, in arcseconds.
+    """
+
+    def __init__(self, order, pixels, m, n):
+        sorted_order = np.argsort(pixels, kind="stable")
+        self.order = order
+        self.pixels = np.asarray(pixels, dtype=np.int64)[sorted_order]
+        self.m = np.asarray(m, dtype=np.float64)[sorted_order]
+        self.n = np.asarray(n, dtype=np.float64)[sorted_order]
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @classmethod
+    def read(cls, path) -> AstrometricCorrectionTable:
+        """Load a table written by `write`."""
+        table = pq.read_table(path)
+        orders = table["Norder"].to_numpy()
+        if len(np.unique(orders)) > 1:
+            raise ValueError(f"Astrometric corrections in {path} mix several HEALPix orders")
+        order = int(orders[0]) if len(orders) > 0 else 0
+        return cls(order, table["Npix"].to_numpy(), table["m"].to_numpy(), table["n"].to_numpy())
+
+    def write(self, path):
+        """Save the table as a parquet file with Norder, Npix, m and n columns."""
+        table = pa.table(
+            {
+                "Norder": pa.array(np.full(len(self), self.order, dtype=np.uint8)),
+                "Npix": pa.array(self.pixels),
+                "m": pa.array(self.m),
+                "n": pa.array(self.n),
+            }
+        )
+        pq.write_table(table, path)
+
+    def lookup(self, pixel: HealpixPixel) -> tuple[float, float]:
+        """The (m, n) correction of the region that holds ``pixel``.
+
+        Pixels larger than the regions span several corrections; use
+        `lookup_positions` for the sources in them.
+
+        Raises:
+            ValueError: if ``pixel`` is larger than the regions.
+            KeyError: if the region of ``pixel`` has no correction.
+        """
+        if pixel.order < self.order:
+            raise ValueError(f"Pixel {pixel} is larger than the astrometric correction regions")
+        region = pixel.pixel >> (2 * (pixel.order - self.order))
+        m, n = self._lookup_regions(np.array([region]))
+        return m[0], n[0]
+
+    def lookup_positions(self, ra, dec) -> tuple[np.ndarray, np.ndarray]:
+        """The (m, n) corrections of the regions that hold each position.
+
+        Args:
+            ra (np.ndarray): right ascensions, in degrees.
+            dec (np.ndarray): declinations, in degrees.
+
+        Returns:
+            Tuple of the m and n arrays, one value per position.
+
+        Raises:
+            KeyError: if the region of any position has no correction.
+        """
+        regions = hp.radec2pix(
+            self.order, np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+        )
+        return self._lookup_regions(np.asarray(regions, dtype=np.int64))
+
+    def _lookup_regions(self, regions):
+        indices = np.minimum(np.searchsorted(self.pixels, regions), max(len(self.pixels) - 1, 0))
+        found = self.pixels[indices] == regions if len(self.pixels) > 0 else np.zeros(len(regions), bool)
+        if not found.all():
+            region = HealpixPixel(self.order, int(regions[~found][0]))
+            raise KeyError(f"No astrometric correction for region {region}")
+        return self.m[indices], self.n[indices]
+
+    def correct_uncertainties(self, ra, dec, uncertainties) -> np.ndarray:
+        """Apply the correction of the region of each source to its positional uncertainty.
+
+        Each source uses the region that holds it, so a chunk may span any number of
+        regions, e.g. when its aligned pixel is the ancestor of a batch of sparse pairs.
+
+        Args:
+            ra (np.ndarray): right ascensions of the sources, in degrees.
+            dec (np.ndarray): declinations of the sources, in degrees.
+            uncertainties (np.ndarray): the uncertainties of the sources, in arcseconds.
+
+        Returns:
+            The corrected uncertainties, as a new array.
+        """
+        m, n = self.lookup_positions(ra, dec)
+        return np.hypot(m * uncertainties, n)
+
+
+def build_astrometric_corrections(output_dir, order, regions, fit, client=None) -> AstrometricCorrectionTable:
+    """Fit the astrometric correction of each region, and consolidate them into a table.
+
+    Each fit is saved in ``output_dir`` as soon as it finishes, and regions that
+    already have a fit are skipped, so an interrupted build can be resumed by
+    calling this again.
+
+    Args:
+        output_dir (str | Path): directory for the per-region fits and the final table.
+        order (int): HEALPix order of the regions.
+        regions (list[int]): pixels of the regions to fit.
+        fit (Callable): ``fit(region)`` returns the (m, n) correction of a region,
+            given as a HealpixPixel, typically a `MacauffAstrometryFit`.
+        client (dask.distributed.Client | None): if given, regions are fitted in
+            parallel on the cluster workers.
+
+    Returns:
+        The `AstrometricCorrectionTable` of all ``regions``, also saved as
+        `CORRECTIONS_FILE` in ``output_dir``.
+    """
+    output_dir = Path(output_dir)
+    regions_dir = output_dir / REGIONS_DIRECTORY / f"Norder={order}"
+    regions_dir.mkdir(parents=True, exist_ok=True)
+    missing = [
+        HealpixPixel(order, int(region))
+        for region in regions
+        if not _region_fit_path(regions_dir, region).exists()
+    ]
+    if client is None:
+        for region in missing:
+            _fit_region(regions_dir, fit, region)
+    else:
+        client.gather(
+            [client.submit(_fit_region, regions_dir, fit, region, pure=False) for region in missing]
+        )
+
+    fits = np.array([np.load(_region_fit_path(regions_dir, region)) for region in regions]).reshape(-1, 2)
+    table = AstrometricCorrectionTable(order, regions, fits[:, 0], fits[:, 1])
+    table.write(output_dir / CORRECTIONS_FILE)
+    return table
+
+
+def _region_fit_path(regions_dir, region):
+    return regions_dir / f"Npix={int(region)}.npy"
+
+
+def _fit_region(regions_dir, fit, region):
+    m, n = fit(region)
+    ## Write to a temporary file first, so that a partial write is never taken as done.
+    temp_path = regions_dir / f"Npix={region.pixel}.tmp.npy"
+    np.save(temp_path, np.array([m, n], dtype=np.float64))
+    temp_path.replace(_region_fit_path(regions_dir, region.pixel))
+
+
+class MacauffAstrometryFit:  # pylint: disable=too-few-public-methods
+    """Fits the astrometric correction of a region with macauff's `AstrometricCorrections`.
+
+    The sources of a region in the catalog to correct, and in the other catalog of
+    the crossmatch as the astrometric reference (e.g. Gaia), are saved as cutouts,
+    and macauff fits the (m, n) correction of the region at its center, as a macauff
+    run with ``correct_astrometry`` does for a chunk. The fit settings (TRILEGAL and
+    galaxy counts, ``nn_radius``, ``correct_mag_array`` and so on) are those of the
+    parameters of the catalog to correct.
+
+    Args:
+        algorithm (MacauffCrossmatch): the algorithm of the crossmatch.
+        catalog (str): the catalog to correct, "a" (left) or "b" (right).
+        left_catalog (lsdb.Catalog): the left catalog, "a".
+        right_catalog (lsdb.Catalog): the right catalog, "b".
+        work_dir (str | Path): directory for the cutouts, simulations and fits of
+            macauff, one subdirectory per region.
+    """
+
+    def __init__(self, algorithm, catalog, left_catalog, right_catalog, work_dir):
+        if catalog not in ("a", "b"):
+            raise ValueError(f"catalog must be 'a' or 'b', not {catalog!r}")
+        self.algorithm = algorithm
+        self.catalog = catalog
+        self.left_catalog = left_catalog
+        self.right_catalog = right_catalog
+        self.work_dir = Path(work_dir)
+
+    def __call__(self, region: HealpixPixel) -> tuple[float, float]:
+        # pylint: disable=protected-access
+        reference = "b" if self.catalog == "a" else "a"
+        left_partition = self.left_catalog.pixel_search(region, fine=True).compute()
+        right_partition = self.right_catalog.pixel_search(region, fine=True).compute()
+        context = self.algorithm._make_pair_context(left_partition, right_partition)
+        self.algorithm._configure_chunk(context, region)
+        partitions = {"a": left_partition, "b": right_partition}
+        params_dict = getattr(context, f"cat_{self.catalog}_params_dict")
+        joint_params_dict = context.crossmatch_params_dict
+        best = int(params_dict["correct_astro_mag_indices_index"])
+        num_filters = len(params_dict["filt_names"])
+
+        save_folder = self.work_dir / f"Norder={region.order}" / f"Npix={region.pixel}"
+        save_folder.mkdir(parents=True, exist_ok=True)
+        ## Cutouts are named by the coordinates of the region center, as macauff expects.
+        center_ra, center_dec = (
+            angle.deg[0]
+            for angle in healpix_to_lonlat(np.array([region.pixel], dtype=np.uint64), region.order)
+        )
+        reference_cutout = _cutout(
+            partitions[reference], getattr(context, f"cat_{reference}_params_dict")["pos_and_err_indices"]
+        )
+        catalog_cutout = np.concatenate(
+            [
+                _cutout(partitions[self.catalog], params_dict["pos_and_err_indices"]),
+                _cutout(partitions[self.catalog], params_dict["mag_indices"]),
+                _snr_to_magnitude_uncertainty(_cutout(partitions[self.catalog], params_dict["snr_indices"])),
+            ],
+            axis=1,
+        )
+        reference_name = str(save_folder / "reference_{}_{}.npy")
+        catalog_name = str(save_folder / "catalog_{}_{}.npy")
+        np.save(reference_name.format(center_ra, center_dec), reference_cutout)
+        np.save(catalog_name.format(center_ra, center_dec), catalog_cutout)
+
+        corrections = AstrometricCorrections(
+            psf_fwhm=params_dict["psf_fwhms"][best],
+            numtrials=joint_params_dict["num_trials"],
+            nn_radius=params_dict["nn_radius"],
+            dens_search_radius=params_dict["dens_dist"],
+            save_folder=str(save_folder),
+            trifolder=str(save_folder),
+            triname="trilegal_auf_simulation_{}_{}",
+            maglim_f=params_dict["tri_maglim_faint"],
+            magnum=params_dict["tri_filt_num"],
+            tri_num_faint=params_dict["tri_num_faint"],
+            trifilterset=params_dict["tri_set_name"],
+            trifiltname=params_dict["tri_filt_names"][best],
+            gal_wav_micron=params_dict["gal_wavs"][best],
+            gal_ab_offset=params_dict["gal_aboffsets"][best],
+            gal_filtname=params_dict["gal_filternames"][best],
+            gal_alav=params_dict["gal_al_avs"][best],
+            dm=joint_params_dict["d_mag"],
+            dd_params=getattr(context, f"{self.catalog}_dd_params"),
+            l_cut=getattr(context, f"{self.catalog}_l_cut"),
+            ax1_mids=np.array([center_ra]),
+            ax2_mids=np.array([center_dec]),
+            ax_dimension=2,
+            mag_array=params_dict["correct_mag_array"],
+            mag_slice=params_dict["correct_mag_slice"],
+            sig_slice=params_dict["correct_sig_slice"],
+            n_pool=joint_params_dict["n_pool"],
+            npy_or_csv="npy",
+            coord_or_chunk="coord",
+            pos_and_err_indices=[[0, 1, 2], [0, 1, 2]],
+            mag_indices=list(range(3, 3 + num_filters)),
+            mag_unc_indices=list(range(3 + num_filters, 3 + 2 * num_filters)),
+            mag_names=params_dict["filt_names"],
+            best_mag_index=best,
+            coord_system=params_dict["auf_region_frame"],
+            pregenerate_cutouts=True,
+            use_photometric_uncertainties=params_dict["use_photometric_uncertainties"],
+        )
+        corrections(
+            reference_name,
+            catalog_name,
+            tri_download=params_dict["download_tri"],
+            overwrite_all_sightlines=True,
+            make_plots=False,
+            make_summary_plot=False,
+        )
+        return float(corrections.m_sigs[0]), float(corrections.n_sigs[0])
+
+
+def _cutout(partition, indices) -> np.ndarray:
+    return partition.iloc[:, list(indices)].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _snr_to_magnitude_uncertainty(snr):
+    with np.errstate(divide="ignore"):
+        return 2.5 / np.log(10) / snr
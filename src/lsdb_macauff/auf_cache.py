@@ -0,0 +1,422 @@
+"""On-disk cache of perturbation AUF grids, keyed by sky region and filter.
+
+Simulating the perturbation component of the AUF is far too slow to repeat for
+every partition pair. The grids only depend on the sky region and the filter,
+so they are simulated once per (region, catalog, filter), saved as ``.npy``
+files, and memory-mapped read-only by every pair in that region.
+`MacauffAufSimulator` fills the cache with macauff's own perturbation simulation.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from hats.pixel_math.healpix_shim import order2nside
+from scipy.spatial import KDTree
+
+from lsdb_macauff.spatial import arcsec_to_chord, pixel_bounding_circles, radec_to_xyz
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+GRID_ARRAYS = ("N", "mag", "fourier", "frac", "flux", "density_mag")
+"""The arrays of a cache entry, as produced by a single macauff perturbation simulation:
+
+- ``N``, ``mag``: the normalising density and magnitude of each simulated N-m combination.
+- ``fourier``: (len(rho) - 1, num N-m) fourier-space perturbation AUF component.
+- ``frac``: (num fractions, num N-m) fraction of sources with a contaminant.
+- ``flux``: (num N-m) average contaminating flux.
+- ``density_mag``: 0-d, the magnitude above which sources count towards the local density.
+"""
+
+DONE_MARKER = "done"
+"""Written in an entry directory once all of its arrays are saved."""
+
+ENTRY_CACHE_SIZE = 256
+"""Number of opened entries kept per process."""
+
+DENSITY_LOG_STEP = 0.2
+"""Width, in natural log of the normalising density, of the bins of macauff's N-m combinations."""
+
+MAGNITUDE_STEP = 0.25
+"""Width, in magnitudes, of the bins of macauff's N-m combinations."""
+
+
+class AufGridCache:
+    """Directory of perturbation AUF grids, one entry per region, catalog and filter.
+
+    Regions are the HEALPix pixels of ``order``. A partition pair uses the grids of
+    the region that holds its aligned pixel or, if the aligned pixel is larger than
+    the regions (e.g. the common ancestor of a batch of sparse pairs), of all the
+    regions in it. Entries are laid out as::
+
+        cache_dir/Norder={order}/Npix={pixel}/catalog={a|b}/filter={filter}/{array}.npy
+
+    Args:
+        cache_dir (str | Path): root directory of the cache. It must be on a local or
+            shared filesystem that supports memory mapping.
+        order (int): HEALPix order of the cache regions.
+    """
+
+    def __init__(self, cache_dir, order):
+        self.cache_dir = Path(cache_dir)
+        self.order = order
+
+    def region_for(self, pixel: HealpixPixel) -> HealpixPixel:
+        """The cache region that holds ``pixel``.
+
+        Raises:
+            ValueError: if ``pixel`` is larger than the cache regions.
+        """
+        if pixel.order < self.order:
+            raise ValueError(f"Pixel {pixel} is larger than the AUF cache regions (order {self.order})")
+        return HealpixPixel(self.order, pixel.pixel >> (2 * (pixel.order - self.order)))
+
+    def regions_for(self, pixel: HealpixPixel) -> list[HealpixPixel]:
+        """The cache regions that cover ``pixel``: the one that holds it, or all of those in it."""
+        if pixel.order >= self.order:
+            return [self.region_for(pixel)]
+        shift = 2 * (self.order - pixel.order)
+        return [HealpixPixel(self.order, (pixel.pixel << shift) + index) for index in range(1 << shift)]
+
+    def regions(self) -> list[HealpixPixel]:
+        """All the regions of the cache order, e.g. to build a full-sky cache."""
+        return [HealpixPixel(self.order, pixel) for pixel in range(12 * order2nside(self.order) ** 2)]
+
+    def entry_path(self, region: HealpixPixel, catalog: str, filt: str) -> Path:
+        """Directory of the entry for ``region``, ``catalog`` ("a" or "b") and filter ``filt``."""
+        return (
+            self.cache_dir
+            / f"Norder={region.order}"
+            / f"Npix={region.pixel}"
+            / f"catalog={catalog}"
+            / f"filter={filt}"
+        )
+
+    def contains(self, region: HealpixPixel, catalog: str, filt: str) -> bool:
+        """Whether the entry has been completely written."""
+        return (self.entry_path(region, catalog, filt) / DONE_MARKER).exists()
+
+    def write(self, region: HealpixPixel, catalog: str, filt: str, grids: dict[str, np.ndarray]):
+        """Save the arrays of an entry, and mark it as done.
+
+        Raises:
+            ValueError: if ``grids`` is missing any of `GRID_ARRAYS`.
+        """
+        missing = [name for name in GRID_ARRAYS if name not in grids]
+        if missing:
+            raise ValueError(f"AUF grids for {region}, {catalog}, {filt} are missing {missing}")
+        entry_path = self.entry_path(region, catalog, filt)
+        entry_path.mkdir(parents=True, exist_ok=True)
+        for name in GRID_ARRAYS:
+            np.save(entry_path / f"{name}.npy", np.asarray(grids[name], dtype=np.float64))
+        (entry_path / DONE_MARKER).touch()
+
+    def grids_key(self, regions, catalog: str, filt_names) -> str:
+        """Key of the grids that `perturb_auf_grids` assembles for a chunk.
+
+        The key includes the time each entry was written, so that grids assembled
+        from entries that were since simulated again are not reused.
+
+        Raises:
+            KeyError: if an entry is not in the cache.
+        """
+        digest = hashlib.sha256(f"{self.cache_dir.resolve()}:{catalog}".encode())
+        for filt in filt_names:
+            for region in regions:
+                if not self.contains(region, catalog, filt):
+                    raise KeyError(f"No AUF grids cached for {region}, catalog {catalog}, filter {filt}")
+                written = (self.entry_path(region, catalog, filt) / DONE_MARKER).stat().st_mtime_ns
+                digest.update(f"{region.order}/{region.pixel}/{filt}:{written}".encode())
+        return digest.hexdigest()
+
+    def read(self, region: HealpixPixel, catalog: str, filt: str) -> dict[str, np.ndarray]:
+        """Memory-map the arrays of an entry, read-only.
+
+        Raises:
+            KeyError: if the entry is not in the cache.
+        """
+        if not self.contains(region, catalog, filt):
+            raise KeyError(f"No AUF grids cached for {region}, catalog {catalog}, filter {filt}")
+        return _open_entry(str(self.entry_path(region, catalog, filt)))
+
+
+@lru_cache(maxsize=ENTRY_CACHE_SIZE)
+def _open_entry(entry_path: str) -> dict[str, np.ndarray]:
+    return {name: np.load(Path(entry_path) / f"{name}.npy", mmap_mode="r") for name in GRID_ARRAYS}
+
+
+def build_auf_cache(cache: AufGridCache, regions, filters, simulate, client=None):
+    """Simulate and save the entries that are missing from the cache.
+
+    Entries that are already complete are skipped, so an interrupted build can be
+    resumed by calling this again. The missing entries of a region are built one
+    after another by the same task, so that ``simulate`` can reuse the work it does
+    for the region, as `MacauffAufSimulator` does.
+
+    Args:
+        cache (AufGridCache): the cache to fill.
+        regions (list[HealpixPixel]): the regions to build, at the cache order.
+        filters (dict[str, list[str]]): the filter names of each catalog, keyed by
+            "a" and "b", e.g. the ``filt_names`` of the catalog parameters.
+        simulate (Callable): ``simulate(region, catalog, filt)`` returns the
+            `GRID_ARRAYS` for one entry, typically a `MacauffAufSimulator`.
+        client (dask.distributed.Client | None): if given, regions are simulated in
+            parallel on the cluster workers.
+
+    Returns:
+        list of the (region, catalog, filter) entries that were built.
+    """
+    missing = {}
+    for region in regions:
+        for catalog, filt_names in filters.items():
+            for filt in filt_names:
+                if not cache.contains(region, catalog, filt):
+                    missing.setdefault(region, []).append((catalog, filt))
+    if client is None:
+        for region, entries in missing.items():
+            _build_region(cache, simulate, region, entries)
+    else:
+        futures = [
+            client.submit(_build_region, cache, simulate, region, entries, pure=False)
+            for region, entries in missing.items()
+        ]
+        client.gather(futures)
+    return [(region, catalog, filt) for region, entries in missing.items() for catalog, filt in entries]
+
+
+def _build_region(cache, simulate, region, entries):
+    for catalog, filt in entries:
+        cache.write(region, catalog, filt, simulate(region, catalog, filt))
+
+
+class MacauffAufSimulator:
+    """Simulates the entries of an `AufGridCache` with macauff's perturbation AUF code.
+
+    The sources of both catalogs in a region are set up as a chunk of ``algorithm``,
+    centered on the region, and macauff's own ``create_perturb_auf`` (see
+    `MacauffCrossmatch.simulate_perturb_auf`) simulates the
+    perturbations of every filter of both catalogs, from the TRILEGAL (and galaxy
+    count) parameters of the catalogs. The grids are then converted to cache entries
+    with `grids_from_perturb_aufs`. The chunk of the latest region is kept, so the
+    filters of a region are simulated by a single macauff run.
+
+    Args:
+        algorithm (MacauffCrossmatch): the algorithm of the crossmatch, with
+            ``include_perturb_auf`` set.
+        left_catalog (lsdb.Catalog): the left catalog, "a".
+        right_catalog (lsdb.Catalog): the right catalog, "b".
+    """
+
+    def __init__(self, algorithm, left_catalog, right_catalog):
+        if not algorithm.crossmatch_params_dict["include_perturb_auf"]:
+            raise ValueError("The algorithm must have include_perturb_auf set to simulate perturbations")
+        self.algorithm = algorithm
+        self.left_catalog = left_catalog
+        self.right_catalog = right_catalog
+        self._latest = None
+
+    def __call__(self, region, catalog, filt):
+        if self._latest is None or self._latest[0] != region:
+            self._latest = (region, self.simulate_region(region))
+        context = self._latest[1]
+        params_dict = getattr(context, f"cat_{catalog}_params_dict")
+        return grids_from_perturb_aufs(
+            getattr(context, f"{catalog}_modelrefinds"),
+            getattr(context, f"{catalog}_perturb_auf_outputs"),
+            list(params_dict["filt_names"]).index(filt),
+            getattr(context, f"{catalog}_astro"),
+            getattr(context, f"{catalog}_photo"),
+            float(params_dict["dens_dist"]),
+        )
+
+    def simulate_region(self, region: HealpixPixel):
+        """Run macauff's perturbation AUF simulation for the sources in ``region``.
+
+        Returns:
+            The chunk context, with the ``{a,b}_modelrefinds`` and
+            ``{a,b}_perturb_auf_outputs`` made by macauff.
+        """
+        # pylint: disable=protected-access
+        left_partition = self.left_catalog.pixel_search(region, fine=True).compute()
+        right_partition = self.right_catalog.pixel_search(region, fine=True).compute()
+        context = self.algorithm._make_pair_context(left_partition, right_partition)
+        self.algorithm._configure_chunk(context, region)
+        context._initialise_chunk()
+        context.simulate_perturb_auf()
+        return context
+
+
+def grids_from_perturb_aufs(modelrefinds, perturb_auf_outputs, filter_index, astro, photo, density_radius):
+    """Convert the perturbation AUF made by macauff for a single pointing to a cache entry.
+
+    macauff does not report the normalising density and magnitude of its simulated
+    N-m combinations, so they are taken as the geometric mean local density (as
+    computed in `perturb_aufs_from_cache`), matching macauff's logarithmic density
+    bins, and the mean magnitude of the sources that macauff assigned to each
+    combination. Combinations that no source uses are never picked. The
+    ``density_mag`` is derived from the magnitudes as macauff does: half a magnitude
+    brighter than the peak of their histogram.
+
+    Args:
+        modelrefinds (np.ndarray): (3, N) indices of each source into the grids.
+        perturb_auf_outputs (dict): the ``fourier_grid``, ``frac_grid``, ``flux_grid``
+            and ``arraylengths`` made by macauff.
+        filter_index (int): the filter of the entry, in magnitude column order.
+        astro (np.ndarray): (N, 3) positions and uncertainties of the sources.
+        photo (np.ndarray): (N, num filters) magnitudes of the sources.
+        density_radius (float): radius of the local density, in degrees.
+
+    Returns:
+        dict with the `GRID_ARRAYS` of the entry.
+    """
+    ## A filter without sources still holds macauff's single, unperturbed, combination.
+    length = max(int(perturb_auf_outputs["arraylengths"][filter_index, 0]), 1)
+    magnitudes = photo[:, filter_index]
+    density_mag = _density_mag(magnitudes)
+    sources = np.nonzero((modelrefinds[1] == filter_index) & (modelrefinds[2] == 0))[0]
+    density = _local_density(astro, magnitudes, density_mag, sources, density_radius)
+    combinations = modelrefinds[0, sources]
+    counts = np.bincount(combinations, minlength=length)[:length]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        log_density = np.bincount(combinations, weights=np.log(density), minlength=length)[:length] / counts
+        mag = np.bincount(combinations, weights=magnitudes[sources], minlength=length)[:length] / counts
+    return {
+        "N": np.exp(log_density),
+        "mag": mag,
+        "fourier": perturb_auf_outputs["fourier_grid"][:, :length, filter_index, 0],
+        "frac": perturb_auf_outputs["frac_grid"][:, :length, filter_index, 0],
+        "flux": perturb_auf_outputs["flux_grid"][:length, filter_index, 0],
+        "density_mag": np.array(density_mag),
+    }
+
+
+def _density_mag(magnitudes) -> float:
+    magnitudes = magnitudes[~np.isnan(magnitudes)]
+    if len(magnitudes) == 0:
+        return -np.inf
+    hist, bins = np.histogram(magnitudes, bins="auto")
+    return float((bins[:-1] + np.diff(bins) / 2)[np.argmax(hist)] - 0.5)
+
+
+def _local_density(astro, magnitudes, density_mag, sources, density_radius) -> np.ndarray:
+    """Sources brighter than ``density_mag`` within ``density_radius`` of each of ``sources``, per deg^2."""
+    xyz = radec_to_xyz(astro[:, 0], astro[:, 1])
+    bright = np.nan_to_num(magnitudes, nan=np.inf) <= density_mag
+    if bright.any() and len(sources) > 0:
+        counts = KDTree(xyz[bright]).query_ball_point(
+            xyz[sources], arcsec_to_chord(density_radius * 3600), return_length=True
+        )
+    else:
+        counts = np.zeros(len(sources))
+    return np.maximum(counts, 1) / (np.pi * density_radius**2)
+
+
+def perturb_aufs_from_cache(cache, regions, catalog, filt_names, astro, photo, magref, density_radius):
+    """Assemble the perturbation AUF inputs of a chunk from the cached grids.
+
+    See `perturb_auf_indices` and `perturb_auf_grids`, which this combines.
+
+    Returns:
+        Tuple of the (3, N) indices of each source into the grids (N-m combination,
+        filter, pointing), and the dict of ``fourier_grid``, ``frac_grid``,
+        ``flux_grid`` and ``arraylengths`` in macauff's (..., N-m, filter, pointing)
+        layout.
+    """
+    return (
+        perturb_auf_indices(cache, regions, catalog, filt_names, astro, photo, magref, density_radius),
+        perturb_auf_grids(cache, regions, catalog, filt_names),
+    )
+
+
+def perturb_auf_grids(cache, regions, catalog, filt_names) -> dict[str, np.ndarray]:
+    """Assemble the cached grids of the regions of a chunk in macauff's layout.
+
+    The grids only depend on the regions, so the chunks with the same regions can
+    share them (see `AufGridCache.grids_key`). They are the largest arrays of a chunk.
+
+    Args:
+        cache (AufGridCache): the cache to read.
+        regions (list[HealpixPixel]): the cache regions of the chunk (see
+            `AufGridCache.regions_for`), one AUF pointing each.
+        catalog (str): "a" or "b".
+        filt_names (list[str]): the filters of the catalog, in magnitude column order.
+
+    Returns:
+        dict of ``fourier_grid``, ``frac_grid``, ``flux_grid`` and ``arraylengths`` in
+        macauff's (..., N-m, filter, pointing) layout.
+    """
+    grids = [[cache.read(region, catalog, filt) for region in regions] for filt in filt_names]
+    arraylengths = np.array(
+        [[len(grid["N"]) for grid in filter_grids] for filter_grids in grids], dtype=np.int64, order="F"
+    )
+    longest_nm = int(arraylengths.max())
+    num_filters, num_points = arraylengths.shape
+    fourier_grid = np.full(
+        (grids[0][0]["fourier"].shape[0], longest_nm, num_filters, num_points), -1.0, order="F"
+    )
+    frac_grid = np.full((grids[0][0]["frac"].shape[0], longest_nm, num_filters, num_points), -1.0, order="F")
+    flux_grid = np.full((longest_nm, num_filters, num_points), -1.0, order="F")
+    for index, filter_grids in enumerate(grids):
+        for point, grid in enumerate(filter_grids):
+            length = arraylengths[index, point]
+            fourier_grid[:, :length, index, point] = grid["fourier"]
+            frac_grid[:, :length, index, point] = grid["frac"]
+            flux_grid[:length, index, point] = grid["flux"]
+    return {
+        "fourier_grid": fourier_grid,
+        "frac_grid": frac_grid,
+        "flux_grid": flux_grid,
+        "arraylengths": arraylengths,
+    }
+
+
+def perturb_auf_indices(cache, regions, catalog, filt_names, astro, photo, magref, density_radius):
+    """The indices of the sources of a chunk into the grids of `perturb_auf_grids`.
+
+    Each region is an AUF pointing of the chunk, and each source uses the pointing
+    of the region whose center is nearest, as macauff does. Within it, the source
+    uses the grids of its best filter, at the simulated N-m combination closest to
+    its magnitude and local normalising density. The local density is the number of
+    sources brighter than the filter's ``density_mag`` within ``density_radius``,
+    per square degree. Densities span orders of magnitude while magnitudes differ by
+    a few units, so the distance to a combination is measured in the bins macauff
+    simulates its combinations in: `DENSITY_LOG_STEP` in log density and
+    `MAGNITUDE_STEP` in magnitude.
+
+    Args:
+        cache (AufGridCache): the cache to read.
+        regions (list[HealpixPixel]): the cache regions of the chunk (see
+            `AufGridCache.regions_for`).
+        catalog (str): "a" or "b".
+        filt_names (list[str]): the filters of the catalog, in magnitude column order.
+        astro (np.ndarray): (N, 3) positions and uncertainties of the chunk sources.
+        photo (np.ndarray): (N, num filters) magnitudes of the chunk sources.
+        magref (np.ndarray): index of the best filter of each source.
+        density_radius (float): radius of the local density, in degrees.
+
+    Returns:
+        The (3, N) indices of each source into the grids (N-m combination, filter,
+        pointing).
+    """
+    modelrefinds = np.zeros((3, len(astro)), dtype=np.int64, order="F")
+    modelrefinds[1] = magref
+    if len(regions) > 1 and len(astro) > 0:
+        centers, _ = pixel_bounding_circles(cache.order, [region.pixel for region in regions])
+        modelrefinds[2] = KDTree(centers).query(radec_to_xyz(astro[:, 0], astro[:, 1]))[1]
+    for index, filt in enumerate(filt_names):
+        for point, region in enumerate(regions):
+            sources = np.nonzero((magref == index) & (modelrefinds[2] == point))[0]
+            if len(sources) == 0:
+                continue
+            grid = cache.read(region, catalog, filt)
+            density = _local_density(astro, photo[:, index], grid["density_mag"], sources, density_radius)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                density_steps = (np.log(density)[:, np.newaxis] - np.log(grid["N"])) / DENSITY_LOG_STEP
+            magnitude_steps = (photo[sources, index][:, np.newaxis] - grid["mag"]) / MAGNITUDE_STEP
+            distances = density_steps**2 + magnitude_steps**2
+            modelrefinds[0, sources] = np.argmin(np.nan_to_num(distances, nan=np.inf), axis=1)
+    return modelrefinds
@@ -0,0 +1,187 @@
+"""Coalescing of sparse partition pairs into shared macauff chunks."""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+
+def aligned_pixel(crossmatch_args) -> HealpixPixel:
+    """The aligned pixel of a partition pair: the smaller of the left and right pixels."""
+    if crossmatch_args.left_order > crossmatch_args.right_order:
+        return HealpixPixel(crossmatch_args.left_order, crossmatch_args.left_pixel)
+    return HealpixPixel(crossmatch_args.right_order, crossmatch_args.right_pixel)
+
+
+def group_sparse_pairs(crossmatch_args_list, max_rows, depth):
+    """Group neighbouring low-density partition pairs.
+
+    Pairs are grouped with the other pairs whose aligned pixel has the same ancestor
+    ``depth`` orders up, as long as the group holds at most ``max_rows`` rows (left
+    and right together). Pairs with more rows, or whose aligned pixel is too shallow
+    to have such an ancestor, are left in a group of their own.
+
+    Args:
+        crossmatch_args_list (list[CrossmatchArgs]): the partition pairs.
+        max_rows (int): maximum number of rows in a group.
+        depth (int): how many orders up the common ancestor of a group is.
+
+    Returns:
+        list of (ancestor pixel, list of positions in ``crossmatch_args_list``) for each
+        group. The ancestor pixel is None for pairs left on their own.
+    """
+    return group_sparse_pixels(
+        [aligned_pixel(crossmatch_args) for crossmatch_args in crossmatch_args_list],
+        [
+            len(crossmatch_args.left_df) + len(crossmatch_args.right_df)
+            for crossmatch_args in crossmatch_args_list
+        ],
+        max_rows,
+        depth,
+    )
+
+
+def group_sparse_pixels(pixels, num_rows, max_rows, depth):
+    """Group neighbouring low-density pixels, as `group_sparse_pairs` does for pairs.
+
+    Args:
+        pixels (list[HealpixPixel]): the aligned pixel of each pair.
+        num_rows (list[int]): the number of rows of each pair.
+        max_rows (int): maximum number of rows in a group.
+        depth (int): how many orders up the common ancestor of a group is.
+
+    Returns:
+        list of (ancestor pixel, list of positions in ``pixels``) for each group.
+    """
+    groups = []
+    open_groups = {}
+    for position, (pixel, pixel_rows) in enumerate(zip(pixels, num_rows)):
+        if pixel_rows > max_rows or pixel.order < depth:
+            groups.append((None, [position]))
+            continue
+        ancestor = HealpixPixel(pixel.order - depth, pixel.pixel >> (2 * depth))
+        group = open_groups.get(ancestor)
+        if group is None or group[0] + pixel_rows > max_rows:
+            group = [0, []]
+            open_groups[ancestor] = group
+            groups.append((ancestor, group[1]))
+        group[0] += pixel_rows
+        group[1].append(position)
+    return groups
+
+
+@dataclass
+class MergedPairs:
+    """Partitions of several pairs, merged into a single chunk."""
+
+    left_df: pd.DataFrame
+    """the left partitions of all pairs, one after another"""
+    right_df: pd.DataFrame
+    """the distinct rows of the right partitions of all pairs"""
+    left_offsets: np.ndarray
+    """position of the first row of each pair in ``left_df``, and the total number of rows"""
+    right_lookup_keys: np.ndarray
+    """sorted ``pair * len(right_df) + merged row`` keys of the right rows of every pair"""
+    right_lookup_rows: np.ndarray
+    """position in its own pair's right partition of each of ``right_lookup_keys``"""
+    right_first_pairs: np.ndarray
+    """for each row of ``right_df``, the first pair whose right partition holds it"""
+    right_first_rows: np.ndarray
+    """for each row of ``right_df``, its position in the partition of ``right_first_pairs``"""
+
+
+def merge_pairs(crossmatch_args_list, ra_column, dec_column) -> MergedPairs:
+    """Merge the partitions of several pairs into one chunk.
+
+    Left partitions are filtered to their aligned pixel, so they are disjoint and are
+    simply concatenated. Right partitions (with their margins) may share rows, e.g.
+    when two pairs use the same right partition, so right rows with the same spatial
+    index and coordinates are kept once.
+
+    Args:
+        crossmatch_args_list (list[CrossmatchArgs]): the partition pairs.
+        ra_column (int): position of the right ascension column in the right partitions.
+        dec_column (int): position of the declination column in the right partitions.
+    """
+    left_sizes = [len(crossmatch_args.left_df) for crossmatch_args in crossmatch_args_list]
+    left_offsets = np.concatenate([[0], np.cumsum(left_sizes)]).astype(np.int64)
+    left_df = pd.concat([crossmatch_args.left_df for crossmatch_args in crossmatch_args_list])
+
+    right_df = pd.concat([crossmatch_args.right_df for crossmatch_args in crossmatch_args_list])
+    right_keys = pd.DataFrame(
+        {
+            "index": right_df.index.to_numpy(),
+            "ra": right_df.iloc[:, ra_column].to_numpy(dtype=np.float64),
+            "dec": right_df.iloc[:, dec_column].to_numpy(dtype=np.float64),
+        }
+    )
+    merged_rows = right_keys.groupby(["index", "ra", "dec"], sort=False).ngroup().to_numpy()
+    first_rows = np.nonzero(~right_keys.duplicated())[0]
+
+    right_pairs = np.repeat(
+        np.arange(len(crossmatch_args_list)),
+        [len(crossmatch_args.right_df) for crossmatch_args in crossmatch_args_list],
+    )
+    right_local_rows = np.concatenate(
+        [np.arange(len(crossmatch_args.right_df)) for crossmatch_args in crossmatch_args_list]
+        + [np.empty(0, dtype=np.int64)]
+    )
+    lookup_keys = right_pairs * len(first_rows) + merged_rows
+    lookup_order = np.argsort(lookup_keys, kind="stable")
+    return MergedPairs(
+        left_df=left_df,
+        right_df=right_df.iloc[first_rows],
+        left_offsets=left_offsets,
+        right_lookup_keys=lookup_keys[lookup_order],
+        right_lookup_rows=right_local_rows[lookup_order].astype(np.int64),
+        right_first_pairs=right_pairs[first_rows].astype(np.int64),
+        right_first_rows=right_local_rows[first_rows].astype(np.int64),
+    )
+
+
+def scatter_matches(merged: MergedPairs, left_indices, right_indices):
+    """Split the matches of a merged chunk back into the matches of each pair.
+
+    A match is given to the pair that holds its left source. Its right source is then
+    looked up in that pair's right partition. In a merged chunk, a left source can
+    also be matched to a right source that is only in the partition of another pair
+    of the group (e.g. across the edge of a pair without a right margin); such a
+    match is kept, with its right source located in the first pair that holds it.
+
+    Returns:
+        list, for each pair, of (positions of its matches in the merged results, left
+        indices in the pair's own partition, the pair whose right partition holds each
+        right source, and the right indices in that partition).
+    """
+    num_pairs = len(merged.left_offsets) - 1
+    pairs = np.searchsorted(merged.left_offsets, left_indices, side="right") - 1
+    lookup_keys = pairs * len(merged.right_df) + right_indices
+    lookup_positions = np.searchsorted(merged.right_lookup_keys, lookup_keys)
+    lookup_positions = np.minimum(lookup_positions, max(len(merged.right_lookup_keys) - 1, 0))
+    found = (
+        merged.right_lookup_keys[lookup_positions] == lookup_keys
+        if len(merged.right_lookup_keys) > 0
+        else np.zeros(len(lookup_keys), dtype=bool)
+    )
+    right_pairs = np.where(found, pairs, merged.right_first_pairs[right_indices]).astype(np.int64)
+    right_rows = np.where(
+        found,
+        merged.right_lookup_rows[lookup_positions] if len(merged.right_lookup_rows) > 0 else 0,
+        merged.right_first_rows[right_indices],
+    ).astype(np.int64)
+
+    scattered = []
+    for pair in range(num_pairs):
+        matches = np.nonzero(pairs == pair)[0]
+        scattered.append(
+            (
+                matches,
+                (left_indices[matches] - merged.left_offsets[pair]).astype(np.int64),
+                right_pairs[matches],
+                right_rows[matches],
+            )
+        )
+    return scattered
@@ -0,0 +1,128 @@
+"""Caching of the chunk configuration derived by macauff."""
+
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+ChunkConfigCacheInfo = namedtuple("ChunkConfigCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+PER_CHUNK_PARAMS = ("chunk_id_list", "auf_region_points_per_chunk", "cf_region_points_per_chunk")
+"""Entries of the parameter dictionaries that are rewritten for every aligned pixel."""
+
+
+class ChunkConfigCache:
+    """Bounded, least-recently-used cache of chunk configurations.
+
+    Entries are keyed by `chunk_config_key`, i.e. by the content of the parameters of
+    a crossmatch, and hold the attributes that macauff derives from those parameters
+    when a chunk is configured. The cache is safe to share between threads. When
+    pickled, the entries and counters are dropped; use `process_chunk_config_cache`
+    to share a cache between all the algorithms, and pairs, of a worker process.
+
+    Attributes:
+        maxsize (int): maximum number of entries. A value of 0 disables caching.
+        hits (int): number of lookups that found an entry.
+        misses (int): number of lookups that did not find an entry.
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 0:
+            raise ValueError("maxsize must be non-negative")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Fetch the configuration for ``key``, or None if it is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, config):
+        """Store the configuration for ``key``, evicting the least recently used entry if full."""
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._entries[key] = config
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def cache_info(self) -> ChunkConfigCacheInfo:
+        """Report the cache statistics, in the style of ``functools.lru_cache``."""
+        with self._lock:
+            return ChunkConfigCacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def __getstate__(self):
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"])
+
+
+_PROCESS_CACHES = {}
+_PROCESS_CACHES_LOCK = threading.Lock()
+
+
+def process_chunk_config_cache(maxsize=128) -> ChunkConfigCache:
+    """The chunk configuration cache of this process with the given size.
+
+    Every call with the same ``maxsize`` returns the same cache, so the algorithms
+    unpickled by the tasks of a dask worker all share it.
+    """
+    with _PROCESS_CACHES_LOCK:
+        if maxsize not in _PROCESS_CACHES:
+            _PROCESS_CACHES[maxsize] = ChunkConfigCache(maxsize)
+        return _PROCESS_CACHES[maxsize]
+
+
+def _update_hash(digest, value):
+    """Feed a parameter value, and its type, into ``digest``."""
+    if isinstance(value, dict):
+        digest.update(b"dict")
+        for key in sorted(value, key=str):
+            _update_hash(digest, key)
+            _update_hash(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update_hash(digest, item)
+    elif isinstance(value, np.ndarray) and value.dtype == object:
+        _update_hash(digest, value.tolist())
+    elif isinstance(value, np.ndarray):
+        digest.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    else:
+        digest.update(f"{type(value).__name__}:{value!r}".encode())
+
+
+def chunk_config_key(crossmatch_params_dict, cat_a_params_dict, cat_b_params_dict) -> str:
+    """Key of the chunk configuration derived from a set of parameter dictionaries.
+
+    The entries in `PER_CHUNK_PARAMS` are ignored, since they are set per aligned
+    pixel, so every pair of a crossmatch shares the same key.
+
+    Returns:
+        A hexadecimal digest of the content of the parameters.
+    """
+    digest = hashlib.sha256()
+    for params_dict in [crossmatch_params_dict, cat_a_params_dict, cat_b_params_dict]:
+        _update_hash(
+            digest, {key: value for key, value in params_dict.items() if key not in PER_CHUNK_PARAMS}
+        )
+    return digest.hexdigest()
@@ -0,0 +1,90 @@
+"""Conversions between partition columns, numpy arrays and Arrow-backed result columns."""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def column_to_numpy(column, dtype, na_value=np.nan):
+    """Convert a single partition column to a numpy array of the given dtype.
+
+    Arrow-backed columns are read straight from their buffers. A copy is only made
+    when the column is split over several chunks, contains nulls, or needs a type
+    conversion (e.g. Arrow's bit-packed booleans), in which case exactly one
+    conversion is performed. The returned array may be a read-only view.
+
+    Args:
+        column (pd.Series): the partition column.
+        dtype (np.dtype): the numpy type of the result.
+        na_value: the value to use for nulls.
+
+    Returns:
+        np.ndarray with the values of the column.
+    """
+    if not isinstance(column.dtype, pd.ArrowDtype):
+        return column.to_numpy(dtype=dtype, copy=False)
+    arrow_data = pa.array(column.array)
+    if isinstance(arrow_data, pa.ChunkedArray):
+        arrow_data = arrow_data.combine_chunks()
+    if arrow_data.null_count > 0:
+        return column.to_numpy(dtype=dtype, na_value=na_value)
+    return arrow_data.to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+
+
+def columns_to_numpy(partition, indices, dtype):
+    """Stack several partition columns into a single (N, len(indices)) numpy array.
+
+    Each column is written directly into the preallocated output, avoiding the
+    intermediate (object-typed, for Arrow-backed frames) array that
+    ``DataFrame.to_numpy`` builds.
+    """
+    values = np.empty((len(partition), len(indices)), dtype=dtype)
+    for position, index in enumerate(indices):
+        values[:, position] = column_to_numpy(partition.iloc[:, index], dtype)
+    return values
+
+
+def to_arrow_columns(values, schema):
+    """Wrap result arrays as pyarrow-backed columns, without an intermediate numpy frame.
+
+    Contiguous float64 arrays are handed to Arrow without a copy; strided views (such as
+    the rows of the contamination probability arrays) are copied once.
+
+    Args:
+        values (dict[str, np.ndarray]): the result array for each column.
+        schema (pd.DataFrame): empty frame with the names and Arrow dtypes of the columns.
+
+    Returns:
+        pd.DataFrame with the columns of ``schema``, in the same order.
+    """
+    return pd.DataFrame(
+        {
+            name: pd.arrays.ArrowExtensionArray(_to_arrow_array(values[name], dtype.pyarrow_dtype))
+            for name, dtype in schema.dtypes.items()
+        },
+        copy=False,
+    )
+
+
+def _to_arrow_array(values, arrow_type):
+    """Convert a result array to Arrow, with nulls where it is NaN or masked.
+
+    NaN values are nulls, as they were when the result was converted with
+    ``convert_dtypes``.
+    """
+    data = np.ascontiguousarray(np.ma.getdata(values))
+    mask = np.ma.getmask(values)
+    mask = None if mask is np.ma.nomask else mask
+    if data.dtype.kind == "f":
+        nan = np.isnan(data)
+        if nan.any():
+            mask = nan if mask is None else mask | nan
+    return pa.array(data, type=arrow_type, mask=mask)
+
+
+def concatenate_values(arrays):
+    """Concatenate result arrays, keeping the masks of any masked arrays."""
+    arrays = [np.empty(0, dtype=np.float64)] + list(arrays)
+    if any(isinstance(array, np.ma.MaskedArray) for array in arrays):
+        return np.ma.concatenate(arrays)
+    return np.concatenate(arrays)
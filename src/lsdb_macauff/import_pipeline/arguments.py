@@ -4,14 +4,18 @@ from dataclasses import dataclass, field
 from os import path
 from pathlib import Path
 
+import pyarrow as pa
 from hats.catalog import TableProperties
 from hats.io.validation import is_valid_catalog
-from hats_import.catalog.file_readers import InputReader, get_file_reader
+from hats_import.catalog.file_readers import CsvPyarrowReader, InputReader, get_file_reader
 from hats_import.runtime_arguments import RuntimeArguments, find_input_paths
 from upath import UPath
 
+from lsdb_macauff.import_pipeline.convert_metadata import apply_schema_to_reader, read_schema
+
 # pylint: disable=too-many-instance-attributes
 # pylint: disable=unsupported-binary-operation
+# pylint: disable=too-many-branches
 
 
 @dataclass
@@ -41,18 +45,76 @@ class MacauffArguments(RuntimeArguments):
     right_catalog_dir: str = ""
     right_id_column: str = ""
     right_assn_column: str = ""
+    right_ra_column: str = ""
+    """if set, with `right_dec_column`, each association row is also assigned to the
+    right partition of its right position, in the ``join_Norder`` and ``join_Npix``
+    columns, and the pairs of left and right partitions are listed in
+    ``partition_join_info.csv``"""
+    right_dec_column: str = ""
 
     ## `macauff` specific attributes
     metadata_file_path: str = ""
+    """XML or YAML file with the column metadata of the cross-match files, or a parquet
+    file with their schema. The column types are given to the file reader, and every
+    split shard is written with this schema"""
+    metadata_table_name: str = ""
+    """for a YAML `metadata_file_path`, the table of the cross-match files. Defaults to
+    the first table"""
+    metadata_schema: pa.Schema | None = None
+    """resolved schema of the cross-match files, read from `metadata_file_path`"""
     resume: bool = True
     """if there are existing intermediate resume files, should we
     read those and continue to create a new catalog where we left off"""
 
     file_reader: InputReader | None = None
+    """reader of the cross-match files. Defaults to a reader that produces Arrow tables,
+    `CsvPyarrowReader` for ``csv`` and `ParquetPyarrowReader` for ``parquet`` files,
+    which the splitting stage uses without converting to pandas"""
+
+    ## Splitting
+    shard_max_rows: int = 1_000_000
+    """in the splitting stage, rows of a left pixel are buffered across input chunks,
+    and written to a shard file once there are this many"""
+    shard_buffer_max_bytes: int = 512 * 1024**2
+    """in the splitting stage, when the rows buffered for all pixels take more memory
+    than this, the largest buffers are written out"""
+    sort_max_bytes: int = 256 * 1024**2
+    """in the reducing stage, the memory budget of the rows sorted at once. A task
+    holds the rows and their sorted copy, so takes about this much for the sort.
+    Larger pixels are sorted externally, in spatial buckets that fit the budget"""
+    sort_max_rows: int | None = None
+    """in the reducing stage, the most rows sorted in memory at once. Defaults to the
+    number of rows that fit in `sort_max_bytes`, from their uncompressed size"""
+
+    ## Reducing
+    partition_by_join_pixel: bool = False
+    """sort the rows of each left partition by their right partition first, so that the
+    rows of each pair of left and right partitions are contiguous. Requires
+    `right_ra_column` and `right_dec_column`"""
+    write_table_kwargs: dict | None = None
+    """additional keyword arguments of the `pyarrow.parquet.ParquetWriter` of the
+    association files, e.g. ``compression`` or ``use_dictionary``"""
+    row_group_kwargs: dict | None = None
+    """sizing of the row groups of the association files. ``{"num_rows": N}`` writes
+    row groups of N rows (100_000 by default)"""
 
     def __post_init__(self):
         self._check_arguments()
 
+    def _check_memory_arguments(self):
+        """Check the arguments that bound the memory of the splitting and reducing stages."""
+        if self.shard_max_rows <= 0:
+            raise ValueError("shard_max_rows must be positive")
+        if self.shard_buffer_max_bytes <= 0:
+            raise ValueError("shard_buffer_max_bytes must be positive")
+        if self.sort_max_bytes <= 0:
+            raise ValueError("sort_max_bytes must be positive")
+        if self.sort_max_rows is not None and self.sort_max_rows <= 0:
+            raise ValueError("sort_max_rows must be positive")
+
+        if self.row_group_kwargs and set(self.row_group_kwargs) - {"num_rows"}:
+            raise ValueError("row_group_kwargs only supports num_rows")
+
     def _check_arguments(self):
         super()._check_arguments()
 
@@ -82,6 +144,12 @@ class MacauffArguments(RuntimeArguments):
             raise ValueError("right_assn_column is required")
         if not is_valid_catalog(self.right_catalog_dir):
             raise ValueError("right_catalog_dir not a valid catalog")
+        if bool(self.right_ra_column) != bool(self.right_dec_column):
+            raise ValueError("right_ra_column and right_dec_column must be provided together")
+        if self.partition_by_join_pixel and not self.right_ra_column:
+            raise ValueError("partition_by_join_pixel requires right_ra_column and right_dec_column")
+
+        self._check_memory_arguments()
 
         if not self.metadata_file_path:
             raise ValueError("metadata_file_path required for macauff crossmatch")
@@ -92,7 +160,13 @@ class MacauffArguments(RuntimeArguments):
         self.input_paths = find_input_paths(self.input_path, f"*{self.input_format}", self.input_file_list)
 
         if not self.file_reader:
-            self.file_reader = get_file_reader(file_format=self.input_format)
+            if self.input_format == "csv":
+                self.file_reader = CsvPyarrowReader()
+            else:
+                self.file_reader = get_file_reader(file_format=self.input_format)
+
+        self.metadata_schema = read_schema(self.metadata_file_path, self.metadata_table_name or None)
+        apply_schema_to_reader(self.file_reader, self.metadata_schema)
 
     def to_table_properties(self, total_rows) -> TableProperties:
         """Catalog-type-specific dataset info."""
@@ -2,9 +2,12 @@
 
 import xml.etree.ElementTree as ET
 
+import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 import yaml
+from hats.io import file_io
+from hats_import.catalog.file_readers import CsvPyarrowReader, CsvReader
 from upath import UPath
 
 
@@ -47,6 +50,16 @@ def from_xml(input_file, output_file):
         input file (str): file to read for match metadata
         output_file (str): desired location for output parquet metadata file
 
+    Raises
+        ValueError: if the XML is mal-formed
+    """
+    schema = schema_from_xml(input_file)
+    pq.write_table(schema.empty_table(), where=output_file)
+
+
+def schema_from_xml(input_file) -> pa.Schema:
+    """Read XML file with column metadata for a cross-match file from macauff, see `from_xml`.
+
     Raises
         ValueError: if the XML is mal-formed
     """
@@ -61,8 +74,7 @@ def from_xml(input_file, output_file):
 
         fields.append(_construct_field(name, units, metadata_dict={"macauff_description": description}))
 
-    schema = pa.schema(fields)
-    pq.write_table(schema.empty_table(), where=output_file)
+    return pa.schema(fields)
 
 
 def from_yaml(input_file, output_directory: UPath):
@@ -86,6 +98,19 @@ def from_yaml(input_file, output_directory: UPath):
         output_dir (str): desired location for output parquet metadata files
             We will write one file per table in the "tables" element.
     """
+    for table_name, schema in schemas_from_yaml(input_file).items():
+        output_file = output_directory / f"{table_name}.parquet"
+        pq.write_table(schema.empty_table(), where=str(output_file))
+
+
+def schemas_from_yaml(input_file) -> dict[str, pa.Schema]:
+    """Read YAML file with column metadata for the various cross-match files from macauff,
+    see `from_yaml`.
+
+    Returns:
+        The schema of each table in the "tables" element, by table name.
+    """
+    schemas = {}
     with open(input_file, "r", encoding="utf-8") as file_handle:
         metadata = yaml.safe_load(file_handle)
         tables = metadata.get("tables", [])
@@ -96,7 +121,55 @@ def from_yaml(input_file, output_directory: UPath):
                 name = column.get("name", f"column_{col_index}")
                 units = column.get("datatype", "string")
                 fields.append(_construct_field(name, units, metadata_dict=column))
+            schemas[table_name] = pa.schema(fields)
+    return schemas
+
 
-            schema = pa.schema(fields)
-            output_file = output_directory / f"{table_name}.parquet"
-            pq.write_table(schema.empty_table(), where=str(output_file))
+def read_schema(metadata_file_path, table_name=None) -> pa.Schema:
+    """Read the schema of a cross-match file from a metadata file of any supported format.
+
+    Args:
+        metadata_file_path (str | Path | UPath): XML or YAML file with column metadata
+            (see `from_xml` and `from_yaml`), or a parquet file with the schema, such as
+            written by them.
+        table_name (str | None): for YAML files, the table of the cross-match file.
+            Defaults to the first table.
+
+    Raises:
+        ValueError: if the YAML file has no tables, or none named ``table_name``.
+    """
+    suffix = UPath(metadata_file_path).suffix.lower()
+    if suffix == ".xml":
+        return schema_from_xml(metadata_file_path)
+    if suffix in (".yaml", ".yml"):
+        schemas = schemas_from_yaml(metadata_file_path)
+        if not schemas:
+            raise ValueError(f"no tables found in {metadata_file_path}")
+        if table_name is None:
+            return next(iter(schemas.values()))
+        if table_name not in schemas:
+            raise ValueError(f"table {table_name} not found in {metadata_file_path}")
+        return schemas[table_name]
+    return file_io.read_parquet_metadata(metadata_file_path).schema.to_arrow_schema()
+
+
+def apply_schema_to_reader(file_reader, schema: pa.Schema):
+    """Give the column types of ``schema`` to a CSV reader, so that it need not infer them.
+
+    The pandas `CsvReader` reads the columns as pyarrow-backed dtypes, which convert to
+    Arrow without inference, and the `CsvPyarrowReader` converts them directly. Types
+    the reader already has, from its ``schema_file``, ``type_map``, ``dtype`` or
+    ``convert_options``, are kept. Other readers read typed files, and are left unchanged.
+
+    Args:
+        file_reader (InputReader): the reader of the cross-match files.
+        schema (pa.Schema): the schema of the cross-match files.
+    """
+    if isinstance(file_reader, CsvReader):
+        if "dtype" not in file_reader.kwargs:
+            file_reader.kwargs["dtype"] = {field.name: pd.ArrowDtype(field.type) for field in schema}
+        if file_reader.header is None and "names" not in file_reader.kwargs:
+            file_reader.kwargs["names"] = schema.names
+    elif isinstance(file_reader, CsvPyarrowReader):
+        if not file_reader.convert_options.column_types:
+            file_reader.convert_options.column_types = schema
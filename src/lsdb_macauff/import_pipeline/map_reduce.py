@@ -5,12 +5,29 @@ import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 from hats.io import file_io, paths
-from hats_import.catalog.map_reduce import _iterate_input_file
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from hats.pixel_math.spatial_index import SPATIAL_INDEX_COLUMN, SPATIAL_INDEX_ORDER, compute_spatial_index
+from hats_import.catalog.map_reduce import _warn_if_not_double_precision_columns
 from hats_import.pipeline_resume_plan import get_pixel_cache_directory, print_task_failure
 
-from lsdb_macauff.import_pipeline.resume_plan import MacauffResumePlan
+from lsdb_macauff.import_pipeline.resume_plan import (
+    PARTITION_JOIN_INFO_COLUMNS,
+    MacauffResumePlan,
+    align_pixels,
+    read_pixel_alignment,
+)
 
-# pylint: disable=too-many-arguments,too-many-locals
+# pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+
+DEFAULT_ROW_GROUP_ROWS = 100_000
+"""Rows of the row groups of the association files, unless set in ``row_group_kwargs``."""
+
+DEFAULT_SORT_MAX_BYTES = 256 * 1024**2
+"""Memory budget of the rows of a pixel that the reducing stage sorts at once, unless
+``sort_max_rows`` is given."""
+
+JOIN_COLUMNS = PARTITION_JOIN_INFO_COLUMNS[2:]
+"""Columns of the order and pixel of the right partition of each association row."""
 
 
 def split_associations(
@@ -22,45 +39,88 @@ def split_associations(
     left_ra_column,
     left_dec_column,
     tmp_path,
+    shard_max_rows=1_000_000,
+    shard_buffer_max_bytes=512 * 1024**2,
+    right_alignment_file=None,
+    highest_right_order=0,
+    right_ra_column=None,
+    right_dec_column=None,
+    metadata_schema=None,
 ):
     """Map a file of links to their healpix pixels and split into shards.
 
+    The chunks of the file are handled as Arrow tables throughout (see
+    `read_arrow_chunks`): the left pixel of each link is derived from its spatial
+    index, and the links are grouped by pixel with a single ``take``.
+
+    If a ``metadata_schema`` is given, the chunks of the file are given its types and
+    column metadata, so that all shards have the same schema. With a reader that was
+    given the schema (see `apply_schema_to_reader`), this does not copy any data.
+
+    The HATS spatial index of the left position of each link is added as the first
+    column, ``_healpix_29``. If a ``right_alignment_file`` is given, the order and
+    pixel of the right partition of the right position of each link are added as the
+    last columns, ``join_Norder`` and ``join_Npix``. Rows are buffered per pixel
+    across the chunks of the file (see `ShardWriter`), so that each task writes one or
+    a few shards per pixel.
 
     Raises:
-        ValueError: if the `ra_column` or `dec_column` cannot be found in the input file.
+        ValueError: if the `ra_column` or `dec_column` cannot be found in the input file,
+            or if some links are outside of the left or right catalog.
         FileNotFoundError: if the file does not exist, or is a directory
     """
     try:
-        with open(left_alignment_file, "rb") as pickle_file:
-            left_alignment = pickle.load(pickle_file)
-
-        for chunk_number, data, mapped_left_pixels in _iterate_input_file(
-            input_file, pickled_reader_file, highest_left_order, left_ra_column, left_dec_column, False
-        ):
-            aligned_left_pixels = left_alignment[mapped_left_pixels]
-            unique_pixels, unique_inverse = np.unique(aligned_left_pixels, return_inverse=True)
-
-            for unique_index, pixel in enumerate(unique_pixels):
-                mapped_indexes = np.where(unique_inverse == unique_index)
-                data_indexes = data.index[mapped_indexes[0].tolist()]
-
-                filtered_data = data.filter(items=data_indexes, axis=0)
+        left_alignment = read_pixel_alignment(left_alignment_file)
+        right_alignment = None if right_alignment_file is None else read_pixel_alignment(right_alignment_file)
+        shard_writer = ShardWriter(tmp_path, splitting_key, shard_max_rows, shard_buffer_max_bytes)
 
-                pixel_dir = get_pixel_cache_directory(tmp_path, pixel)
-                file_io.make_directory(pixel_dir, exist_ok=True)
-                output_file = file_io.append_paths_to_pointer(
-                    pixel_dir, f"shard_{splitting_key}_{chunk_number}.parquet"
+        position_columns = [left_ra_column, left_dec_column]
+        if right_alignment is not None:
+            position_columns += [right_ra_column, right_dec_column]
+        for chunk_number, data in enumerate(read_arrow_chunks(input_file, pickled_reader_file)):
+            missing_columns = [column for column in position_columns if column not in data.column_names]
+            if missing_columns:
+                raise ValueError(f"columns {missing_columns} not found in {input_file}")
+            if chunk_number == 0:
+                _warn_if_not_double_precision_columns(data, [left_ra_column, left_dec_column])
+            if metadata_schema is not None:
+                data = data.cast(
+                    pa.schema(
+                        [
+                            metadata_schema.field(name) if name in metadata_schema.names else data.field(name)
+                            for name in data.column_names
+                        ]
+                    )
+                )
+            spatial_index = compute_spatial_index(
+                data[left_ra_column].to_numpy(), data[left_dec_column].to_numpy()
+            )
+            alignment_rows = align_pixels(
+                left_alignment, spatial_index >> (2 * (SPATIAL_INDEX_ORDER - highest_left_order))
+            )
+            data = data.add_column(0, SPATIAL_INDEX_COLUMN, pa.array(spatial_index, type=pa.int64()))
+            if right_alignment is not None:
+                right_spatial_index = compute_spatial_index(
+                    data[right_ra_column].to_numpy(), data[right_dec_column].to_numpy()
+                )
+                right_rows = align_pixels(
+                    right_alignment,
+                    right_spatial_index >> (2 * (SPATIAL_INDEX_ORDER - highest_right_order)),
+                    catalog_side="right",
+                )
+                data = data.append_column(
+                    JOIN_COLUMNS[0], pa.array(right_alignment[right_rows, 2], pa.uint8())
+                )
+                data = data.append_column(
+                    JOIN_COLUMNS[1], pa.array(right_alignment[right_rows, 3], pa.uint64())
                 )
-                if isinstance(data, pd.DataFrame):
-                    filtered_data = data.iloc[unique_inverse == unique_index]
-                    filtered_data = pa.Table.from_pandas(
-                        filtered_data, preserve_index=False
-                    ).replace_schema_metadata()
-                else:
-                    filtered_data = data.filter(unique_inverse == unique_index)
 
-                pq.write_table(filtered_data, output_file.path, filesystem=output_file.fs)
-                del filtered_data
+            for alignment_row, filtered_data in split_by_pixel(data, alignment_rows):
+                pixel = HealpixPixel(
+                    int(left_alignment[alignment_row, 2]), int(left_alignment[alignment_row, 3])
+                )
+                shard_writer.add(pixel, filtered_data)
+        shard_writer.close()
 
         MacauffResumePlan.splitting_key_done(tmp_path=tmp_path, splitting_key=splitting_key)
     except Exception as exception:  # pylint: disable=broad-exception-caught
@@ -68,9 +128,169 @@ def split_associations(
         raise exception
 
 
-def reduce_associations(left_pixel, tmp_path, catalog_path, reduce_key):
+def read_arrow_chunks(input_file, pickled_reader_file):
+    """Generator of the chunks of an input file, as Arrow tables.
+
+    Readers that produce Arrow tables, such as `CsvPyarrowReader` and
+    `ParquetPyarrowReader`, are used as they are. The chunks of pandas readers are
+    converted once, as a whole.
+
+    Raises:
+        NotImplementedError: if there is no file reader.
+    """
+    with open(pickled_reader_file, "rb") as pickle_file:
+        file_reader = pickle.load(pickle_file)
+    if not file_reader:
+        raise NotImplementedError("No file reader implemented")
+    for data in file_reader.read(input_file):
+        if isinstance(data, pd.DataFrame):
+            data = pa.Table.from_pandas(data, preserve_index=False)
+        yield data.replace_schema_metadata()
+
+
+class ShardWriter:
+    """Buffers the rows of each left pixel, and writes them out in few, large shards.
+
+    A pixel's rows are written as a shard once they reach ``max_rows``. When the rows
+    buffered for all pixels take more than ``max_bytes``, the largest buffers are
+    written out until they fit again. Shards are named
+    ``shard_{splitting_key}_{number}.parquet``, numbered per pixel.
+
+    Args:
+        tmp_path (str | Path | UPath): the directory of the intermediate files.
+        splitting_key (str): unique string of the splitting task.
+        max_rows (int): rows of a pixel at which they are written out.
+        max_bytes (int): memory of the buffered rows of all pixels at which the
+            largest buffers are written out.
+    """
+
+    def __init__(self, tmp_path, splitting_key, max_rows, max_bytes):
+        self.tmp_path = tmp_path
+        self.splitting_key = splitting_key
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self._buffers = {}
+        self._shard_counts = {}
+        self._buffered_bytes = 0
+
+    def add(self, pixel, table: pa.Table):
+        """Buffer the rows of ``table``, which are all in ``pixel``."""
+        if table.get_total_buffer_size() > 2 * table.nbytes:
+            ## A small slice of a larger chunk: copy it, so that the buffer does not keep
+            ## the whole chunk in memory.
+            table = table.take(np.arange(table.num_rows))
+        buffer = self._buffers.setdefault(pixel, [0, 0, []])
+        buffer[0] += table.num_rows
+        buffer[1] += table.nbytes
+        buffer[2].append(table)
+        self._buffered_bytes += table.nbytes
+        if buffer[0] >= self.max_rows:
+            self.flush(pixel)
+        while self._buffered_bytes > self.max_bytes:
+            self.flush(max(self._buffers, key=lambda buffered: self._buffers[buffered][1]))
+
+    def flush(self, pixel):
+        """Write the buffered rows of ``pixel`` as a shard."""
+        _, num_bytes, tables = self._buffers.pop(pixel)
+        self._buffered_bytes -= num_bytes
+        shard_number = self._shard_counts.get(pixel, 0)
+        self._shard_counts[pixel] = shard_number + 1
+
+        pixel_dir = get_pixel_cache_directory(self.tmp_path, pixel)
+        file_io.make_directory(pixel_dir, exist_ok=True)
+        output_file = file_io.append_paths_to_pointer(
+            pixel_dir, f"shard_{self.splitting_key}_{shard_number}.parquet"
+        )
+        merged_table = pa.concat_tables(tables, promote_options="default")
+        pq.write_table(merged_table, output_file.path, filesystem=output_file.fs)
+
+    def close(self):
+        """Write the rows still buffered for every pixel."""
+        for pixel in list(self._buffers):
+            self.flush(pixel)
+
+    def shard_pixels(self):
+        """The pixels that shards were written for."""
+        return list(self._shard_counts)
+
+
+def split_by_pixel(data, pixels):
+    """Group the rows of a chunk of links by their aligned left pixel, or any sortable key.
+
+    The rows are sorted by pixel once, with a stable argsort, and each group is a
+    zero-copy slice of the sorted table.
+
+    Args:
+        data (pd.DataFrame | pa.Table): the chunk of links.
+        pixels (np.ndarray): the aligned left pixel (or its key) of each row.
+
+    Returns:
+        Generator of (pixel, pa.Table) for each pixel that has rows, in sorted order.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, preserve_index=False).replace_schema_metadata()
+    pixels = np.asarray(pixels)
+    if len(pixels) > 1 and np.any(pixels[1:] < pixels[:-1]):
+        order = np.argsort(pixels, kind="stable")
+        pixels = pixels[order]
+        data = data.take(order)
+    if len(pixels) == 0:
+        return
+    starts = np.flatnonzero(np.concatenate([[True], pixels[1:] != pixels[:-1]]))
+    ends = np.append(starts[1:], len(pixels))
+    for start, end in zip(starts, ends):
+        yield pixels[start], data.slice(start, end - start)
+
+
+def reduce_associations(
+    left_pixel,
+    tmp_path,
+    catalog_path,
+    reduce_key,
+    left_id_column=None,
+    write_table_kwargs=None,
+    row_group_kwargs=None,
+    sort_max_rows=None,
+    partition_by_join_pixel=False,
+    sort_max_bytes=DEFAULT_SORT_MAX_BYTES,
+):
     """For all points determined to be in the target left_pixel, map them to the appropriate right_pixel
-    and aggregate into a single parquet file."""
+    and aggregate into a single parquet file.
+
+    The rows are sorted by their ``_healpix_29`` spatial index, then by
+    ``left_id_column``, so that the min/max statistics of the row groups let readers
+    skip the parts of the pixel they do not need. Pixels with more than
+    ``sort_max_rows`` rows are sorted externally: their rows are first spread over
+    spatial buckets of at most about ``sort_max_rows`` rows (see `_plan_sort_buckets`),
+    which are then sorted and written one at a time. The memory of the task therefore
+    does not grow with the size of the pixel.
+
+    Unless given, ``sort_max_rows`` is derived from ``sort_max_bytes`` and the
+    uncompressed size of the rows of the shards (see `_sort_max_rows`). Sorting a table
+    holds both the table and its sorted copy, so a task takes about ``sort_max_bytes``
+    for the sort, plus the buffers of the writers.
+
+    If the rows were assigned to right partitions in the splitting stage, the pairs of
+    ``left_pixel`` and right pixels are saved for ``partition_join_info.csv``, and with
+    ``partition_by_join_pixel`` the rows are sorted by right pixel first, so that the
+    rows of each pair are contiguous.
+
+    Args:
+        left_pixel (HealpixPixel): the pixel to reduce.
+        tmp_path (str | Path | UPath): the directory of the intermediate files.
+        catalog_path (str | Path | UPath): the directory of the association catalog.
+        reduce_key (str): unique string of the reducing task.
+        left_id_column (str | None): the second sorting column.
+        write_table_kwargs (dict | None): additional keyword arguments of the
+            `pyarrow.parquet.ParquetWriter`, e.g. ``compression`` or ``use_dictionary``.
+        row_group_kwargs (dict | None): ``{"num_rows": N}`` to write row groups of N
+            rows, `DEFAULT_ROW_GROUP_ROWS` by default.
+        sort_max_rows (int | None): the most rows sorted in memory at once. If None,
+            derived from ``sort_max_bytes``.
+        partition_by_join_pixel (bool): whether to sort the rows by right pixel first.
+        sort_max_bytes (int): memory budget of the rows sorted at once, used when
+            ``sort_max_rows`` is None.
+    """
     try:
         inputs = get_pixel_cache_directory(tmp_path, left_pixel)
 
@@ -85,8 +305,52 @@ def reduce_associations(left_pixel, tmp_path, catalog_path, reduce_key):
 
         destination_file = paths.pixel_catalog_file(catalog_path, left_pixel)
 
-        merged_table = pq.read_table(inputs)
-        pq.write_table(merged_table, destination_file.path, filesystem=destination_file.fs)
+        row_group_rows = (row_group_kwargs or {}).get("num_rows", DEFAULT_ROW_GROUP_ROWS)
+        shard_files = _list_shards(inputs)
+        schema = pa.unify_schemas([pq.read_schema(shard.path, filesystem=shard.fs) for shard in shard_files])
+        has_join_pixels = all(column in schema.names for column in JOIN_COLUMNS)
+        if sort_max_rows is None:
+            sort_max_rows = _sort_max_rows(shard_files, sort_max_bytes)
+        sort_keys = [(SPATIAL_INDEX_COLUMN, "ascending")]
+        if left_id_column is not None:
+            sort_keys.append((left_id_column, "ascending"))
+        sort_dir = file_io.get_upath(tmp_path) / "sorting" / reduce_key
+        if partition_by_join_pixel and has_join_pixels:
+            sort_keys = [(column, "ascending") for column in JOIN_COLUMNS] + sort_keys
+            sorted_tables = _sorted_tables_by_join_pixel(
+                shard_files, left_pixel, schema, sort_keys, sort_dir, sort_max_rows, row_group_rows
+            )
+        else:
+            sorted_tables = _sorted_tables(
+                shard_files, left_pixel, schema, sort_keys, sort_dir, sort_max_rows, row_group_rows
+            )
+
+        writer_kwargs = {"write_statistics": True} | (write_table_kwargs or {})
+        writer_kwargs["sorting_columns"] = pq.SortingColumn.from_ordering(schema, sort_keys)
+        join_pixels = set()
+        with pq.ParquetWriter(
+            destination_file.path, schema, filesystem=destination_file.fs, **writer_kwargs
+        ) as writer:
+            row_group_writer = _RowGroupWriter(writer, schema, row_group_rows)
+            for sorted_table in sorted_tables:
+                if has_join_pixels:
+                    join_pixels.update(
+                        zip(
+                            *(
+                                column.to_pylist()
+                                for column in sorted_table.group_by(JOIN_COLUMNS).aggregate([]).columns
+                            )
+                        )
+                    )
+                row_group_writer.write(sorted_table)
+                del sorted_table
+            row_group_writer.close()
+        file_io.remove_directory(sort_dir, ignore_errors=True)
+        if has_join_pixels:
+            join_info = pd.DataFrame(sorted(join_pixels), columns=JOIN_COLUMNS)
+            join_info.insert(0, PARTITION_JOIN_INFO_COLUMNS[0], left_pixel.order)
+            join_info.insert(1, PARTITION_JOIN_INFO_COLUMNS[1], left_pixel.pixel)
+            MacauffResumePlan.write_join_pixels(tmp_path, reduce_key, join_info)
         MacauffResumePlan.reducing_key_done(tmp_path=tmp_path, reducing_key=reduce_key)
     except Exception as exception:  # pylint: disable=broad-exception-caught
         print_task_failure(
@@ -94,3 +358,181 @@ def reduce_associations(left_pixel, tmp_path, catalog_path, reduce_key):
             exception,
         )
         raise exception
+
+
+def _list_shards(directory):
+    """The parquet files of a directory of shards, sorted by name."""
+    return sorted(file_io.get_upath(directory).glob("*.parquet"), key=lambda shard: shard.name)
+
+
+def _sort_max_rows(shard_files, max_bytes):
+    """The most rows of the shards that fit, with their sorted copy, in ``max_bytes``.
+
+    The size of a row is the average uncompressed size of the row groups of the shards.
+    """
+    num_rows = 0
+    num_bytes = 0
+    for shard in shard_files:
+        metadata = pq.ParquetFile(shard.path, filesystem=shard.fs).metadata
+        num_rows += metadata.num_rows
+        num_bytes += sum(
+            metadata.row_group(index).total_byte_size for index in range(metadata.num_row_groups)
+        )
+    row_bytes = max(num_bytes / max(num_rows, 1), 1)
+    return max(int(max_bytes / (2 * row_bytes)), 1)
+
+
+def _sorted_tables(shard_files, left_pixel, schema, sort_keys, sort_dir, max_rows, row_group_rows):
+    """Generator of the rows of the shards sorted by ``sort_keys``, in tables of bounded size.
+
+    The first sorting key must be ``_healpix_29``, or constant within the shards.
+    """
+    buckets = _plan_sort_buckets(shard_files, left_pixel, max_rows)
+    if len(buckets) > 1:
+        _spread_to_buckets(shard_files, buckets, sort_dir, row_group_rows)
+    for bucket in buckets:
+        bucket_files = (
+            shard_files if len(buckets) == 1 else _list_shards(get_pixel_cache_directory(sort_dir, bucket))
+        )
+        bucket_table = pa.concat_tables(
+            [pq.read_table(shard.path, filesystem=shard.fs).cast(schema) for shard in bucket_files]
+        )
+        yield bucket_table.sort_by(sort_keys)
+
+
+def _sorted_tables_by_join_pixel(
+    shard_files, left_pixel, schema, sort_keys, sort_dir, max_rows, row_group_rows
+):
+    """Like `_sorted_tables`, for ``sort_keys`` that start with the join pixel columns.
+
+    Pixels with more than ``max_rows`` rows are first spread over one directory per
+    right pixel, each of which is then sorted by `_sorted_tables`.
+    """
+    num_rows = sum(pq.ParquetFile(shard.path, filesystem=shard.fs).metadata.num_rows for shard in shard_files)
+    if num_rows <= max_rows:
+        yield from _sorted_tables(
+            shard_files, left_pixel, schema, sort_keys, sort_dir, max_rows, row_group_rows
+        )
+        return
+
+    join_dir = sort_dir / "join"
+    join_writer = ShardWriter(join_dir, "join", row_group_rows, 64 * 1024**2)
+    for shard in shard_files:
+        for batch in pq.ParquetFile(shard.path, filesystem=shard.fs).iter_batches():
+            join_pixels = np.stack([batch.column(column).to_numpy() for column in JOIN_COLUMNS], axis=1)
+            unique_join_pixels, join_indexes = np.unique(join_pixels, axis=0, return_inverse=True)
+            for join_index, join_rows in split_by_pixel(pa.Table.from_batches([batch]), join_indexes.ravel()):
+                order, pixel = unique_join_pixels[join_index]
+                join_writer.add(HealpixPixel(int(order), int(pixel)), join_rows)
+    join_writer.close()
+
+    for join_pixel in sorted(join_writer.shard_pixels()):
+        yield from _sorted_tables(
+            _list_shards(get_pixel_cache_directory(join_dir, join_pixel)),
+            left_pixel,
+            schema,
+            sort_keys,
+            sort_dir / f"join_{join_pixel.order}_{join_pixel.pixel}",
+            max_rows,
+            row_group_rows,
+        )
+
+
+def _plan_sort_buckets(shard_files, left_pixel, max_rows, histogram_order_delta=6):
+    """Split a pixel into sub-pixels of at most ``max_rows`` rows, in spatial index order.
+
+    The rows are counted in a histogram of the pixel ``histogram_order_delta`` orders
+    deeper, from the ``_healpix_29`` column alone. Sub-pixels with more rows than
+    ``max_rows`` are split into their children, down to the order of the histogram, so
+    a dense histogram bin can still make a bucket larger than ``max_rows``.
+
+    Returns:
+        list of the non-empty sub-pixels, sorted by spatial index.
+    """
+    fine_order = min(left_pixel.order + histogram_order_delta, SPATIAL_INDEX_ORDER)
+    num_bins = 4 ** (fine_order - left_pixel.order)
+    first_bin = left_pixel.pixel * num_bins
+    counts = np.zeros(num_bins, dtype=np.int64)
+    for shard in shard_files:
+        for batch in pq.ParquetFile(shard.path, filesystem=shard.fs).iter_batches(
+            columns=[SPATIAL_INDEX_COLUMN]
+        ):
+            bins = (batch.column(0).to_numpy() >> (2 * (SPATIAL_INDEX_ORDER - fine_order))) - first_bin
+            counts += np.bincount(bins, minlength=num_bins)
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+
+    buckets = []
+    pending = [left_pixel]
+    while pending:
+        pixel = pending.pop()
+        scale = 4 ** (fine_order - pixel.order)
+        start = pixel.pixel * scale - first_bin
+        num_rows = cumulative_counts[start + scale] - cumulative_counts[start]
+        if num_rows == 0:
+            continue
+        if num_rows <= max_rows or pixel.order == fine_order:
+            buckets.append(pixel)
+        else:
+            ## Children in reverse, so that they are popped in nested order.
+            pending.extend(
+                HealpixPixel(pixel.order + 1, pixel.pixel * 4 + child) for child in range(3, -1, -1)
+            )
+    return buckets
+
+
+def _spread_to_buckets(shard_files, buckets, sort_dir, row_group_rows):
+    """Copy the rows of the shards to the directory of their bucket in ``sort_dir``."""
+    bucket_starts = np.array(
+        [bucket.pixel << (2 * (SPATIAL_INDEX_ORDER - bucket.order)) for bucket in buckets], dtype=np.int64
+    )
+    bucket_writer = ShardWriter(sort_dir, "bucket", row_group_rows, 64 * 1024**2)
+    for shard in shard_files:
+        for batch in pq.ParquetFile(shard.path, filesystem=shard.fs).iter_batches():
+            spatial_index = batch.column(SPATIAL_INDEX_COLUMN).to_numpy()
+            bucket_indexes = np.searchsorted(bucket_starts, spatial_index, side="right") - 1
+            for bucket_index, bucket_rows in split_by_pixel(pa.Table.from_batches([batch]), bucket_indexes):
+                bucket_writer.add(buckets[bucket_index], bucket_rows)
+    bucket_writer.close()
+
+
+class _RowGroupWriter:
+    """Writes tables to a parquet file in row groups of ``row_group_rows`` rows, but the last.
+
+    Complete row groups are sliced off each table as they fill, and only the rows
+    of the last, incomplete, row group are held until the next table.
+    """
+
+    def __init__(self, writer, schema, row_group_rows):
+        self.writer = writer
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, table):
+        """Write the complete row groups of ``table``, after the rows held from earlier tables."""
+        table = table.cast(self.schema)
+        if self.pending_rows > 0:
+            num_rows = min(self.row_group_rows - self.pending_rows, table.num_rows)
+            self.pending.append(table.slice(0, num_rows))
+            self.pending_rows += num_rows
+            table = table.slice(num_rows)
+            if self.pending_rows < self.row_group_rows:
+                return
+            self._flush()
+        num_full_rows = table.num_rows - table.num_rows % self.row_group_rows
+        if num_full_rows > 0:
+            self.writer.write_table(table.slice(0, num_full_rows), row_group_size=self.row_group_rows)
+        if num_full_rows < table.num_rows:
+            self.pending = [table.slice(num_full_rows)]
+            self.pending_rows = table.num_rows - num_full_rows
+
+    def close(self):
+        """Write the rows that are held, as the last row group."""
+        if self.pending_rows > 0:
+            self._flush()
+
+    def _flush(self):
+        self.writer.write_table(pa.concat_tables(self.pending), row_group_size=self.row_group_rows)
+        self.pending = []
+        self.pending_rows = 0
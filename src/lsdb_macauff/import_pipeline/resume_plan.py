@@ -2,15 +2,15 @@
 
 from __future__ import annotations
 
-import pickle
 import re
 from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
 from typing import List
 
 import hats
-import hats.pixel_math.healpix_shim as hp
 import numpy as np
+import pandas as pd
 from hats import HealpixPixel
 from hats.io import file_io
 from hats_import.pipeline_resume_plan import PipelineResumePlan
@@ -19,6 +19,9 @@ from upath import UPath
 
 from lsdb_macauff.import_pipeline.arguments import MacauffArguments
 
+PARTITION_JOIN_INFO_COLUMNS = ["Norder", "Npix", "join_Norder", "join_Npix"]
+"""Columns of ``partition_join_info.csv``, one row per pair of left and right pixels."""
+
 
 @dataclass
 class MacauffResumePlan(PipelineResumePlan):
@@ -29,10 +32,14 @@ class MacauffResumePlan(PipelineResumePlan):
     left_pixels: List[HealpixPixel] = field(default_factory=list)
     highest_left_order: int = 0
     left_alignment_file: str = None
+    highest_right_order: int = 0
+    right_alignment_file: str = None
 
     SPLITTING_STAGE = "splitting"
     REDUCING_STAGE = "reducing"
-    LEFT_ALIGNMENT_FILE = "left_alignment.pickle"
+    JOIN_INFO_STAGE = "join_info"
+    LEFT_ALIGNMENT_FILE = "left_alignment.npy"
+    RIGHT_ALIGNMENT_FILE = "right_alignment.npy"
 
     def __init__(self, args: MacauffArguments):
         if not args.tmp_path:  # pragma: no cover (not reachable, but required for mypy)
@@ -70,17 +77,19 @@ class MacauffResumePlan(PipelineResumePlan):
                     self.tmp_path, self.LEFT_ALIGNMENT_FILE
                 )
                 if not file_io.does_file_or_directory_exist(self.left_alignment_file):
-                    regenerated_left_alignment = np.full(hp.order2npix(self.highest_left_order), None)
-                    for pixel in self.left_pixels:
-                        explosion_factor = 4 ** (self.highest_left_order - pixel.order)
-                        exploded_pixels = np.arange(
-                            pixel.pixel * explosion_factor,
-                            (pixel.pixel + 1) * explosion_factor,
+                    write_pixel_alignment(self.left_alignment_file, self.left_pixels, self.highest_left_order)
+                if args.right_ra_column:
+                    right_catalog = hats.read_hats(args.right_catalog_dir)
+                    self.highest_right_order = right_catalog.partition_info.get_highest_order()
+                    self.right_alignment_file = file_io.append_paths_to_pointer(
+                        self.tmp_path, self.RIGHT_ALIGNMENT_FILE
+                    )
+                    if not file_io.does_file_or_directory_exist(self.right_alignment_file):
+                        write_pixel_alignment(
+                            self.right_alignment_file,
+                            right_catalog.partition_info.get_healpix_pixels(),
+                            self.highest_right_order,
                         )
-                        regenerated_left_alignment[exploded_pixels] = pixel
-
-                    with open(self.left_alignment_file, "wb") as pickle_file:
-                        pickle.dump(regenerated_left_alignment, pickle_file)
 
             step_progress.update(1)
 
@@ -95,6 +104,10 @@ class MacauffResumePlan(PipelineResumePlan):
                 file_io.append_paths_to_pointer(self.tmp_path, self.REDUCING_STAGE),
                 exist_ok=True,
             )
+            file_io.make_directory(
+                file_io.append_paths_to_pointer(self.tmp_path, self.JOIN_INFO_STAGE),
+                exist_ok=True,
+            )
             step_progress.update(1)
 
     def get_remaining_split_keys(self):
@@ -158,6 +171,31 @@ class MacauffResumePlan(PipelineResumePlan):
         ]
         return reduce_items
 
+    @classmethod
+    def write_join_pixels(cls, tmp_path, reducing_key: str, join_pixels: pd.DataFrame):
+        """Save the pairs of left and right pixels of a single reducing task.
+
+        Args:
+            tmp_path (str): where to write intermediate resume files.
+            reducing_key (str): unique string for each reducing task (e.g. "3_57")
+            join_pixels (pd.DataFrame): the ``Norder``, ``Npix``, ``join_Norder`` and
+                ``join_Npix`` of the pairs.
+        """
+        join_info_file = file_io.append_paths_to_pointer(tmp_path, cls.JOIN_INFO_STAGE, f"{reducing_key}.csv")
+        file_io.write_dataframe_to_csv(join_pixels, join_info_file, index=False)
+
+    def read_partition_join_info(self) -> pd.DataFrame:
+        """The pairs of left and right pixels of all the reducing tasks, sorted."""
+        join_info_files = sorted((file_io.get_upath(self.tmp_path) / self.JOIN_INFO_STAGE).glob("*.csv"))
+        frames = [file_io.load_csv_to_pandas(join_info_file) for join_info_file in join_info_files]
+        if not frames:
+            return pd.DataFrame(columns=PARTITION_JOIN_INFO_COLUMNS)
+        return (
+            pd.concat(frames, ignore_index=True)
+            .sort_values(PARTITION_JOIN_INFO_COLUMNS)
+            .reset_index(drop=True)
+        )
+
     def is_reducing_done(self) -> bool:
         """Are there partitions left to reduce?"""
         return self.done_file_exists(self.REDUCING_STAGE)
@@ -169,3 +207,64 @@ class MacauffResumePlan(PipelineResumePlan):
         if len(remaining_reduce_items) > 0:
             raise RuntimeError(f"{len(remaining_reduce_items)} reduce stages did not complete successfully.")
         self.touch_stage_done_file(self.REDUCING_STAGE)
+
+
+def write_pixel_alignment(alignment_file, partition_pixels, highest_order):
+    """Save the range table that maps pixels of the highest order to the partitions of a catalog.
+
+    Each partition covers a contiguous range of the nested pixels at the highest
+    order. The table holds one (start, end, order, pixel) row per partition, sorted by
+    the start of its range, so that it takes constant memory whatever the order.
+
+    Args:
+        alignment_file (str | Path | UPath): the ``.npy`` file to write.
+        partition_pixels (list[HealpixPixel]): the partitions of the catalog.
+        highest_order (int): the highest order of the partitions.
+    """
+    table = np.array(
+        [
+            [
+                pixel.pixel << (2 * (highest_order - pixel.order)),
+                (pixel.pixel + 1) << (2 * (highest_order - pixel.order)),
+                pixel.order,
+                pixel.pixel,
+            ]
+            for pixel in partition_pixels
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 4)
+    table = table[np.argsort(table[:, 0], kind="stable")]
+    with open(alignment_file, "wb") as alignment_handle:
+        np.save(alignment_handle, table)
+
+
+@lru_cache(maxsize=4)
+def read_pixel_alignment(alignment_file) -> np.ndarray:
+    """Memory-map the range table written by `write_pixel_alignment`, once per process."""
+    return np.load(str(alignment_file), mmap_mode="r")
+
+
+def align_pixels(alignment, mapped_pixels, catalog_side="left") -> np.ndarray:
+    """Position in the range table of the partition that holds each pixel.
+
+    Args:
+        alignment (np.ndarray): the range table, from `read_pixel_alignment`.
+        mapped_pixels (np.ndarray): pixels of the highest order of the catalog.
+        catalog_side (str): "left" or "right", for the error message.
+
+    Returns:
+        The row of ``alignment`` of each pixel.
+
+    Raises:
+        ValueError: if some pixels are not covered by any partition.
+    """
+    mapped_pixels = np.asarray(mapped_pixels, dtype=np.int64)
+    rows = np.searchsorted(alignment[:, 0], mapped_pixels, side="right") - 1
+    covered = rows >= 0
+    covered[covered] = mapped_pixels[covered] < alignment[rows[covered], 1]
+    if not covered.all():
+        raise ValueError(
+            f"{np.count_nonzero(~covered)} rows are outside of the {catalog_side} catalog, "
+            f"e.g. at pixel {mapped_pixels[~covered][0]}"
+        )
+    return rows
@@ -36,6 +36,13 @@ def run(args, client):
                     left_ra_column=args.left_ra_column,
                     left_dec_column=args.left_dec_column,
                     tmp_path=args.tmp_path,
+                    shard_max_rows=args.shard_max_rows,
+                    shard_buffer_max_bytes=args.shard_buffer_max_bytes,
+                    right_alignment_file=resume_plan.right_alignment_file,
+                    highest_right_order=resume_plan.highest_right_order,
+                    right_ra_column=args.right_ra_column,
+                    right_dec_column=args.right_dec_column,
+                    metadata_schema=args.metadata_schema,
                 )
             )
         resume_plan.wait_for_splitting(futures)
@@ -53,6 +60,12 @@ def run(args, client):
                     tmp_path=args.tmp_path,
                     catalog_path=args.catalog_path,
                     reduce_key=pixel_key,
+                    left_id_column=args.left_id_column,
+                    write_table_kwargs=args.write_table_kwargs,
+                    row_group_kwargs=args.row_group_kwargs,
+                    sort_max_rows=args.sort_max_rows,
+                    sort_max_bytes=args.sort_max_bytes,
+                    partition_by_join_pixel=args.partition_by_join_pixel,
                 )
             )
 
@@ -67,6 +80,12 @@ def run(args, client):
             total_rows += row_group.num_rows
         partition_info = PartitionInfo.read_from_file(metadata_path)
         partition_info.write_to_file(args.catalog_path / "partition_info.csv")
+        if args.right_ra_column:
+            file_io.write_dataframe_to_csv(
+                resume_plan.read_partition_join_info(),
+                args.catalog_path / "partition_join_info.csv",
+                index=False,
+            )
         step_progress.update(1)
         total_rows = int(total_rows)
         catalog_info = args.to_table_properties(total_rows)
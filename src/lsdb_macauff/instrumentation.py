@@ -0,0 +1,222 @@
+"""Opt-in timing and memory instrumentation of the macauff stages of each chunk."""
+
+from __future__ import annotations
+
+import functools
+import resource
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+
+STAGES = [
+    "_initialise_chunk",
+    "make_shared_data",
+    "create_perturb_auf",
+    "group_sources",
+    "calculate_phot_like",
+    "pair_sources",
+    "_postprocess_chunk",
+]
+"""The methods of a chunk context that are timed. ``make_shared_data`` is called from
+``_initialise_chunk``, so its time is also part of the time of ``_initialise_chunk``."""
+
+NESTED_STAGES = ["make_shared_data"]
+"""Stages that run within another stage, to leave out when adding up the time of a chunk."""
+
+MATCH_STAGES = ["pair_sources", "_postprocess_chunk"]
+"""Stages after which the number of matches is recorded as the output rows."""
+
+RECORD_SCHEMA = pa.schema(
+    [
+        pa.field("Norder", pa.uint8()),
+        pa.field("Npix", pa.uint64()),
+        pa.field("chunk", pa.string()),
+        pa.field("stage", pa.string()),
+        pa.field("wall_time", pa.float64()),
+        pa.field("peak_memory", pa.int64()),
+        pa.field("left_rows", pa.int64()),
+        pa.field("right_rows", pa.int64()),
+        pa.field("output_rows", pa.int64()),
+    ]
+)
+"""Columns of the instrumentation table. Times are in seconds, memory in bytes."""
+
+_OPEN_STAGES = []
+"""The stages open in this process, of every recorder, as [memory at start, peak so far] lists."""
+_OPEN_STAGES_LOCK = threading.Lock()
+
+_PROC_STATUS = Path("/proc/self/status")
+_PROC_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+
+class StageRecorder:
+    """Records the wall time, peak memory and row counts of the stages of one chunk.
+
+    Peak memory is how far the resident set of the process rose above its size at the
+    start of the stage, so it includes the work arrays of macauff's Fortran routines,
+    and no allocation is slowed down to measure it. It is read from the high-water mark
+    of the process, which on Linux is reset at the start of every stage (after handing
+    its value so far to the other open stages of the process, so nested and concurrent
+    stages all get their peak). Elsewhere the high-water mark cannot be reset, and the
+    peak is only how far it rose during the stage. The memory of the process is shared
+    by the chunks that run in it, so the peak of a stage includes what concurrent pairs
+    or sub-chunks allocated meanwhile.
+
+    Args:
+        aligned_pix (HealpixPixel): the aligned pixel of the chunk's partition pair.
+        left_rows (int): number of rows of the left partition of the chunk.
+        right_rows (int): number of rows of the right partition of the chunk.
+    """
+
+    def __init__(self, aligned_pix, left_rows, right_rows):
+        self.aligned_pix = aligned_pix
+        self.left_rows = left_rows
+        self.right_rows = right_rows
+        self.chunk = uuid.uuid4().hex
+        self.records = []
+        self._open_stages = []
+
+    def instrument(self, context, stages=None, count_output_rows=None):
+        """Wrap the stage methods of a chunk context, so that every call is recorded.
+
+        Args:
+            context: the chunk context.
+            stages (list[str] | None): the stages to record. Defaults to `STAGES`.
+            count_output_rows (Callable | None): returns the number of matches of the
+                chunk after each of `MATCH_STAGES`. Defaults to the length of ``context.ac``.
+        """
+        if count_output_rows is None:
+
+            def count_output_rows():
+                return len(context.ac)
+
+        for stage in STAGES if stages is None else stages:
+            setattr(context, stage, self._wrap(stage, getattr(context, stage), count_output_rows))
+
+    def finish(self):
+        """Stop recording, closing the stages that were left open by an exception."""
+        with _OPEN_STAGES_LOCK:
+            for open_stage in self._open_stages:
+                _remove_open_stage(open_stage)
+        self._open_stages = []
+
+    def _wrap(self, stage, method, count_output_rows):
+        @functools.wraps(method)
+        def recorded(*args, **kwargs):
+            self._enter_stage()
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            wall_time = time.perf_counter() - start
+            peak_memory = self._exit_stage()
+            output_rows = count_output_rows() if stage in MATCH_STAGES else None
+            self.records.append((stage, wall_time, peak_memory, output_rows))
+            return result
+
+        return recorded
+
+    def _enter_stage(self):
+        with _OPEN_STAGES_LOCK:
+            current, peak = _process_memory()
+            ## The stages that are already open (the outer stage of a nested one, or the
+            ## stages of concurrent chunks) keep the peak so far before it is reset.
+            for open_stage in _OPEN_STAGES:
+                open_stage[1] = max(open_stage[1], peak)
+            open_stage = [current, current] if _reset_peak() else [peak, peak]
+            _OPEN_STAGES.append(open_stage)
+        self._open_stages.append(open_stage)
+
+    def _exit_stage(self):
+        open_stage = self._open_stages.pop()
+        with _OPEN_STAGES_LOCK:
+            _, peak = _process_memory()
+            for other_stage in _OPEN_STAGES:
+                other_stage[1] = max(other_stage[1], peak)
+            _remove_open_stage(open_stage)
+        return open_stage[1] - open_stage[0]
+
+    def to_table(self) -> pa.Table:
+        """The records of this chunk, one row per stage call, with `RECORD_SCHEMA`."""
+        stages, wall_times, peak_memories, output_rows = zip(*self.records) if self.records else ([],) * 4
+        num_records = len(stages)
+        return pa.table(
+            {
+                "Norder": [self.aligned_pix.order] * num_records,
+                "Npix": [self.aligned_pix.pixel] * num_records,
+                "chunk": [self.chunk] * num_records,
+                "stage": list(stages),
+                "wall_time": list(wall_times),
+                "peak_memory": list(peak_memories),
+                "left_rows": [self.left_rows] * num_records,
+                "right_rows": [self.right_rows] * num_records,
+                "output_rows": list(output_rows),
+            },
+            schema=RECORD_SCHEMA,
+        )
+
+    def write(self, instrumentation_dir):
+        """Save the records of this chunk as a parquet file in ``instrumentation_dir``.
+
+        Every chunk writes its own file, so workers never contend for the same file.
+        """
+        instrumentation_dir = Path(instrumentation_dir)
+        instrumentation_dir.mkdir(parents=True, exist_ok=True)
+        pq.write_table(
+            self.to_table(),
+            instrumentation_dir
+            / f"Norder={self.aligned_pix.order}_Npix={self.aligned_pix.pixel}_{self.chunk}.parquet",
+        )
+
+
+def load_instrumentation(instrumentation_dir) -> pd.DataFrame:
+    """Load the records of all chunks of a run as a single frame.
+
+    Args:
+        instrumentation_dir (str | Path): the ``instrumentation_dir`` of the crossmatch.
+
+    Returns:
+        pd.DataFrame with the `RECORD_SCHEMA` columns, one row per stage of each chunk.
+    """
+    dataset = pds.dataset(str(instrumentation_dir), format="parquet", schema=RECORD_SCHEMA)
+    return dataset.to_table().to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _process_memory():
+    """The resident set size and its high-water mark of this process, in bytes.
+
+    The resident set size is None where ``/proc`` is not available.
+    """
+    try:
+        memory = {}
+        for line in _PROC_STATUS.read_text(encoding="ascii").splitlines():
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                memory[name] = int(value.split()[0]) * 1024
+        return memory["VmRSS"], memory["VmHWM"]
+    except (OSError, KeyError, ValueError):
+        ## ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return None, max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _reset_peak():
+    """Reset the high-water mark of the resident set of this process, if the system allows it."""
+    try:
+        _PROC_CLEAR_REFS.write_text("5", encoding="ascii")
+        return True
+    except OSError:
+        return False
+
+
+def _remove_open_stage(open_stage):
+    """Remove a stage from `_OPEN_STAGES`, comparing by identity."""
+    for index, other_stage in enumerate(_OPEN_STAGES):
+        if other_stage is open_stage:
+            del _OPEN_STAGES[index]
+            return
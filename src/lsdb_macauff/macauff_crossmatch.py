@@ -1,19 +1,164 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 import pyarrow as pa
 from cdshealpix.nested import healpix_to_skycoord
-from hats.pixel_math.healpix_pixel import HealpixPixel
 from lsdb.core.crossmatch.abstract_crossmatch_algorithm import AbstractCrossmatchAlgorithm
 from lsdb.core.crossmatch.crossmatch_args import CrossmatchArgs
 from macauff import CrossMatch
 
+from lsdb_macauff.auf_cache import perturb_auf_grids, perturb_auf_indices
+from lsdb_macauff.batching import aligned_pixel, group_sparse_pairs, merge_pairs, scatter_matches
+from lsdb_macauff.chunk_config import chunk_config_key, process_chunk_config_cache
+from lsdb_macauff.columns import column_to_numpy, columns_to_numpy, concatenate_values, to_arrow_columns
+from lsdb_macauff.instrumentation import StageRecorder
+from lsdb_macauff.result_cache import file_stamp, params_hash, referenced_files
+from lsdb_macauff.shared_arrays import arrays_key, process_shared_data_store
+from lsdb_macauff.spatial import any_within, rows_within, split_into_sub_chunks
+
+
+def _merge_photometry_variants(with_photometry, without_photometry):
+    """Outer-join the matches of the with- and without-photometry variants of a chunk.
+
+    Args:
+        with_photometry (tuple): the left indices, right indices and values of the
+            matches made with photometry.
+        without_photometry (tuple): the same, for the matches made without photometry.
+
+    Returns:
+        The left and right indices of the union of the matches, sorted, and their
+        values. The columns of the without-photometry variant are suffixed with
+        `WITHOUT_PHOTOMETRY_SUFFIX`, and the values of each variant are masked for
+        the matches it did not make.
+    """
+    num_right = int(max(with_photometry[1].max(initial=-1), without_photometry[1].max(initial=-1))) + 1
+    variant_keys = [
+        np.asarray(left_indices, dtype=np.int64) * num_right + right_indices
+        for left_indices, right_indices, _ in [with_photometry, without_photometry]
+    ]
+    keys = np.union1d(*variant_keys)
+    values = {}
+    for suffix, keys_in_variant, (_, _, variant_values) in zip(
+        ["", WITHOUT_PHOTOMETRY_SUFFIX], variant_keys, [with_photometry, without_photometry]
+    ):
+        positions = np.searchsorted(keys, keys_in_variant)
+        missing = np.ones(len(keys), dtype=bool)
+        missing[positions] = False
+        for name, column in variant_values.items():
+            merged = np.zeros(len(keys), dtype=np.float64)
+            merged[positions] = column
+            values[f"{name}{suffix}"] = np.ma.masked_array(merged, mask=missing)
+    return keys // num_right, keys % num_right, values
+
+
+def _corrections_parts(corrections):
+    """The parts of an astrometric correction table that go into the parameter hash."""
+    if corrections is None:
+        return (None,)
+    return corrections.order, corrections.pixels, corrections.m, corrections.n
+
+
+WITHOUT_PHOTOMETRY_SUFFIX = "_without_photometry"
+"""Suffix of the result columns of the matches made without photometry."""
 
-# pylint: disable=too-many-instance-attributes, no-member, attribute-defined-outside-init
+
+# pylint: disable=too-many-instance-attributes, no-member, attribute-defined-outside-init, protected-access
+# pylint: disable=too-many-arguments, too-many-positional-arguments, too-many-locals
 class MacauffCrossmatch(AbstractCrossmatchAlgorithm, CrossMatch):
-    """Class that runs the Macauff crossmatch"""
+    """Class that runs the Macauff crossmatch
+
+    Args:
+        crossmatch_params_file_path (str): path to the macauff joint parameters file.
+        cat_a_params_file_path (str): path to the macauff parameters file for the left catalog.
+        cat_b_params_file_path (str): path to the macauff parameters file for the right catalog.
+        chunk_config_cache_size (int): number of chunk configurations, one per set of
+            parameters, kept in the least-recently-used cache of each worker process
+            (see `process_chunk_config_cache`). 0 disables the cache.
+        max_chunk_rows (int | None): if set, partition pairs with more rows than this (left
+            and right together) are split into spatial sub-chunks of at most about this many
+            rows, which are matched separately and merged. The perturbation AUF indices,
+            counterpart fractions and photometric likelihoods are derived once from the
+            whole pair, and every sub-chunk holds the whole islands of its core sources, so
+            the result is the same as that of a single-chunk run.
+        sub_chunk_halo_arcsec (float | None): sources linked to the core of a sub-chunk by a
+            chain of left-right pairs closer than this are added to it as its halo. Defaults
+            to ``pos_corr_dist``, the shortest distance that completes macauff's islands.
+        sub_chunk_workers (int): number of threads used to match the sub-chunks of a pair.
+        sparse_batch_rows (int): in `perform_crossmatch_batch`, the maximum number of rows
+            (left and right together) of a group of sparse pairs matched as one chunk.
+        sparse_batch_depth (int): in `perform_crossmatch_batch`, pairs are only grouped with
+            pairs whose aligned pixel has the same ancestor this many orders up.
+        auf_cache (AufGridCache | None): precomputed perturbation AUF grids (see
+            `build_auf_cache` and `MacauffAufSimulator`). Required when
+            ``include_perturb_auf`` is set.
+        cat_a_astrometric_corrections (AstrometricCorrectionTable | None): precomputed
+            astrometric corrections of the left catalog (see `build_astrometric_corrections`
+            and `MacauffAstrometryFit`). Required when its ``correct_astrometry`` is set.
+        cat_b_astrometric_corrections (AstrometricCorrectionTable | None): the same, for
+            the right catalog.
+        include_without_photometry (bool): if True, the matches made without photometry
+            are returned along with the matches made with it, from the same pass. The
+            result holds the union of both sets of matches, with a second family of extra
+            columns suffixed with `WITHOUT_PHOTOMETRY_SUFFIX`; the columns of a family are
+            null for the matches it did not make. Requires ``include_phot_like`` and
+            ``with_and_without_photometry``.
+        trim_right_partition (bool): if True, the right sources farther than ``pos_corr_dist``
+            from every left source (e.g. margin sources, or the rest of a larger right pixel)
+            are dropped before matching. They can never be matched, but they do count
+            towards the field populations that macauff derives for the chunk, so the
+            match probabilities may change slightly.
+        exact_match_precheck (bool): pairs whose sources are farther apart than
+            ``pos_corr_dist`` are skipped without setting up a chunk. They are found by
+            comparing the bounding boxes of the left and right sources; if True, pairs
+            whose boxes overlap are also checked source by source with a k-d tree,
+            which is only worth its cost when many such pairs have no match.
+        instrumentation_dir (str | Path | None): if set, the wall time, peak memory and row
+            counts of the macauff stages of every chunk are saved in this directory, which
+            must be reachable from all workers. Load them with `load_instrumentation`.
+        result_cache (ResultCache | None): if set, the result of every partition pair is
+            saved in this cache, and pairs whose partitions, pixels and parameters are
+            unchanged since an earlier run are read back instead of matched. The
+            parameters include the files that the parameter files name (see
+            `referenced_files`). Changes to the content of the ``auf_cache`` are not
+            detected.
+        min_match_probability (float | None): if set, matches with a lower probability
+            ``p`` are dropped on the worker, before the result frame is built.
+        max_separation_arcsec (float | None): if set, matches whose sources are farther
+            apart than this are dropped likewise. With ``include_without_photometry``, a
+            match is kept if either of its families passes both thresholds.
+        shared_array_dir (str | Path | None): the Hankel transform grids that macauff's
+            ``make_shared_data`` derives from the parameters, and the perturbation AUF
+            grids that chunks assemble from the ``auf_cache``, are made once per worker
+            process and shared by all its chunks (see `SharedDataStore`). If set, they
+            are also written to this node-local directory and memory-mapped by the other
+            processes of the node, and kept for later runs. The astrometry and
+            photometry of each chunk are then also written there, keyed by their
+            content, so that the concurrent pairs of a partition on the node share them
+            and they can be paged out; they are removed once the chunk is done.
+    """
 
     CHUNK_ID = "0"
 
+    PIXEL_ATTRIBUTES = (
+        "aligned_pix",
+        "chunk_id",
+        "a_auf_region_points",
+        "b_auf_region_points",
+        "cf_region_points",
+    )
+    """Chunk attributes that depend on the aligned pixel, and are set for every pair."""
+
+    PAIR_STAGES = ("create_perturb_auf", "calculate_phot_like")
+    """Stages whose results depend on all of the sources of a pair: the source densities
+    behind the perturbation AUF indices, and the counterpart fractions and photometric
+    likelihoods. They run once for a pair that is split into sub-chunks."""
+
+    SOURCE_ATTRIBUTES = ("a_modelrefinds", "b_modelrefinds", "a_sky_inds", "b_sky_inds")
+    """Attributes set by ``PAIR_STAGES`` that hold a value per source, in their last axis."""
+
     extra_columns = pd.DataFrame(
         {
             "p": pd.Series(dtype=pd.ArrowDtype(pa.float64())),
@@ -29,7 +174,29 @@ class MacauffCrossmatch(AbstractCrossmatchAlgorithm, CrossMatch):
         }
     )
 
-    def __init__(self, crossmatch_params_file_path, cat_a_params_file_path, cat_b_params_file_path):
+    def __init__(
+        self,
+        crossmatch_params_file_path,
+        cat_a_params_file_path,
+        cat_b_params_file_path,
+        chunk_config_cache_size=128,
+        max_chunk_rows=None,
+        sub_chunk_halo_arcsec=None,
+        sub_chunk_workers=1,
+        sparse_batch_rows=10_000,
+        sparse_batch_depth=2,
+        auf_cache=None,
+        cat_a_astrometric_corrections=None,
+        cat_b_astrometric_corrections=None,
+        include_without_photometry=False,
+        instrumentation_dir=None,
+        trim_right_partition=False,
+        exact_match_precheck=False,
+        result_cache=None,
+        min_match_probability=None,
+        max_separation_arcsec=None,
+        shared_array_dir=None,
+    ):
         super().__init__(
             crossmatch_params_file_path,
             cat_a_params_file_path,
@@ -38,16 +205,76 @@ class MacauffCrossmatch(AbstractCrossmatchAlgorithm, CrossMatch):
             use_mpi=False,
             walltime=None,
         )
+        self.auf_cache = auf_cache
+        self.cat_a_astrometric_corrections = cat_a_astrometric_corrections
+        self.cat_b_astrometric_corrections = cat_b_astrometric_corrections
+        self.include_without_photometry = include_without_photometry
+        self.instrumentation_dir = instrumentation_dir
+        self.trim_right_partition = trim_right_partition
+        self.exact_match_precheck = exact_match_precheck
         self.validate_params()
+        if include_without_photometry:
+            self.extra_columns = pd.concat(
+                [self.extra_columns, self.extra_columns.add_suffix(WITHOUT_PHOTOMETRY_SUFFIX)], axis=1
+            )
+        self.chunk_config_cache_size = chunk_config_cache_size
+        self.chunk_config_key = chunk_config_key(
+            self.crossmatch_params_dict, self.cat_a_params_dict, self.cat_b_params_dict
+        )
+        self.max_chunk_rows = max_chunk_rows
+        if sub_chunk_halo_arcsec is None:
+            sub_chunk_halo_arcsec = float(self.crossmatch_params_dict["pos_corr_dist"])
+        if sub_chunk_halo_arcsec < float(self.crossmatch_params_dict["pos_corr_dist"]):
+            raise ValueError("sub_chunk_halo_arcsec must be at least pos_corr_dist")
+        self.sub_chunk_halo_arcsec = sub_chunk_halo_arcsec
+        self.sub_chunk_workers = sub_chunk_workers
+        self.sparse_batch_rows = sparse_batch_rows
+        self.sparse_batch_depth = sparse_batch_depth
+        self.min_match_probability = min_match_probability
+        self.max_separation_arcsec = max_separation_arcsec
+        self.shared_array_dir = shared_array_dir
+        self.result_cache = result_cache
+        self.params_hash = None
+        if result_cache is not None:
+            self.params_hash = params_hash(
+                Path(crossmatch_params_file_path),
+                Path(cat_a_params_file_path),
+                Path(cat_b_params_file_path),
+                max_chunk_rows,
+                sub_chunk_halo_arcsec,
+                None if auf_cache is None else (str(auf_cache.cache_dir), auf_cache.order),
+                *_corrections_parts(cat_a_astrometric_corrections),
+                *_corrections_parts(cat_b_astrometric_corrections),
+                include_without_photometry,
+                trim_right_partition,
+                min_match_probability,
+                max_separation_arcsec,
+                *(
+                    file_stamp(path)
+                    for params_dict, params_path in [
+                        (self.crossmatch_params_dict, crossmatch_params_file_path),
+                        (self.cat_a_params_dict, cat_a_params_file_path),
+                        (self.cat_b_params_dict, cat_b_params_file_path),
+                    ]
+                    for path in referenced_files(params_dict, Path(params_path).parent)
+                ),
+            )
 
     def validate_params(self):
         """Validate that the parameters provided are compatible with this implementation."""
-        if self.crossmatch_params_dict["include_perturb_auf"]:
-            raise NotImplementedError("Perturbations are not implemented in this version.")
-        if self.cat_a_params_dict["correct_astrometry"]:
-            raise NotImplementedError("Astrometric corrections are not implemented in this version.")
-        if self.cat_b_params_dict["correct_astrometry"]:
-            raise NotImplementedError("Astrometric corrections are not implemented in this version.")
+        if self.crossmatch_params_dict["include_perturb_auf"] and self.auf_cache is None:
+            raise NotImplementedError("Perturbations are only supported with a precomputed AUF cache.")
+        if self.cat_a_params_dict["correct_astrometry"] and self.cat_a_astrometric_corrections is None:
+            raise NotImplementedError("Astrometric corrections are only supported when precomputed.")
+        if self.cat_b_params_dict["correct_astrometry"] and self.cat_b_astrometric_corrections is None:
+            raise NotImplementedError("Astrometric corrections are only supported when precomputed.")
+        if self.include_without_photometry and not (
+            self.crossmatch_params_dict["include_phot_like"]
+            and self.crossmatch_params_dict["with_and_without_photometry"]
+        ):
+            raise ValueError(
+                "include_without_photometry requires include_phot_like and with_and_without_photometry"
+            )
 
     def perform_crossmatch(
         self, crossmatch_args: CrossmatchArgs
@@ -64,108 +291,645 @@ class MacauffCrossmatch(AbstractCrossmatchAlgorithm, CrossMatch):
             Indices of the matching rows from the left and right tables found from cross-matching, and a
             datafame with the "_dist_arcsec" column with the great circle separation between the points.
         """
-        l_inds, r_inds, extra_cols = self._find_crossmatch_indices(crossmatch_args)
-        extra_cols = extra_cols.convert_dtypes(dtype_backend="pyarrow", convert_integer=False)
-        return l_inds, r_inds, extra_cols
+        if self.result_cache is None:
+            return self._find_crossmatch_indices(crossmatch_args)
+        key = self.result_cache.result_key(crossmatch_args, self.params_hash)
+        result = self.result_cache.read(key, self.extra_columns)
+        if result is None:
+            result = self._find_crossmatch_indices(crossmatch_args)
+            self.result_cache.write(key, result)
+        return result
+
+    def perform_crossmatch_batch(
+        self, crossmatch_args_list: list[CrossmatchArgs]
+    ) -> list[tuple[np.ndarray, np.ndarray, pd.DataFrame, np.ndarray]]:
+        """Perform the cross-match of several partition pairs, coalescing sparse ones.
+
+        For pairs with few sources, the fixed cost of setting up a macauff chunk dominates.
+        Neighbouring sparse pairs (see `group_sparse_pairs`) are therefore merged and matched
+        as a single chunk, configured for their common ancestor pixel, and the matches are
+        scattered back to the pairs that hold their left sources (see `scatter_matches`).
+        Other pairs are matched one by one, as in `perform_crossmatch`. See
+        `batch_sparse_pairs` to route the sparse pairs of an lsdb crossmatch here.
+
+        With a ``result_cache``, the pairs with a saved result are read back first, and
+        only the others are grouped and matched. The matches of a pair can depend on the
+        pairs it was grouped with, so they may differ slightly from a run without cache.
+        Results with right sources from other pairs are not saved.
+
+        Args:
+            crossmatch_args_list (list[CrossmatchArgs]): the partitions and respective pixel
+                information of each pair.
+
+        Returns:
+            For each pair, in the same order, the result of `perform_crossmatch`, and the
+            position in ``crossmatch_args_list`` of the pair whose right partition holds the
+            right source of each match. That is the pair itself, unless the left source was
+            matched to a right source that is only in the partition of another pair.
+        """
+        results = [None] * len(crossmatch_args_list)
+        keys = [None] * len(crossmatch_args_list)
+        candidates = []
+        for position, crossmatch_args in enumerate(crossmatch_args_list):
+            if not self._has_possible_matches(crossmatch_args.left_df, crossmatch_args.right_df):
+                results[position] = self._empty_result()
+                continue
+            if self.result_cache is not None:
+                keys[position] = self.result_cache.result_key(crossmatch_args, self.params_hash)
+                results[position] = self.result_cache.read(keys[position], self.extra_columns)
+            if results[position] is None:
+                candidates.append(position)
+
+        right_pairs = [None] * len(crossmatch_args_list)
+        b_ra_index, b_dec_index = self.cat_b_params_dict["pos_and_err_indices"][:2]
+        for ancestor, group in group_sparse_pairs(
+            [crossmatch_args_list[position] for position in candidates],
+            self.sparse_batch_rows,
+            self.sparse_batch_depth,
+        ):
+            positions = [candidates[index] for index in group]
+            if ancestor is None or len(positions) == 1:
+                for position in positions:
+                    results[position] = self._find_crossmatch_indices(crossmatch_args_list[position])
+                    if keys[position] is not None:
+                        self.result_cache.write(keys[position], results[position])
+                continue
+            merged = merge_pairs(
+                [crossmatch_args_list[position] for position in positions], b_ra_index, b_dec_index
+            )
+            left_indices, right_indices, values = self._significant_matches(
+                *self._run_chunk(merged.left_df, merged.right_df, ancestor)
+            )
+            scattered = scatter_matches(merged, left_indices, right_indices)
+            for position, (matches, pair_left_indices, pair_right_groups, pair_right_indices) in zip(
+                positions, scattered
+            ):
+                pair_values = {name: values[name][matches] for name in self.extra_columns.columns}
+                results[position] = (
+                    pair_left_indices,
+                    pair_right_indices,
+                    to_arrow_columns(pair_values, self.extra_columns),
+                )
+                right_pairs[position] = np.asarray(positions, dtype=np.int64)[pair_right_groups]
+                if keys[position] is not None and (right_pairs[position] == position).all():
+                    self.result_cache.write(keys[position], results[position])
+        return [
+            (
+                *result,
+                np.full(len(result[0]), position, dtype=np.int64) if pair_rights is None else pair_rights,
+            )
+            for position, (result, pair_rights) in enumerate(zip(results, right_pairs))
+        ]
+
+    def crossmatch_batch(
+        self,
+        crossmatch_args_list: list[CrossmatchArgs],
+        how: str,
+        suffixes: tuple[str, str],
+        suffix_method: str = "all_columns",
+    ) -> list[pd.DataFrame]:
+        """Perform the crossmatch of several partition pairs, as ``crossmatch`` does for one.
+
+        The pairs are matched with `perform_crossmatch_batch`. The right columns of a
+        match whose right source is in the partition of another pair of the batch are
+        taken from that partition.
+
+        Args:
+            crossmatch_args_list (list[CrossmatchArgs]): the partitions and respective pixel
+                information of each pair.
+            how (str): one of {'inner', 'left'}.
+            suffixes (tuple[str, str]): the suffixes of the left and right columns.
+            suffix_method (str): the suffix method to use.
+
+        Returns:
+            The crossmatch result of each pair, in the same order.
+        """
+        frames = []
+        for position, (
+            crossmatch_args,
+            (left_indices, right_indices, extra_columns, right_pairs),
+        ) in enumerate(zip(crossmatch_args_list, self.perform_crossmatch_batch(crossmatch_args_list))):
+            right_df = crossmatch_args.right_df
+            sources = np.unique(right_pairs)
+            if np.any(sources != position):
+                right_frames = [crossmatch_args_list[source].right_df for source in sources]
+                offsets = np.cumsum([0] + [len(frame) for frame in right_frames])
+                right_indices = offsets[np.searchsorted(sources, right_pairs)] + right_indices
+                right_df = pd.concat(right_frames)
+            frames.append(
+                self._create_crossmatch_df(
+                    crossmatch_args.left_df,
+                    right_df,
+                    left_indices,
+                    right_indices,
+                    extra_columns,
+                    how,
+                    suffixes,
+                    suffix_method,
+                )
+            )
+        return frames
 
     def _find_crossmatch_indices(self, crossmatch_args: CrossmatchArgs):
         left_partition = crossmatch_args.left_df
-        left_order = crossmatch_args.left_order
-        left_pixel = crossmatch_args.left_pixel
-
         right_partition = crossmatch_args.right_df
-        right_order = crossmatch_args.right_order
-        right_pixel = crossmatch_args.right_pixel
-
-        aligned_pix = (
-            HealpixPixel(left_order, left_pixel)
-            if left_order > right_order
-            else HealpixPixel(right_order, right_pixel)
-        )
+        aligned_pix = aligned_pixel(crossmatch_args)
 
         if left_partition is None or right_partition is None or aligned_pix is None:
             raise ValueError("left_partition, right_partition, and aligned_pix must be provided.")
 
-        self.left_partition = left_partition
-        self.right_partition = right_partition
-        self.set_chunk_from_healpix(aligned_pix)
-        self._load_metadata_config(self.chunk_id)
-        self._process_chunk()
-        left_indices = self.ac
-        right_indices = self.bc
-        extra_columns = pd.DataFrame(
-            {
-                "p": self.p,
-                "eta": self.eta,
-                "xi": self.xi,
-                "a_avg_cont": self.a_avg_cont,
-                "b_avg_cont": self.b_avg_cont,
-                "a_cont_f1": self.acontprob[0],
-                "a_cont_f10": self.acontprob[1],
-                "b_cont_f1": self.bcontprob[0],
-                "b_cont_f10": self.bcontprob[1],
-                "sep": self.seps,
-            }
+        right_rows = None
+        if self.trim_right_partition:
+            right_rows = self._matchable_right_rows(left_partition, right_partition)
+            if len(right_rows) == 0:
+                return self._empty_result()
+            right_partition = right_partition.iloc[right_rows]
+        elif not self._has_possible_matches(left_partition, right_partition):
+            return self._empty_result()
+
+        if (
+            self.max_chunk_rows is not None
+            and len(left_partition) + len(right_partition) > self.max_chunk_rows
+        ):
+            left_indices, right_indices, values = self._run_sub_chunks(
+                left_partition, right_partition, aligned_pix
+            )
+        else:
+            left_indices, right_indices, values = self._run_chunk(
+                left_partition, right_partition, aligned_pix
+            )
+        if right_rows is not None:
+            right_indices = right_rows[right_indices]
+        left_indices, right_indices, values = self._significant_matches(left_indices, right_indices, values)
+        return left_indices, right_indices, to_arrow_columns(values, self.extra_columns)
+
+    def _significant_matches(self, left_indices, right_indices, values):
+        """Drop the matches below ``min_match_probability`` or beyond ``max_separation_arcsec``."""
+        if self.min_match_probability is None and self.max_separation_arcsec is None:
+            return left_indices, right_indices, values
+        suffixes = [""] + ([WITHOUT_PHOTOMETRY_SUFFIX] if self.include_without_photometry else [])
+        keep = np.zeros(len(left_indices), dtype=bool)
+        for suffix in suffixes:
+            passes = np.ones(len(left_indices), dtype=bool)
+            if self.min_match_probability is not None:
+                passes &= np.ma.filled(values[f"p{suffix}"] >= self.min_match_probability, False)
+            if self.max_separation_arcsec is not None:
+                passes &= np.ma.filled(values[f"sep{suffix}"] <= self.max_separation_arcsec, False)
+            keep |= passes
+        return (
+            left_indices[keep],
+            right_indices[keep],
+            {name: column[keep] for name, column in values.items()},
         )
-        return left_indices, right_indices, extra_columns
+
+    def _positions(self, left_partition, right_partition):
+        """The right ascension and declination of the left and right sources, in degrees."""
+        a_ra_index, a_dec_index = self.cat_a_params_dict["pos_and_err_indices"][:2]
+        b_ra_index, b_dec_index = self.cat_b_params_dict["pos_and_err_indices"][:2]
+        return (
+            column_to_numpy(left_partition.iloc[:, a_ra_index], np.float64),
+            column_to_numpy(left_partition.iloc[:, a_dec_index], np.float64),
+            column_to_numpy(right_partition.iloc[:, b_ra_index], np.float64),
+            column_to_numpy(right_partition.iloc[:, b_dec_index], np.float64),
+        )
+
+    def _has_possible_matches(self, left_partition, right_partition):
+        """Whether any right source lies within ``pos_corr_dist`` of any left source.
+
+        macauff only pairs sources closer than ``pos_corr_dist``, so pairs for which
+        this is False (e.g. an empty side, or partitions at the edge of a footprint)
+        can skip the chunk setup and matching altogether. Unless ``exact_match_precheck``
+        is set, only the bounding boxes of the sources are compared, so this may be
+        True for pairs without possible matches.
+        """
+        if len(left_partition) == 0 or len(right_partition) == 0:
+            return False
+        return any_within(
+            *self._positions(left_partition, right_partition),
+            float(self.crossmatch_params_dict["pos_corr_dist"]),
+            exact=self.exact_match_precheck,
+        )
+
+    def _matchable_right_rows(self, left_partition, right_partition):
+        """Positions of the right sources within ``pos_corr_dist`` of any left source."""
+        if len(left_partition) == 0 or len(right_partition) == 0:
+            return np.empty(0, dtype=np.int64)
+        left_ra, left_dec, right_ra, right_dec = self._positions(left_partition, right_partition)
+        return rows_within(
+            right_ra, right_dec, left_ra, left_dec, float(self.crossmatch_params_dict["pos_corr_dist"])
+        )
+
+    def _empty_result(self):
+        """The result of a pair without matches, with the ``extra_columns`` schema."""
+        empty_indices = np.empty(0, dtype=np.int64)
+        values = {name: np.empty(0, dtype=np.float64) for name in self.extra_columns.columns}
+        return empty_indices, empty_indices.copy(), to_arrow_columns(values, self.extra_columns)
+
+    def _run_chunk(
+        self, left_partition, right_partition, aligned_pix, a_halo=None, b_halo=None, pair_stage_data=None
+    ):
+        """Match a single chunk with macauff.
+
+        Returns:
+            The left and right indices of the matches, and a dictionary with the values of
+            the extra columns for each match.
+        """
+        context = self._make_pair_context(left_partition, right_partition, a_halo, b_halo, pair_stage_data)
+        self._run_stages(context, aligned_pix, context._process_chunk)
+        if self.include_without_photometry:
+            return _merge_photometry_variants(
+                context.chunk_results[""], context.chunk_results[WITHOUT_PHOTOMETRY_SUFFIX]
+            )
+        return context.chunk_results[""]
+
+    def _run_stages(self, context, aligned_pix, run):
+        """Configure a pair context for the aligned pixel, and ``run`` its stages.
+
+        With ``instrumentation_dir``, the stages are recorded while they run.
+        """
+        self._configure_chunk(context, aligned_pix)
+        recorder = None
+        if self.instrumentation_dir is not None:
+            recorder = StageRecorder(aligned_pix, len(context.left_partition), len(context.right_partition))
+            recorder.instrument(context, count_output_rows=context._count_matches)
+        try:
+            run()
+        finally:
+            if recorder is not None:
+                recorder.finish()
+            context._remove_shared_chunk_arrays()
+        if recorder is not None:
+            recorder.write(self.instrumentation_dir)
+
+    def _run_sub_chunks(self, left_partition, right_partition, aligned_pix):
+        """Match a dense partition pair as a set of spatial sub-chunks with halos.
+
+        The ``PAIR_STAGES`` run once for the whole pair, and every sub-chunk uses their
+        results for its own sources (see `_pair_stage_data`). Each sub-chunk holds the
+        whole islands of its core sources (see `split_into_sub_chunks`), so it pairs them
+        exactly as the single chunk would. A match is kept by the sub-chunks whose core
+        holds either of its sources (see ``_postprocess_chunk``), and the copies of the
+        matches kept by two sub-chunks are dropped. The indices are mapped back to
+        positions in the partitions.
+        """
+        sub_chunks = split_into_sub_chunks(
+            aligned_pix,
+            *self._positions(left_partition, right_partition),
+            max_rows=self.max_chunk_rows,
+            halo_arcsec=self.sub_chunk_halo_arcsec,
+        )
+        pair_stage_data = self._pair_stage_data(left_partition, right_partition, aligned_pix)
+
+        def run_sub_chunk(sub_chunk):
+            rows = {"a": sub_chunk.left_rows, "b": sub_chunk.right_rows}
+            left_indices, right_indices, values = self._run_chunk(
+                left_partition.iloc[sub_chunk.left_rows],
+                right_partition.iloc[sub_chunk.right_rows],
+                aligned_pix,
+                a_halo=sub_chunk.left_halo,
+                b_halo=sub_chunk.right_halo,
+                pair_stage_data={
+                    stage: {
+                        name: value[..., rows[name[0]]] if name in self.SOURCE_ATTRIBUTES else value
+                        for name, value in attributes.items()
+                    }
+                    for stage, attributes in pair_stage_data.items()
+                },
+            )
+            return sub_chunk.left_rows[left_indices], sub_chunk.right_rows[right_indices], values
+
+        if self.sub_chunk_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.sub_chunk_workers) as executor:
+                results = list(executor.map(run_sub_chunk, sub_chunks))
+        else:
+            results = [run_sub_chunk(sub_chunk) for sub_chunk in sub_chunks]
+
+        left_indices = np.concatenate([np.empty(0, dtype=np.int64)] + [result[0] for result in results])
+        right_indices = np.concatenate([np.empty(0, dtype=np.int64)] + [result[1] for result in results])
+        _, first = np.unique(left_indices * len(right_partition) + right_indices, return_index=True)
+        first = np.sort(first)
+        values = {
+            name: concatenate_values(result[2][name] for result in results)[first]
+            for name in self.extra_columns.columns
+        }
+        return left_indices[first], right_indices[first], values
+
+    def _pair_stage_data(self, left_partition, right_partition, aligned_pix):
+        """Run the stages of a partition pair up to the last of ``PAIR_STAGES``.
+
+        Returns:
+            For each of ``PAIR_STAGES``, the attributes that it set on the pair context.
+        """
+        context = self._make_pair_context(left_partition, right_partition)
+        pair_stage_data = {}
+
+        def run():
+            context._initialise_chunk()
+            for stage in ["create_perturb_auf", "group_sources", "calculate_phot_like"]:
+                before = dict(vars(context))
+                getattr(context, stage)()
+                if stage in self.PAIR_STAGES:
+                    pair_stage_data[stage] = {
+                        name: value
+                        for name, value in vars(context).items()
+                        if name not in before or before[name] is not value
+                    }
+
+        self._run_stages(context, aligned_pix, run)
+        return pair_stage_data
+
+    def _count_matches(self):
+        """Number of matches of a chunk context, after ``pair_sources`` or ``_postprocess_chunk``.
+
+        With ``include_without_photometry``, the matches of both variants are counted
+        together, as they are merged in the result.
+        """
+        chunk_results = vars(self).get("chunk_results")
+        if chunk_results is not None:
+            if self.include_without_photometry:
+                return len(
+                    _merge_photometry_variants(chunk_results[""], chunk_results[WITHOUT_PHOTOMETRY_SUFFIX])[0]
+                )
+            return len(chunk_results[""][0])
+        if not self.include_without_photometry:
+            return len(self.ac)
+        num_right = len(self.b_astro)
+        return len(
+            np.union1d(
+                self.ac * num_right + self.bc,
+                getattr(self, f"ac{WITHOUT_PHOTOMETRY_SUFFIX}") * num_right
+                + getattr(self, f"bc{WITHOUT_PHOTOMETRY_SUFFIX}"),
+            )
+        )
+
+    def _make_pair_context(
+        self, left_partition, right_partition, a_halo=None, b_halo=None, pair_stage_data=None
+    ):
+        """Create the execution context for a single partition pair.
+
+        macauff keeps all of the state for a chunk as attributes of the ``CrossMatch``
+        object, and rewrites the per-chunk entries of the parameter dictionaries. Each
+        pair therefore runs on its own shallow copy of this algorithm, with private
+        copies of the parameter dictionaries, so that one instance can process several
+        pairs concurrently.
+
+        Args:
+            left_partition (pd.DataFrame): partition from the left catalog.
+            right_partition (pd.DataFrame): partition from the right catalog.
+            a_halo (np.ndarray | None): for sub-chunks, which left rows are in the halo.
+            b_halo (np.ndarray | None): for sub-chunks, which right rows are in the halo.
+            pair_stage_data (dict | None): for sub-chunks, the attributes that each of
+                ``PAIR_STAGES`` set for the whole pair, restricted to the sub-chunk's rows.
+
+        Returns:
+            A copy of this algorithm that holds the state for the given pair.
+        """
+        context = copy.copy(self)
+        context.crossmatch_params_dict = dict(self.crossmatch_params_dict)
+        context.cat_a_params_dict = dict(self.cat_a_params_dict)
+        context.cat_b_params_dict = dict(self.cat_b_params_dict)
+        context.left_partition = left_partition
+        context.right_partition = right_partition
+        context.a_halo = a_halo
+        context.b_halo = b_halo
+        context.pair_stage_data = pair_stage_data
+        return context
+
+    def _configure_chunk(self, context, aligned_pix):
+        """Configure the chunk of a pair context for the aligned pixel.
+
+        Apart from the region points, the attributes that ``_load_metadata_config``
+        derives only depend on the parameters. They are kept in the process-wide
+        ``chunk_config_cache``, keyed by the content of the parameters, and every
+        pair context gets its own copies of them and of the parameter dictionaries.
+        The per-chunk entries and region points are then set for the aligned pixel.
+        """
+        config = self.chunk_config_cache.get(self.chunk_config_key)
+        if config is None:
+            before = dict(vars(context))
+            context.set_chunk_from_healpix(aligned_pix)
+            context._load_metadata_config(context.chunk_id)
+            config = {
+                name: value
+                for name, value in vars(context).items()
+                if name not in self.PIXEL_ATTRIBUTES and (name not in before or before[name] is not value)
+            }
+            for params_dict in ["crossmatch_params_dict", "cat_a_params_dict", "cat_b_params_dict"]:
+                config[params_dict] = getattr(context, params_dict)
+            self.chunk_config_cache.put(self.chunk_config_key, copy.deepcopy(config))
+        else:
+            vars(context).update(copy.deepcopy(config))
+            context.set_chunk_from_healpix(aligned_pix)
+        context._set_region_points()
+
+    def _append_extra_columns(self, dataframe, extra_columns=None):  # pylint: disable=arguments-renamed
+        """Add the extra columns to the crossmatch result.
+
+        lsdb checks the columns against the class-level ``extra_columns``, but here
+        they depend on the options of the instance, so they are checked against those.
+        """
+        if extra_columns is None:
+            raise ValueError("No extra column values were provided")
+        for name, dtype in self.extra_columns.dtypes.items():
+            if name not in extra_columns:
+                raise ValueError(f"Missing extra column '{name} of type {dtype}'")
+            if extra_columns[name].dtype != dtype:
+                raise ValueError(f"Invalid type '{dtype}' for extra column '{name}'")
+        for name in extra_columns.columns:
+            if name not in self.extra_columns.columns:
+                raise ValueError(f"Provided extra column '{name}' not found in definition")
+            column = extra_columns[name]
+            column.index = dataframe.index
+            dataframe[name] = column
+
+    @property
+    def chunk_config_cache(self):
+        """The chunk configuration cache of this process (see `process_chunk_config_cache`)."""
+        return process_chunk_config_cache(self.chunk_config_cache_size)
+
+    def cache_info(self):
+        """Hit and miss statistics of the chunk configuration cache in this process."""
+        return self.chunk_config_cache.cache_info()
 
     def _make_chunk_queue(self, completed_chunks):
         return []
 
     def _initialise_chunk(self):
-        self.a_astro = self.left_partition.iloc[:, self.a_pos_and_err_indices].to_numpy(dtype=np.float64)
-        self.a_photo = self.left_partition.iloc[:, self.a_mag_indices].to_numpy(dtype=np.float64)
-        self.a_magref = self.left_partition.iloc[:, self.a_best_mag_index_col].to_numpy(dtype=np.int64)
-        self.a_in_overlaps = self.left_partition.iloc[:, self.a_chunk_overlap_col].to_numpy().astype(bool)
-        self.b_astro = self.right_partition.iloc[:, self.b_pos_and_err_indices].to_numpy(dtype=np.float64)
-        self.b_photo = self.right_partition.iloc[:, self.b_mag_indices].to_numpy(dtype=np.float64)
-        self.b_magref = self.right_partition.iloc[:, self.b_best_mag_index_col].to_numpy(dtype=np.int64)
-        self.b_in_overlaps = self.right_partition.iloc[:, self.b_chunk_overlap_col].to_numpy().astype(bool)
+        self.a_astro = columns_to_numpy(self.left_partition, self.a_pos_and_err_indices, np.float64)
+        self.a_photo = columns_to_numpy(self.left_partition, self.a_mag_indices, np.float64)
+        self.a_magref = column_to_numpy(self.left_partition.iloc[:, self.a_best_mag_index_col], np.int64)
+        self.a_in_overlaps = column_to_numpy(
+            self.left_partition.iloc[:, self.a_chunk_overlap_col], bool, na_value=False
+        )
+        self.b_astro = columns_to_numpy(self.right_partition, self.b_pos_and_err_indices, np.float64)
+        self.b_photo = columns_to_numpy(self.right_partition, self.b_mag_indices, np.float64)
+        self.b_magref = column_to_numpy(self.right_partition.iloc[:, self.b_best_mag_index_col], np.int64)
+        self.b_in_overlaps = column_to_numpy(
+            self.right_partition.iloc[:, self.b_chunk_overlap_col], bool, na_value=False
+        )
+        if self.cat_a_params_dict["correct_astrometry"]:
+            self.a_astro[:, 2] = self.cat_a_astrometric_corrections.correct_uncertainties(
+                self.a_astro[:, 0], self.a_astro[:, 1], self.a_astro[:, 2]
+            )
+        if self.cat_b_params_dict["correct_astrometry"]:
+            self.b_astro[:, 2] = self.cat_b_astrometric_corrections.correct_uncertainties(
+                self.b_astro[:, 0], self.b_astro[:, 1], self.b_astro[:, 2]
+            )
+        if self.a_halo is not None:
+            self.a_in_overlaps = self.a_in_overlaps | self.a_halo
+        if self.b_halo is not None:
+            self.b_in_overlaps = self.b_in_overlaps | self.b_halo
+        self._share_chunk_arrays()
         self.make_shared_data()
 
+    def _share_chunk_arrays(self):
+        """Back the astrometry and photometry of the chunk with files in ``shared_array_dir``.
+
+        The files are keyed by the content of the arrays, so the chunks of the node that
+        read the same partition map the same pages. The chunk that wrote them removes
+        them in `_remove_shared_chunk_arrays`.
+        """
+        self.shared_chunk_keys = []
+        if self.shared_array_dir is None:
+            return
+        for catalog in ["a", "b"]:
+            arrays = {name: getattr(self, f"{catalog}_{name}") for name in ["astro", "photo"]}
+            key = arrays_key(arrays)
+            arrays, wrote = self.shared_data_store.share_arrays(key, arrays)
+            if wrote:
+                self.shared_chunk_keys.append(key)
+            for name, array in arrays.items():
+                setattr(self, f"{catalog}_{name}", array)
+
+    def _remove_shared_chunk_arrays(self):
+        """Remove the files that `_share_chunk_arrays` wrote for this chunk."""
+        for key in vars(self).get("shared_chunk_keys", []):
+            self.shared_data_store.remove(key)
+
+    @property
+    def shared_data_store(self):
+        """The shared data store of this process (see `process_shared_data_store`)."""
+        return process_shared_data_store(self.shared_array_dir)
+
+    def make_shared_data(self, *args, **kwargs):
+        """Set the data shared by the stages of a chunk, made once per set of parameters.
+
+        macauff derives it from the parameters alone, so the attributes that its
+        ``make_shared_data`` sets are kept in the ``shared_data_store``, keyed like
+        the chunk configuration, and every chunk with the same parameters gets the
+        same read-only arrays.
+        """
+        vars(self).update(
+            self.shared_data_store.get_or_make(
+                self.chunk_config_key, lambda: self._make_own_shared_data(*args, **kwargs)
+            )
+        )
+
+    def _make_own_shared_data(self, *args, **kwargs):
+        """Run macauff's ``make_shared_data``, and return the attributes it set."""
+        before = dict(vars(self))
+        super().make_shared_data(*args, **kwargs)
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if name not in before or before[name] is not value
+        }
+
+    def create_perturb_auf(self, *args, **kwargs):
+        """Create the perturbation AUF component, reading its grids from ``auf_cache``.
+
+        The chunk uses the cache regions that cover its aligned pixel, one AUF pointing
+        per region. The grids are assembled once per set of regions, and shared by the
+        chunks of the node through the ``shared_data_store``. Without perturbations,
+        macauff's own (trivial) AUF component is used. A sub-chunk uses the component
+        of its whole pair instead (see `_run_sub_chunks`).
+        """
+        if self._use_pair_stage_data("create_perturb_auf"):
+            return
+        if not self.crossmatch_params_dict["include_perturb_auf"]:
+            super().create_perturb_auf(*args, **kwargs)
+            return
+        regions = self.auf_cache.regions_for(self.aligned_pix)
+        for catalog in ["a", "b"]:
+            filt_names = getattr(self, f"cat_{catalog}_params_dict")["filt_names"]
+            modelrefinds = perturb_auf_indices(
+                self.auf_cache,
+                regions,
+                catalog,
+                filt_names,
+                getattr(self, f"{catalog}_astro"),
+                getattr(self, f"{catalog}_photo"),
+                getattr(self, f"{catalog}_magref"),
+                float(getattr(self, f"cat_{catalog}_params_dict")["dens_dist"]),
+            )
+            perturb_auf_outputs = self.shared_data_store.get_or_make(
+                self.auf_cache.grids_key(regions, catalog, filt_names),
+                lambda catalog=catalog, filt_names=filt_names: perturb_auf_grids(
+                    self.auf_cache, regions, catalog, filt_names
+                ),
+            )
+            setattr(self, f"{catalog}_modelrefinds", modelrefinds)
+            setattr(self, f"{catalog}_perturb_auf_outputs", dict(perturb_auf_outputs))
+
+    def calculate_phot_like(self, *args, **kwargs):
+        """Calculate the counterpart fractions and photometric likelihoods of the chunk.
+
+        A sub-chunk uses those of its whole pair instead (see `_run_sub_chunks`).
+        """
+        if not self._use_pair_stage_data("calculate_phot_like"):
+            super().calculate_phot_like(*args, **kwargs)
+
+    def _use_pair_stage_data(self, stage):
+        """Set the attributes that ``stage`` set for the whole pair, if this is a sub-chunk."""
+        pair_stage_data = vars(self).get("pair_stage_data")
+        if pair_stage_data is None:
+            return False
+        vars(self).update(pair_stage_data[stage])
+        return True
+
+    def simulate_perturb_auf(self, *args, **kwargs):
+        """Create the perturbation AUF component with macauff's own simulation.
+
+        This is what fills the ``auf_cache``, see `MacauffAufSimulator`.
+        """
+        super().create_perturb_auf(*args, **kwargs)
+
     def set_chunk_from_healpix(self, aligned_pix):
         """Set the chunk parameters based on the healpix pixels."""
+        self.aligned_pix = aligned_pix
         self.chunk_id = MacauffCrossmatch.CHUNK_ID
         healpix_center = healpix_to_skycoord(aligned_pix.pixel, aligned_pix.order)[0]
-        self.cat_a_params_dict["chunk_id_list"] = np.array([self.chunk_id])
-        self.cat_a_params_dict["auf_region_points_per_chunk"] = np.array(
-            [
-                [
-                    healpix_center.ra.deg,
-                    healpix_center.ra.deg,
-                    1.0,
-                    healpix_center.dec.deg,
-                    healpix_center.dec.deg,
-                    1.0,
-                ]
-            ]
-        )
-        self.cat_b_params_dict["chunk_id_list"] = np.array([self.chunk_id])
-        self.cat_b_params_dict["auf_region_points_per_chunk"] = np.array(
-            [
-                [
-                    healpix_center.ra.deg,
-                    healpix_center.ra.deg,
-                    1.0,
-                    healpix_center.dec.deg,
-                    healpix_center.dec.deg,
-                    1.0,
-                ]
-            ]
-        )
-        self.crossmatch_params_dict["chunk_id_list"] = np.array([self.chunk_id])
-        self.crossmatch_params_dict["cf_region_points_per_chunk"] = np.array(
+        region_points = [
             [
-                [
-                    healpix_center.ra.deg,
-                    healpix_center.ra.deg,
-                    1.0,
-                    healpix_center.dec.deg,
-                    healpix_center.dec.deg,
-                    1.0,
-                ]
+                healpix_center.ra.deg,
+                healpix_center.ra.deg,
+                1.0,
+                healpix_center.dec.deg,
+                healpix_center.dec.deg,
+                1.0,
             ]
-        )
+        ]
+        for params_dict, key in [
+            (self.cat_a_params_dict, "auf_region_points_per_chunk"),
+            (self.cat_b_params_dict, "auf_region_points_per_chunk"),
+            (self.crossmatch_params_dict, "cf_region_points_per_chunk"),
+        ]:
+            params_dict["chunk_id_list"] = np.array([self.chunk_id])
+            params_dict[key] = np.array(region_points)
+
+    def _set_region_points(self):
+        """Set the AUF and counterpart fraction region points of the aligned pixel.
+
+        These are the points macauff derives from the single-point rectangles that
+        `set_chunk_from_healpix` sets, i.e. the center of the aligned pixel.
+        """
+        for name, params_dict, key in [
+            ("a_auf_region_points", self.cat_a_params_dict, "auf_region_points_per_chunk"),
+            ("b_auf_region_points", self.cat_b_params_dict, "auf_region_points_per_chunk"),
+            ("cf_region_points", self.crossmatch_params_dict, "cf_region_points_per_chunk"),
+        ]:
+            rectangle = params_dict[key][0]
+            setattr(self, name, np.array([[rectangle[0], rectangle[3]]]))
 
     def _load_metadata_config(self, chunk_id):
         self._load_metadata_config_params(chunk_id)
@@ -181,12 +945,12 @@ class MacauffCrossmatch(AbstractCrossmatchAlgorithm, CrossMatch):
         chunk is being matched (i.e., there is no compartmentalisation of a
         larger region), then ``in_chunk_overlap`` should all be set to ``False``.
         """
-        if self.include_phot_like and self.with_and_without_photometry:
-            # loop_array_extensions = ['', '_without_photometry']
-            loop_array_extensions = [""]
+        if self.include_phot_like and self.with_and_without_photometry and self.include_without_photometry:
+            loop_array_extensions = ["", WITHOUT_PHOTOMETRY_SUFFIX]
         else:
             loop_array_extensions = [""]
 
+        self.chunk_results = {}
         for file_extension in loop_array_extensions:
             self.ac = getattr(self, f"ac{file_extension}")
             self.bc = getattr(self, f"bc{file_extension}")
@@ -198,3 +962,28 @@ class MacauffCrossmatch(AbstractCrossmatchAlgorithm, CrossMatch):
             self.acontprob = getattr(self, f"pacontam{file_extension}")
             self.bcontprob = getattr(self, f"pbcontam{file_extension}")
             self.seps = getattr(self, f"crptseps{file_extension}")
+
+            # A match is kept if either of its sources is in the core. Sub-chunks flag their
+            # halos in the overlap arrays (see `_initialise_chunk`).
+            core_matches = ~self.a_in_overlaps[self.ac] | ~self.b_in_overlaps[self.bc]
+            for name in ["ac", "bc", "p", "eta", "xi", "a_avg_cont", "b_avg_cont", "seps"]:
+                setattr(self, name, getattr(self, name)[core_matches])
+            self.acontprob = self.acontprob[:, core_matches]
+            self.bcontprob = self.bcontprob[:, core_matches]
+
+            self.chunk_results[file_extension] = (
+                self.ac,
+                self.bc,
+                {
+                    "p": self.p,
+                    "eta": self.eta,
+                    "xi": self.xi,
+                    "a_avg_cont": self.a_avg_cont,
+                    "b_avg_cont": self.b_avg_cont,
+                    "a_cont_f1": self.acontprob[0],
+                    "a_cont_f10": self.acontprob[1],
+                    "b_cont_f1": self.bcontprob[0],
+                    "b_cont_f10": self.bcontprob[1],
+                    "sep": self.seps,
+                },
+            )
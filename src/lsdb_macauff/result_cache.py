@@ -0,0 +1,242 @@
+"""Persistent cache of the crossmatch results of partition pairs, keyed by content.
+
+Re-running a crossmatch after a few pixels of the inputs changed should only
+match those pixels again. The result of each partition pair is saved under a
+hash of the two partitions and of everything that configures the match, so a
+pair whose inputs and parameters are unchanged is read back instead of matched.
+Files, such as the partitions of catalogs on disk and the inputs named in the
+parameter files, are identified by their path, size and modification time rather
+than read.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from hats import read_hats
+from hats.catalog import CatalogCollection
+from hats.io import paths
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+LEFT_INDEX_COLUMN = "_left_index"
+"""Column of a cached result holding the positions of the matched left rows."""
+
+RIGHT_INDEX_COLUMN = "_right_index"
+"""Column of a cached result holding the positions of the matched right rows."""
+
+REFERENCED_FILE_SUFFIXES = ("_path", "_location")
+"""Suffixes of the keys of macauff parameters whose values may name input files."""
+
+
+def frame_hash(frame: pd.DataFrame) -> str:
+    """Hash of the column names, index and values of a frame."""
+    digest = hashlib.sha256()
+    digest.update("\0".join(str(column) for column in frame.columns).encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def file_stamp(path) -> str:
+    """Cheap identifier of the content of a file: its path, size and modification time.
+
+    A directory, such as a partition written as several files, is identified by the
+    stamps of its files. Missing files have a stamp of their own, so a file that
+    appears changes it.
+
+    Args:
+        path (str | Path | UPath): the file.
+    """
+    path = Path(path) if isinstance(path, str) else path
+    if not path.exists():
+        return f"{path}:missing"
+    if path.is_dir():
+        return ";".join(file_stamp(child) for child in sorted(path.iterdir()))
+    stat = path.stat()
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def referenced_files(params_dict, base_dir) -> list[Path]:
+    """The existing files that the values of a macauff parameter dictionary name.
+
+    Values of the keys that end in one of `REFERENCED_FILE_SUFFIXES` are taken as
+    paths, relative to the working directory or else to ``base_dir``, the directory
+    of the parameter file. Directories are left out, since macauff also writes its
+    outputs to some of them.
+
+    Returns:
+        The files, in the order of the keys.
+    """
+    files = []
+    for key in sorted(params_dict):
+        if not key.endswith(REFERENCED_FILE_SUFFIXES):
+            continue
+        values = params_dict[key] if isinstance(params_dict[key], (list, tuple)) else [params_dict[key]]
+        for value in values:
+            if not isinstance(value, (str, Path)):
+                continue
+            for path in [Path(value), Path(base_dir) / value]:
+                if path.is_file():
+                    files.append(path)
+                    break
+    return files
+
+
+def params_hash(*parts) -> str:
+    """Hash of the parameters of a crossmatch.
+
+    Args:
+        *parts: the parameters. Paths are hashed by the content of their file, numpy
+            arrays by their values, and anything else by its ``repr``.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, Path):
+            digest.update(part.read_bytes())
+        elif isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Directory of the results of partition pairs, one parquet file per pair.
+
+    Results are keyed by `result_key`, laid out as::
+
+        cache_dir/{key[:2]}/{key}.parquet
+
+    Nothing is ever evicted: entries of inputs that changed are simply not read
+    again, and the directory can be deleted at any time to reclaim the space.
+
+    Partitions of the catalogs given here are identified by the `file_stamp` of
+    their files, and by their columns and index, which catch the rows and columns
+    that lsdb filtered out. Partitions of other catalogs are hashed whole, with
+    `frame_hash`.
+
+    Args:
+        cache_dir (str | Path): root directory of the cache, reachable from all workers.
+        left_catalog_dir (str | Path | None): the left HATS catalog, if read from disk.
+        right_catalog_dir (str | Path | None): the right HATS catalog, if read from disk.
+        right_margin_dir (str | Path | None): the margin catalog of the right catalog.
+    """
+
+    def __init__(self, cache_dir, left_catalog_dir=None, right_catalog_dir=None, right_margin_dir=None):
+        self.cache_dir = Path(cache_dir)
+        self.left_catalog = _CatalogFiles.of(left_catalog_dir)
+        self.right_catalog = _CatalogFiles.of(right_catalog_dir)
+        self.right_margin = _CatalogFiles.of(right_margin_dir)
+
+    def result_key(self, crossmatch_args, crossmatch_params_hash) -> str:
+        """Key of the result of a partition pair.
+
+        Args:
+            crossmatch_args (CrossmatchArgs): the partitions and respective pixel
+                information of the pair.
+            crossmatch_params_hash (str): hash of the parameters of the crossmatch,
+                see `params_hash`.
+        """
+        left_pixel = HealpixPixel(crossmatch_args.left_order, crossmatch_args.left_pixel)
+        right_pixel = HealpixPixel(crossmatch_args.right_order, crossmatch_args.right_pixel)
+        if self.left_catalog is None:
+            left_id = frame_hash(crossmatch_args.left_df)
+        else:
+            left_id = _partition_id(crossmatch_args.left_df, [self.left_catalog.stamp(left_pixel)])
+        if self.right_catalog is None:
+            right_id = frame_hash(crossmatch_args.right_df)
+        else:
+            right_stamps = [self.right_catalog.stamp(right_pixel)]
+            if self.right_margin is not None:
+                right_stamps.append(self.right_margin.stamp(right_pixel))
+            right_id = _partition_id(crossmatch_args.right_df, right_stamps)
+        return params_hash(
+            crossmatch_args.left_order,
+            crossmatch_args.left_pixel,
+            crossmatch_args.right_order,
+            crossmatch_args.right_pixel,
+            left_id,
+            right_id,
+            crossmatch_params_hash,
+        )
+
+    def entry_path(self, key: str) -> Path:
+        """File of the result with ``key``."""
+        return self.cache_dir / key[:2] / f"{key}.parquet"
+
+    def contains(self, key: str) -> bool:
+        """Whether the result with ``key`` is saved."""
+        return self.entry_path(key).exists()
+
+    def read(
+        self, key: str, extra_columns: pd.DataFrame
+    ) -> tuple[np.ndarray, np.ndarray, pd.DataFrame] | None:
+        """The saved result with ``key``, or None if there is none.
+
+        Args:
+            key (str): the key of the result.
+            extra_columns (pd.DataFrame): the empty frame of the extra columns of the
+                algorithm, whose columns are read back.
+
+        Returns:
+            The left indices, right indices and extra columns of the result.
+        """
+        path = self.entry_path(key)
+        if not path.exists():
+            return None
+        table = pq.read_table(path, columns=[LEFT_INDEX_COLUMN, RIGHT_INDEX_COLUMN, *extra_columns.columns])
+        values = table.select(list(extra_columns.columns)).to_pandas(types_mapper=pd.ArrowDtype)
+        return table[LEFT_INDEX_COLUMN].to_numpy(), table[RIGHT_INDEX_COLUMN].to_numpy(), values
+
+    def write(self, key: str, result: tuple[np.ndarray, np.ndarray, pd.DataFrame]):
+        """Save the result of a partition pair under ``key``."""
+        left_indices, right_indices, values = result
+        table = pa.Table.from_pandas(values.reset_index(drop=True), preserve_index=False)
+        table = table.add_column(0, RIGHT_INDEX_COLUMN, pa.array(np.asarray(right_indices, dtype=np.int64)))
+        table = table.add_column(0, LEFT_INDEX_COLUMN, pa.array(np.asarray(left_indices, dtype=np.int64)))
+        path = self.entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        ## Write to a temporary file first, so that a partial write is never read back.
+        temp_path = path.parent / f"{key}.{uuid.uuid4().hex}.tmp"
+        pq.write_table(table, temp_path)
+        temp_path.replace(path)
+
+
+class _CatalogFiles:  # pylint: disable=too-few-public-methods
+    """The partition files of a HATS catalog on disk."""
+
+    def __init__(self, catalog_dir, npix_suffix):
+        self.catalog_dir = catalog_dir
+        self.npix_suffix = npix_suffix
+
+    @classmethod
+    def of(cls, catalog_dir):
+        """The files of the catalog, or of the main catalog of the collection, in ``catalog_dir``.
+
+        Returns None if ``catalog_dir`` is None.
+        """
+        if catalog_dir is None:
+            return None
+        catalog = read_hats(catalog_dir)
+        if isinstance(catalog, CatalogCollection):
+            catalog = catalog.main_catalog
+        return cls(catalog.catalog_path, catalog.catalog_info.npix_suffix)
+
+    def stamp(self, pixel) -> str:
+        """The `file_stamp` of the partition of ``pixel``."""
+        return file_stamp(paths.pixel_catalog_file(self.catalog_dir, pixel, npix_suffix=self.npix_suffix))
+
+
+def _partition_id(frame, stamps) -> str:
+    """Identifier of a partition read from the files with ``stamps``, and maybe filtered since."""
+    return params_hash(
+        *stamps,
+        [str(column) for column in frame.columns],
+        pd.util.hash_pandas_object(frame.index).to_numpy(),
+    )
@@ -0,0 +1,505 @@
+"""Cost-aware scheduling of the partition pairs of a crossmatch.
+
+When the left and right catalogs differ greatly in density, a few partition pairs
+take most of the runtime and memory of a crossmatch. The cost of each pair is
+predicted from the row counts of its partitions, and `pair_cost_annotations`
+annotates the tasks of lsdb's own crossmatch graph so that dask starts the
+heaviest pairs first, and claims their predicted memory as a worker resource so
+that a worker never takes on more pairs than it can hold.
+
+At the other end, the many sparse pairs of a crossmatch are dominated by the
+fixed cost of a macauff chunk, and `batch_sparse_pairs` routes them through the
+batch path of the algorithm.
+"""
+
+from __future__ import annotations
+
+import operator
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from dask._task_spec import Task, TaskRef
+from dask.base import tokenize
+from hats.io import file_io, paths
+from hats.pixel_math.healpix_pixel import INVALID_PIXEL, HealpixPixel
+from lsdb.core.crossmatch.crossmatch_args import CrossmatchArgs
+from lsdb.operations.functions.crossmatch_catalog_data import perform_crossmatch
+from lsdb.operations.lsdb_ops import AlignAndApply
+from lsdb.operations.operation import HealpixGraph, Operation
+
+from lsdb_macauff.batching import group_sparse_pixels
+from lsdb_macauff.instrumentation import NESTED_STAGES, load_instrumentation
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+MEMORY_RESOURCE = "MEMORY"
+"""Default name of the worker resource that holds the memory of the pairs, in bytes.
+Workers must advertise it, e.g. with ``dask worker --resources MEMORY=16e9``."""
+
+DEFAULT_TIME_COEFFICIENTS = (np.log(1e-4), 0.5, 0.5)
+"""Cost model of the wall time, in seconds, when there is no instrumentation to fit."""
+
+DEFAULT_MEMORY_COEFFICIENTS = (np.log(4e3), 0.5, 0.5)
+"""Cost model of the peak memory, in bytes, when there is no instrumentation to fit."""
+
+
+class PairCostModel:
+    """Predicts the wall time and peak memory of a partition pair from its row counts.
+
+    Both are modelled as power laws of the number of left and right rows,
+
+        cost = exp(c0) * (left_rows + 1)^c1 * (right_rows + 1)^c2
+
+    Args:
+        time_coefficients (tuple[float, float, float]): (c0, c1, c2) of the wall
+            time, in seconds.
+        memory_coefficients (tuple[float, float, float]): (c0, c1, c2) of the peak
+            memory, in bytes.
+    """
+
+    def __init__(
+        self,
+        time_coefficients=DEFAULT_TIME_COEFFICIENTS,
+        memory_coefficients=DEFAULT_MEMORY_COEFFICIENTS,
+    ):
+        self.time_coefficients = tuple(float(c) for c in time_coefficients)
+        self.memory_coefficients = tuple(float(c) for c in memory_coefficients)
+
+    @classmethod
+    def fit(cls, records: pd.DataFrame, min_chunks=3) -> PairCostModel:
+        """Fit the model to the instrumentation records of earlier runs.
+
+        The wall time of a chunk is the sum of its outermost stages, and its peak
+        memory the largest peak of any of its stages.
+
+        Args:
+            records (pd.DataFrame): records as returned by `load_instrumentation`.
+            min_chunks (int): the fewest chunks to fit to. With fewer, the default
+                coefficients are kept.
+
+        Returns:
+            The fitted `PairCostModel`.
+        """
+        ## Chunks with a stage that has no peak memory are left out altogether.
+        overlapped = records.loc[records["peak_memory"].isna(), "chunk"].unique()
+        records = records[~records["stage"].isin(NESTED_STAGES) & ~records["chunk"].isin(overlapped)]
+        chunks = records.groupby("chunk").agg(
+            left_rows=("left_rows", "first"),
+            right_rows=("right_rows", "first"),
+            wall_time=("wall_time", "sum"),
+            peak_memory=("peak_memory", "max"),
+        )
+        chunks = chunks[(chunks["wall_time"] > 0) & (chunks["peak_memory"] > 0)]
+        if len(chunks) < min_chunks:
+            return cls()
+        design = np.stack(
+            [
+                np.ones(len(chunks)),
+                np.log1p(chunks["left_rows"].to_numpy(dtype=np.float64)),
+                np.log1p(chunks["right_rows"].to_numpy(dtype=np.float64)),
+            ],
+            axis=1,
+        )
+        time_coefficients = np.linalg.lstsq(
+            design, np.log(chunks["wall_time"].to_numpy(dtype=np.float64)), rcond=None
+        )[0]
+        memory_coefficients = np.linalg.lstsq(
+            design, np.log(chunks["peak_memory"].to_numpy(dtype=np.float64)), rcond=None
+        )[0]
+        return cls(time_coefficients, memory_coefficients)
+
+    @classmethod
+    def from_instrumentation(cls, instrumentation_dir=None) -> PairCostModel:
+        """Fit the model to an ``instrumentation_dir``, or use the defaults if it holds no records."""
+        if instrumentation_dir is None or not any(Path(instrumentation_dir).glob("*.parquet")):
+            return cls()
+        return cls.fit(load_instrumentation(instrumentation_dir))
+
+    def predict(self, left_rows, right_rows) -> tuple[np.ndarray, np.ndarray]:
+        """Predicted wall time, in seconds, and peak memory, in bytes, of pairs.
+
+        Args:
+            left_rows (np.ndarray): number of left rows of each pair.
+            right_rows (np.ndarray): number of right rows of each pair.
+
+        Returns:
+            Tuple of the wall times and the peak memories of the pairs.
+        """
+        log_left = np.log1p(np.asarray(left_rows, dtype=np.float64))
+        log_right = np.log1p(np.asarray(right_rows, dtype=np.float64))
+
+        def power_law(coefficients):
+            return np.exp(coefficients[0] + coefficients[1] * log_left + coefficients[2] * log_right)
+
+        return power_law(self.time_coefficients), power_law(self.memory_coefficients)
+
+
+def partition_row_counts(catalog_base_dir) -> dict[HealpixPixel, int]:
+    """Number of rows of each partition of a HATS catalog, from its ``_metadata`` file.
+
+    Catalogs without a ``_metadata`` file, such as empty margin catalogs, have no rows.
+    """
+    metadata_path = paths.get_parquet_metadata_pointer(catalog_base_dir)
+    if not metadata_path.exists():
+        return {}
+    metadata = file_io.read_parquet_metadata(metadata_path)
+    row_counts = {}
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        pixel = paths.get_healpix_from_path(row_group.column(0).file_path)
+        if pixel != INVALID_PIXEL:
+            row_counts[pixel] = row_counts.get(pixel, 0) + row_group.num_rows
+    return row_counts
+
+
+def _rows_in_aligned_pixels(
+    left_pixels, right_pixels, aligned_pixels, left_counts, right_counts, margin_counts
+) -> tuple[np.ndarray, np.ndarray]:
+    """Estimated left rows, and right rows with their margin, of pairs within their aligned pixels.
+
+    Partitions larger than the aligned pixel contribute in proportion to its area.
+    """
+
+    def rows_in_aligned(counts, pixel, aligned):
+        if pixel is None:
+            return 0
+        return counts.get(pixel, 0) / 4 ** (aligned.order - pixel.order)
+
+    left_rows = np.array(
+        [rows_in_aligned(left_counts, left, aligned) for left, aligned in zip(left_pixels, aligned_pixels)],
+        dtype=np.float64,
+    )
+    right_rows = np.array(
+        [
+            rows_in_aligned(right_counts, right, aligned) + rows_in_aligned(margin_counts, right, aligned)
+            for right, aligned in zip(right_pixels, aligned_pixels)
+        ],
+        dtype=np.float64,
+    )
+    return left_rows, right_rows
+
+
+def crossmatch_operation(catalog) -> AlignAndApply:
+    """The lsdb operation that matches the partition pairs of a ``Catalog.crossmatch`` result.
+
+    Raises:
+        ValueError: if ``catalog`` is not the direct result of ``Catalog.crossmatch``.
+    """
+    operation = catalog._operation  # pylint: disable=protected-access
+    if isinstance(operation, SparsePairBatches):
+        operation = operation.crossmatch_operation
+    if not isinstance(operation, AlignAndApply) or operation.func is not perform_crossmatch:
+        raise ValueError("The catalog must be the result of Catalog.crossmatch")
+    return operation
+
+
+def crossmatch_pair_rows(operation) -> tuple[np.ndarray, np.ndarray]:
+    """Estimated left and right rows of each partition pair of a crossmatch operation.
+
+    The rows are read from the ``_metadata`` files of the catalogs, and right rows
+    include those of the margin. Partitions larger than the aligned pixel of a pair
+    contribute in proportion to its area.
+
+    Args:
+        operation (AlignAndApply): the operation, see `crossmatch_operation`.
+
+    Returns:
+        Tuple of the left and right rows of each output partition of ``operation``.
+
+    Raises:
+        ValueError: if the left or right catalog was not read from disk.
+    """
+    left_catalog, right_catalog, margin_catalog = operation.input_cats[:3]
+    left_pixels, right_pixels = operation.pixel_lists[:2]
+    return _rows_in_aligned_pixels(
+        left_pixels,
+        right_pixels,
+        operation.output_pixels,
+        _catalog_row_counts(left_catalog),
+        _catalog_row_counts(right_catalog),
+        _catalog_row_counts(margin_catalog),
+    )
+
+
+def _catalog_row_counts(catalog) -> dict[HealpixPixel, int]:
+    if catalog is None:
+        return {}
+    if catalog.hc_structure.catalog_path is None:
+        raise ValueError("The row counts of the pairs are only known for catalogs read from disk")
+    return partition_row_counts(catalog.hc_structure.catalog_path)
+
+
+def pair_cost_annotations(catalog, client=None, cost_model=None, memory_resource=MEMORY_RESOURCE) -> dict:
+    """Dask annotations that schedule the partition pairs of an lsdb crossmatch by their predicted cost.
+
+    The annotations apply to the tasks of the graph that lsdb builds for ``catalog``,
+    e.g. the result of ``catalog.crossmatch(..., algorithm=MacauffCrossmatch)``,
+    with or without `batch_sparse_pairs`. The tasks that match pairs are given
+    decreasing priorities in order of their predicted wall time, so the heavy
+    pairs start first and the light ones fill the gaps at the end, and the tasks
+    that read their partitions inherit the priority of the pairs that need them.
+    With a ``client``, each matching task also claims its predicted peak memory
+    from the ``memory_resource`` of its worker. A pair that is predicted to need
+    more than any worker has claims the largest worker whole, so that it still
+    runs, alone. A batch of sparse pairs claims the memory of all its pairs.
+
+    Use them around the computation of the catalog::
+
+        with dask.annotate(**pair_cost_annotations(xmatch, client)):
+            result = xmatch.compute()
+
+    Args:
+        catalog (lsdb.Catalog): the result of ``Catalog.crossmatch``.
+        client (dask.distributed.Client | None): the client of the cluster. If None,
+            the tasks only get priorities.
+        cost_model (PairCostModel | None): the model of the pair costs. Defaults to
+            the model fitted to the ``instrumentation_dir`` of the algorithm, if it
+            has one, or to `PairCostModel()`.
+        memory_resource (str | None): the worker resource of the memory, in bytes.
+            If None, the tasks only get priorities.
+
+    Returns:
+        dict of the ``priority``, and ``resources``, annotations, as functions of
+        the task keys.
+
+    Raises:
+        ValueError: if ``catalog`` is not the result of ``Catalog.crossmatch``, or
+            if no worker of the cluster advertises ``memory_resource``.
+    """
+    operation = crossmatch_operation(catalog)
+    if cost_model is None:
+        cost_model = PairCostModel.from_instrumentation(
+            getattr(operation.args[0], "instrumentation_dir", None)
+        )
+    max_memory = None
+    if client is not None and memory_resource is not None:
+        worker_memories = [
+            worker["resources"][memory_resource]
+            for worker in client.scheduler_info()["workers"].values()
+            if memory_resource in worker.get("resources", {})
+        ]
+        if len(worker_memories) == 0:
+            raise ValueError(
+                f"No worker has the {memory_resource} resource. Start the workers with "
+                f"`--resources {memory_resource}=<bytes>`, or pass memory_resource=None"
+            )
+        max_memory = max(worker_memories)
+
+    wall_times, peak_memories = cost_model.predict(*crossmatch_pair_rows(operation))
+    built = catalog._operation.build()  # pylint: disable=protected-access
+    graph = built.graph
+    work_costs = {}
+    for pixel, wall_time, peak_memory in zip(operation.output_pixels, wall_times, peak_memories):
+        if pixel not in built.pixel_to_key_map:
+            continue
+        work_key = _matching_task_key(graph, built.pixel_to_key_map[pixel])
+        time_sum, memory_sum = work_costs.get(work_key, (0.0, 0.0))
+        work_costs[work_key] = (time_sum + wall_time, memory_sum + peak_memory)
+
+    work_keys = sorted(work_costs, key=lambda key: work_costs[key][0], reverse=True)
+    priorities = {}
+    for rank, work_key in enumerate(work_keys):
+        priority = len(work_keys) - rank
+        pending = [work_key]
+        while pending:
+            key = pending.pop()
+            if priorities.get(key, 0) < priority:
+                priorities[key] = priority
+                pending.extend(graph[key].dependencies)
+    for key in built.pixel_to_key_map.values():
+        priorities[key] = max(
+            [priorities.get(key, 0)] + [priorities.get(dep, 0) for dep in graph[key].dependencies]
+        )
+    annotations = {"priority": _KeyAnnotation(priorities, 0)}
+    if max_memory is not None:
+        resources = {
+            key: {memory_resource: min(memory, max_memory)} for key, (_, memory) in work_costs.items()
+        }
+        annotations["resources"] = _KeyAnnotation(resources, {})
+    return annotations
+
+
+def _matching_task_key(graph, key):
+    """The key of the task that matches the pair of output ``key``: the batch task of batched pairs."""
+    dependencies = list(graph[key].dependencies)
+    if len(dependencies) == 1 and getattr(graph[dependencies[0]], "func", None) is _crossmatch_batch:
+        return dependencies[0]
+    return key
+
+
+class _KeyAnnotation:  # pylint: disable=too-few-public-methods
+    """A task annotation looked up by key, which the dask scheduler calls for every task of a graph."""
+
+    def __init__(self, values, default):
+        self.values = values
+        self.default = default
+
+    def __call__(self, key):
+        return self.values.get(key, self.default)
+
+
+def batch_sparse_pairs(catalog, max_rows=None, depth=None):
+    """Route the sparse partition pairs of an lsdb crossmatch through the batch path of its algorithm.
+
+    Neighbouring pairs with few rows (estimated from the ``_metadata`` files) are
+    grouped as in `group_sparse_pairs`, and each group is matched by a single task,
+    which calls the ``crossmatch_batch`` method of the algorithm (see
+    `MacauffCrossmatch.crossmatch_batch`). The other pairs are left as they are.
+    The partitions of the result are those of ``catalog``.
+
+    Args:
+        catalog (lsdb.Catalog): the result of ``Catalog.crossmatch``, with an algorithm
+            that has a ``crossmatch_batch`` method.
+        max_rows (int | None): the maximum number of rows of a group. Defaults to the
+            ``sparse_batch_rows`` of the algorithm.
+        depth (int | None): how many orders up the common ancestor of a group is.
+            Defaults to the ``sparse_batch_depth`` of the algorithm.
+
+    Returns:
+        lsdb.Catalog with the same partitions as ``catalog``.
+    """
+    operation = crossmatch_operation(catalog)
+    algorithm = operation.args[0]
+    max_rows = algorithm.sparse_batch_rows if max_rows is None else max_rows
+    depth = algorithm.sparse_batch_depth if depth is None else depth
+    left_rows, right_rows = crossmatch_pair_rows(operation)
+    batches = [
+        positions
+        for ancestor, positions in group_sparse_pixels(
+            operation.output_pixels, left_rows + right_rows, max_rows, depth
+        )
+        if ancestor is not None and len(positions) > 1
+    ]
+    return catalog.__class__(SparsePairBatches(operation, batches), catalog.hc_structure)
+
+
+class SparsePairBatches(Operation):
+    """A crossmatch operation whose sparse partition pairs are matched in batches.
+
+    The tasks of the pairs of each batch are replaced by a single task, which calls
+    the ``crossmatch_batch`` method of the algorithm with all of them, and by a task
+    per pair that picks its partition out of the result.
+
+    Args:
+        operation (AlignAndApply): the operation of the crossmatch.
+        batches (list[list[int]]): the positions, in the output partitions of the
+            crossmatch, of the pairs of each batch.
+    """
+
+    def __init__(self, operation, batches):
+        self.crossmatch_operation = operation
+        self.batches = [list(batch) for batch in batches]
+
+    @property
+    def name(self) -> str:
+        return f"SparsePairBatches({self.crossmatch_operation.name})"
+
+    @property
+    def key_name(self) -> str:
+        return f"sparse-pair-batches-{tokenize(self.crossmatch_operation.key_name, self.batches)}"
+
+    @property
+    def meta(self):
+        return self.crossmatch_operation.meta
+
+    @property
+    def dependencies(self) -> list[Operation]:
+        return self.crossmatch_operation.dependencies
+
+    @property
+    def healpix_pixels(self) -> list[HealpixPixel]:
+        return self.crossmatch_operation.healpix_pixels
+
+    def build(self, pixels=None) -> HealpixGraph:
+        built = self.crossmatch_operation.build(pixels)
+        graph = dict(built.graph)
+        pixel_to_key_map = dict(built.pixel_to_key_map)
+        output_pixels = self.crossmatch_operation.output_pixels
+        ## The arguments of lsdb's perform_crossmatch are the partitions, pixels and
+        ## catalog infos of the four inputs, then the arguments of the operation.
+        num_inputs = 3 * len(self.crossmatch_operation.input_cats)
+        for number, batch in enumerate(self.batches):
+            batch = [position for position in batch if output_pixels[position] in pixel_to_key_map]
+            if len(batch) < 2:
+                continue
+            batch_key = (f"{self.key_name}-batch", number)
+            pair_keys = []
+            for position in batch:
+                pair_task = graph.pop(pixel_to_key_map[output_pixels[position]])
+                self._check_pair_task(pair_task, num_inputs)
+                pair_key = (f"{self.key_name}-pair", position)
+                graph[pair_key] = Task(pair_key, _pair_inputs, *pair_task.args[:num_inputs])
+                pair_keys.append(pair_key)
+            graph[batch_key] = Task(
+                batch_key,
+                _crossmatch_batch,
+                *self.crossmatch_operation.args,
+                *[TaskRef(pair_key) for pair_key in pair_keys],
+            )
+            for index, position in enumerate(batch):
+                key = (self.key_name, position)
+                graph[key] = Task(key, operator.getitem, TaskRef(batch_key), index)
+                pixel_to_key_map[output_pixels[position]] = key
+        return HealpixGraph(graph, pixel_to_key_map)
+
+    def _check_pair_task(self, pair_task, num_inputs):
+        """Check that the task of a pair has the argument layout that `build` slices.
+
+        Raises:
+            ValueError: if the crossmatch operation, or the task that lsdb built for the
+                pair, does not have the layout of the lsdb versions this was written for.
+        """
+        num_args = num_inputs + len(self.crossmatch_operation.args)
+        if (
+            self.crossmatch_operation.func is not perform_crossmatch
+            or self.crossmatch_operation.kwargs
+            or len(pair_task.args) != num_args
+        ):
+            raise ValueError(
+                f"The task {pair_task.key} does not call perform_crossmatch with the partitions, pixels "
+                f"and catalog infos of {len(self.crossmatch_operation.input_cats)} inputs followed by "
+                f"{len(self.crossmatch_operation.args)} arguments ({num_args} in all, "
+                f"got {len(pair_task.args)}). This version of lsdb is not supported for batching "
+                "sparse pairs; see the versions of lsdb and dask in pyproject.toml."
+            )
+
+
+def _pair_inputs(*inputs):
+    return inputs
+
+
+class _CrossmatchArgsCollector:  # pylint: disable=too-few-public-methods
+    """Stands in for the algorithm in lsdb's ``perform_crossmatch``, to collect its `CrossmatchArgs`."""
+
+    def __init__(self, extra_columns):
+        self.extra_columns = extra_columns
+
+    def crossmatch(self, crossmatch_args, how, suffixes, suffix_method):  # pylint: disable=unused-argument
+        """Return the arguments of the crossmatch of the pair, unmatched."""
+        return crossmatch_args
+
+
+def _crossmatch_batch(algorithm, how, suffixes, suffix_method, meta_df, *pair_inputs):
+    """Match a batch of partition pairs with the ``crossmatch_batch`` method of the algorithm.
+
+    The partitions of each pair are prepared by lsdb's own ``perform_crossmatch``, so
+    that the left rows are filtered to the aligned pixel and the right margin is added
+    just as for a pair matched alone.
+
+    Returns:
+        list of the crossmatch result of each pair.
+    """
+    collector = _CrossmatchArgsCollector(algorithm.extra_columns)
+    prepared = [
+        perform_crossmatch(*inputs, collector, how, suffixes, suffix_method, meta_df)
+        for inputs in pair_inputs
+    ]
+    positions = [position for position, args in enumerate(prepared) if isinstance(args, CrossmatchArgs)]
+    results = [meta_df] * len(prepared)
+    frames = algorithm.crossmatch_batch(
+        [prepared[position] for position in positions], how, suffixes, suffix_method
+    )
+    for position, frame in zip(positions, frames):
+        results[position] = frame
+    return results
@@ -0,0 +1,206 @@
+"""The read-only arrays of macauff chunks, shared between the chunks of a node.
+
+Three kinds of data are shared:
+
+- the Hankel transform grids that macauff's ``make_shared_data`` derives from the
+  parameters alone, made once per set of parameters;
+- the perturbation AUF grids that a chunk assembles from the ``auf_cache``, made
+  once per set of cache regions, which are the largest arrays of a chunk;
+- with a directory, the astrometry and photometry of each chunk, keyed by their
+  content, so that the pairs of the same partition share them.
+
+The first two are made once per worker process, and shared by all its chunks. With
+a node-local directory, the first process to make the data also writes it there,
+and the other processes of the node memory-map the files, so that they share the
+pages and the kernel can page them out under memory pressure.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import pickle
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+ARRAYS_FILE_SUFFIX = ".npy"
+OTHER_VALUES_FILE = "values.pickle"
+
+
+class SharedDataStore:
+    """Shared data of chunks, keyed by what it is made from (e.g. `chunk_config_key`).
+
+    The arrays handed out are read-only, since every chunk of the process uses them.
+    The store is safe to share between threads: a key that is being made by one
+    thread is waited for by the others. The data of the ``maxsize`` most recently
+    used keys is kept in the process; chunks still using older data keep it alive.
+
+    Args:
+        directory (str | Path | None): node-local directory of the files, ideally on a
+            ``tmpfs`` such as ``/dev/shm``. If None, the data is only shared within
+            the process.
+        maxsize (int): number of keys whose data is kept in the process.
+
+    Attributes:
+        makes (int): number of times the data of a key was made in this process.
+    """
+
+    def __init__(self, directory=None, maxsize=16):
+        self.directory = None if directory is None else Path(directory)
+        self.maxsize = maxsize
+        self.makes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_make(self, key, make) -> dict:
+        """The shared data of ``key``, read from the directory or made with ``make()`` if absent.
+
+        Args:
+            key (str): the key of the parameters the data is made from.
+            make (Callable[[], dict]): makes the data, as a dict of attribute names and values.
+
+        Returns:
+            dict of the attribute names and values, the arrays read-only.
+        """
+        with self._lock:
+            if key not in self._entries:
+                values = self._read(key)
+                if values is None:
+                    values = make()
+                    self.makes += 1
+                    values = self._write(key, values)
+                for value in values.values():
+                    if isinstance(value, np.ndarray):
+                        value.flags.writeable = False
+                self._entries[key] = values
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def share_arrays(self, key, arrays) -> tuple[dict, bool]:
+        """Back ``arrays`` with the files of ``key``, writing them unless another process has.
+
+        Unlike `get_or_make`, the arrays are not kept in the process, and are meant to
+        be removed with `remove` by the chunk that wrote them, once it is done. Chunks
+        that mapped the files keep their pages after the removal.
+
+        Args:
+            key (str): the key of the arrays, e.g. their `arrays_key`.
+            arrays (dict[str, np.ndarray]): the arrays, by name.
+
+        Returns:
+            Tuple of the dict of the read-only, memory-mapped arrays by name, and
+            whether this call wrote the files. Without a directory, or if the entry
+            is removed while being mapped, the given arrays are returned unchanged.
+        """
+        if self.directory is None:
+            return arrays, False
+        values = self._read(key)
+        wrote = False
+        if values is None:
+            wrote = self._write_entry(key, arrays)
+            values = self._read(key)
+        if values is None:
+            return arrays, False
+        return values, wrote
+
+    def remove(self, key):
+        """Delete the files of ``key`` from the directory."""
+        if self.directory is not None:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def clear(self):
+        """Forget the data made or read by this process, and reset the ``makes`` counter.
+
+        The files in the directory are kept; delete the directory to remove them.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.makes = 0
+
+    def entry_dir(self, key) -> Path:
+        """Directory of the files of ``key``."""
+        return self.directory / key
+
+    def _read(self, key):
+        """The values of ``key`` in the directory, or None if absent or being removed."""
+        if self.directory is None or not self.entry_dir(key).exists():
+            return None
+        entry_dir = self.entry_dir(key)
+        try:
+            with open(entry_dir / OTHER_VALUES_FILE, "rb") as values_file:
+                values = pickle.load(values_file)
+            for path in entry_dir.glob(f"*{ARRAYS_FILE_SUFFIX}"):
+                values[path.stem] = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        return values
+
+    def _write(self, key, values):
+        """Write the values of ``key`` to the directory, and map its arrays back."""
+        if self.directory is None:
+            return values
+        self._write_entry(key, values)
+        return self._read(key)
+
+    def _write_entry(self, key, values) -> bool:
+        """Write the values of ``key`` to the directory, unless another process has.
+
+        Returns:
+            Whether this call wrote the entry.
+        """
+        arrays = {
+            name: value
+            for name, value in values.items()
+            if isinstance(value, np.ndarray) and not value.dtype.hasobject
+        }
+        ## Write to a temporary directory first, so that a partial entry is never read.
+        temp_dir = self.directory / f"{key}.{uuid.uuid4().hex}.tmp"
+        temp_dir.mkdir(parents=True)
+        for name, array in arrays.items():
+            np.save(temp_dir / f"{name}{ARRAYS_FILE_SUFFIX}", array)
+        with open(temp_dir / OTHER_VALUES_FILE, "wb") as values_file:
+            pickle.dump({name: value for name, value in values.items() if name not in arrays}, values_file)
+        try:
+            temp_dir.rename(self.entry_dir(key))
+        except OSError:
+            ## Another process wrote the entry in the meantime.
+            shutil.rmtree(temp_dir)
+            return False
+        return True
+
+
+def arrays_key(arrays) -> str:
+    """Key of a dict of arrays, from their names, types, shapes and content.
+
+    Returns:
+        A hexadecimal digest of the arrays.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(arrays):
+        array = np.asarray(arrays[name])
+        digest.update(f"{name}:{array.dtype.str}{array.shape}".encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+_PROCESS_STORES = {}
+_PROCESS_STORES_LOCK = threading.Lock()
+
+
+def process_shared_data_store(directory=None) -> SharedDataStore:
+    """The shared data store of this process for the given directory.
+
+    Every call with the same ``directory`` returns the same store, so the algorithms
+    unpickled by the tasks of a dask worker all share it.
+    """
+    key = None if directory is None else str(directory)
+    with _PROCESS_STORES_LOCK:
+        if key not in _PROCESS_STORES:
+            _PROCESS_STORES[key] = SharedDataStore(directory)
+        return _PROCESS_STORES[key]
@@ -0,0 +1,252 @@
+"""Vectorised sky geometry used to partition and pre-filter crossmatch chunks."""
+
+from __future__ import annotations
+
+import warnings
+from dataclasses import dataclass
+
+import hats.pixel_math.healpix_shim as hp
+import numpy as np
+from cdshealpix.nested import healpix_to_lonlat, vertices
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import KDTree
+
+# pylint: disable=too-many-arguments,too-many-locals
+
+MAX_SUB_CHUNK_DEPTH = 6
+"""How many orders below the aligned pixel we may go when splitting a dense pair."""
+
+
+def radec_to_xyz(ra, dec) -> np.ndarray:
+    """Convert right ascension and declination, in degrees, to unit vectors.
+
+    Returns:
+        array with the cartesian coordinates in the last dimension.
+    """
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def arcsec_to_chord(arcsec):
+    """Chord length on the unit sphere subtended by an angle in arcseconds."""
+    return 2 * np.sin(np.radians(np.asarray(arcsec, dtype=np.float64) / 3600) / 2)
+
+
+def chord_to_arcsec(chord):
+    """Angle in arcseconds subtended by a chord of the unit sphere."""
+    return np.degrees(2 * np.arcsin(np.clip(np.asarray(chord, dtype=np.float64) / 2, 0, 1))) * 3600
+
+
+def pixel_bounding_circles(order, pixels):
+    """Centers and radii of circles that enclose the corners of each HEALPix pixel.
+
+    Args:
+        order (int): the HEALPix order of the pixels.
+        pixels (np.ndarray): nested pixel numbers.
+
+    Returns:
+        Tuple of the (N, 3) unit vectors of the pixel centers, and the angular radius
+        of each circle in arcseconds.
+    """
+    pixels = np.asarray(pixels, dtype=np.uint64)
+    center_lon, center_lat = healpix_to_lonlat(pixels, order)
+    centers = radec_to_xyz(center_lon.deg, center_lat.deg)
+    corner_lon, corner_lat = vertices(pixels, order)
+    corners = radec_to_xyz(corner_lon.deg, corner_lat.deg)
+    radius_chord = np.max(np.linalg.norm(corners - centers[:, np.newaxis, :], axis=-1), axis=1)
+    return centers, chord_to_arcsec(radius_chord)
+
+
+def any_within(left_ra, left_dec, right_ra, right_dec, radius_arcsec, exact=True) -> bool:
+    """Whether any right source lies within ``radius_arcsec`` of any left source.
+
+    The cartesian bounding boxes of the two sets of sources are compared first, which
+    settles pairs that are far apart without building a k-d tree. If they overlap and
+    ``exact`` is set, a k-d tree is built over the smaller of the two sets of sources,
+    and queried with the nearest neighbour of each source of the other set.
+
+    Args:
+        left_ra, left_dec (np.ndarray): coordinates of the left sources, in degrees.
+        right_ra, right_dec (np.ndarray): coordinates of the right sources, in degrees.
+        radius_arcsec (float): the search radius, in arcseconds.
+        exact (bool): if False, sources whose bounding boxes overlap are assumed to
+            have a pair within the radius.
+    """
+    if len(left_ra) == 0 or len(right_ra) == 0:
+        return False
+    left_xyz = radec_to_xyz(left_ra, left_dec)
+    right_xyz = radec_to_xyz(right_ra, right_dec)
+    chord = arcsec_to_chord(radius_arcsec)
+    if not boxes_within(left_xyz, right_xyz, chord):
+        return False
+    if not exact:
+        return True
+    tree_xyz, query_xyz = (left_xyz, right_xyz) if len(left_xyz) < len(right_xyz) else (right_xyz, left_xyz)
+    distances, _ = KDTree(tree_xyz).query(query_xyz, k=1, distance_upper_bound=chord)
+    return bool(np.isfinite(distances).any())
+
+
+def boxes_within(left_xyz, right_xyz, chord) -> bool:
+    """Whether the cartesian bounding boxes of two sets of unit vectors are within ``chord`` of each other.
+
+    Two points within ``chord`` of each other differ by at most ``chord`` in every
+    coordinate, so sets whose boxes are farther apart have no such pair of points.
+    """
+    return bool(
+        np.all(left_xyz.min(axis=0) - chord <= right_xyz.max(axis=0))
+        and np.all(right_xyz.min(axis=0) - chord <= left_xyz.max(axis=0))
+    )
+
+
+def rows_within(query_ra, query_dec, reference_ra, reference_dec, radius_arcsec) -> np.ndarray:
+    """Positions of the query sources within ``radius_arcsec`` of any reference source.
+
+    Args:
+        query_ra, query_dec (np.ndarray): coordinates of the sources to filter, in degrees.
+        reference_ra, reference_dec (np.ndarray): coordinates of the reference sources, in degrees.
+        radius_arcsec (float): the search radius, in arcseconds.
+
+    Returns:
+        Sorted positions of the query sources that have a reference source within the radius.
+    """
+    if len(query_ra) == 0 or len(reference_ra) == 0:
+        return np.empty(0, dtype=np.int64)
+    distances, _ = KDTree(radec_to_xyz(reference_ra, reference_dec)).query(
+        radec_to_xyz(query_ra, query_dec), k=1, distance_upper_bound=arcsec_to_chord(radius_arcsec)
+    )
+    return np.nonzero(np.isfinite(distances))[0]
+
+
+@dataclass
+class SubChunk:
+    """Rows of a partition pair that make up one spatial sub-chunk.
+
+    Rows are positions in the original partitions. Halo rows lie outside the
+    sub-chunk's core pixel, and are only there to complete the islands of the
+    core sources.
+    """
+
+    pixel: HealpixPixel
+    """the core pixel of this sub-chunk"""
+    left_rows: np.ndarray
+    """positions of the left partition rows in this sub-chunk"""
+    left_halo: np.ndarray
+    """for each of ``left_rows``, True if the row is in the halo"""
+    right_rows: np.ndarray
+    """positions of the right partition rows in this sub-chunk"""
+    right_halo: np.ndarray
+    """for each of ``right_rows``, True if the row is in the halo"""
+
+
+def split_into_sub_chunks(
+    aligned_pix, left_ra, left_dec, right_ra, right_dec, max_rows, halo_arcsec
+) -> list[SubChunk]:
+    """Split a partition pair into spatial sub-chunks with island-complete halos.
+
+    The aligned pixel is divided into its descendants at the shallowest order where
+    no descendant holds more than ``max_rows`` sources of the two partitions together
+    (going at most ``MAX_SUB_CHUNK_DEPTH`` orders deeper, with a warning if that is
+    not deep enough). A sub-chunk is made for each descendant that holds left sources.
+    Its core is the sources in the descendant, and its halo every other source linked
+    to the core by a chain of left-right pairs closer than ``halo_arcsec``. With
+    ``halo_arcsec`` at least macauff's ``pos_corr_dist``, every island that macauff
+    forms from a core source is then entirely in the sub-chunk.
+
+    Args:
+        aligned_pix (HealpixPixel): the aligned pixel of the pair.
+        left_ra, left_dec (np.ndarray): coordinates of the left partition, in degrees.
+        right_ra, right_dec (np.ndarray): coordinates of the right partition, in degrees.
+        max_rows (int): target maximum number of core rows per sub-chunk.
+        halo_arcsec (float): the distance within which a left and a right source are linked,
+            in arcseconds.
+
+    Returns:
+        list of `SubChunk`, such that every left row is in the core of exactly one
+        sub-chunk, and every right row in the core of at most one.
+    """
+    for depth in range(1, MAX_SUB_CHUNK_DEPTH + 1):
+        sub_order = aligned_pix.order + depth
+        left_pixels = hp.radec2pix(sub_order, left_ra, left_dec)
+        right_pixels = hp.radec2pix(sub_order, right_ra, right_dec)
+        _, counts = np.unique(np.concatenate([left_pixels, right_pixels]), return_counts=True)
+        if len(counts) == 0 or counts.max() <= max_rows:
+            break
+    else:
+        warnings.warn(
+            f"Pixel {aligned_pix} still has a sub-chunk of {counts.max()} rows at order {sub_order}, "
+            f"more than max_rows={max_rows}, after splitting it {MAX_SUB_CHUNK_DEPTH} orders deeper.",
+            stacklevel=2,
+        )
+
+    num_left = len(left_pixels)
+    ## Nodes are the left rows, followed by the right rows.
+    labels = _linked_components(left_ra, left_dec, right_ra, right_dec, halo_arcsec)
+    label_order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[label_order]
+    left_sorted = np.argsort(left_pixels, kind="stable")
+    right_sorted = np.argsort(right_pixels, kind="stable")
+    left_sorted_pixels = left_pixels[left_sorted]
+    right_sorted_pixels = right_pixels[right_sorted]
+
+    sub_chunks = []
+    for pixel in np.unique(left_pixels):
+        core_labels = np.unique(
+            np.concatenate(
+                [
+                    labels[_rows_in_pixel(left_sorted_pixels, left_sorted, pixel)],
+                    labels[num_left + _rows_in_pixel(right_sorted_pixels, right_sorted, pixel)],
+                ]
+            )
+        )
+        starts = np.searchsorted(sorted_labels, core_labels)
+        ends = np.searchsorted(sorted_labels, core_labels, side="right")
+        nodes = np.sort(np.concatenate([label_order[start:end] for start, end in zip(starts, ends)]))
+        left_rows = nodes[nodes < num_left].astype(np.int64)
+        right_rows = (nodes[nodes >= num_left] - num_left).astype(np.int64)
+        sub_chunks.append(
+            SubChunk(
+                pixel=HealpixPixel(sub_order, int(pixel)),
+                left_rows=left_rows,
+                left_halo=left_pixels[left_rows] != pixel,
+                right_rows=right_rows,
+                right_halo=right_pixels[right_rows] != pixel,
+            )
+        )
+    return sub_chunks
+
+
+def _linked_components(left_ra, left_dec, right_ra, right_dec, link_arcsec):
+    """Connected component of every source, in the graph of left-right pairs closer than ``link_arcsec``.
+
+    Returns:
+        the component labels of the left sources, followed by those of the right sources.
+    """
+    num_left, num_right = len(left_ra), len(right_ra)
+    if num_left == 0 or num_right == 0:
+        return np.arange(num_left + num_right)
+    ## The chord is padded so that rounding never unlinks a pair at exactly the distance.
+    chord = arcsec_to_chord(link_arcsec) * (1 + 1e-9)
+    neighbours = KDTree(radec_to_xyz(right_ra, right_dec)).query_ball_point(
+        radec_to_xyz(left_ra, left_dec), chord
+    )
+    lengths = np.fromiter((len(rows) for rows in neighbours), dtype=np.int64, count=num_left)
+    left_nodes = np.repeat(np.arange(num_left), lengths)
+    right_nodes = num_left + np.concatenate(
+        [np.empty(0, dtype=np.int64)] + [np.asarray(rows, dtype=np.int64) for rows in neighbours]
+    )
+    graph = coo_matrix(
+        (np.ones(len(left_nodes), dtype=bool), (left_nodes, right_nodes)),
+        shape=(num_left + num_right, num_left + num_right),
+    )
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+
+def _rows_in_pixel(sorted_pixels, sorted_order, pixel):
+    """Positions of the rows in ``pixel``, given the sorted row pixels and their argsort."""
+    start, end = np.searchsorted(sorted_pixels, [pixel, pixel + 1])
+    return sorted_order[start:end]
@@ -3,6 +3,7 @@
 from os import path
 
 import pytest
+from hats_import.catalog.file_readers import CsvPyarrowReader
 
 from lsdb_macauff.import_pipeline.arguments import MacauffArguments
 
@@ -29,6 +30,7 @@ def test_macauff_arguments(catwise_dir, gaia_dir, test_data_dir, import_metadata
     )
 
     assert len(args.input_paths) > 0
+    assert isinstance(args.file_reader, CsvPyarrowReader)
 
 
 def test_empty_required(gaia_dir, catwise_dir, test_data_dir, import_metadata_yaml, tmp_path):
@@ -181,3 +183,30 @@ def test_macauff_args_invalid_input_directory(gaia_dir, catwise_dir, import_meta
             input_format="csv",
             metadata_file_path=import_metadata_yaml,
         )
+
+
+def test_macauff_args_right_position(gaia_dir, catwise_dir, test_data_dir, import_metadata_yaml, tmp_path):
+    kwargs = {
+        "output_path": tmp_path,
+        "output_artifact_name": "object_to_source",
+        "tmp_dir": tmp_path,
+        "left_catalog_dir": gaia_dir,
+        "left_ra_column": "ra",
+        "left_dec_column": "dec",
+        "left_id_column": "source_id",
+        "left_assn_column": "gaia_source_id",
+        "right_catalog_dir": catwise_dir,
+        "right_id_column": "id",
+        "right_assn_column": "catwise_id",
+        "input_path": test_data_dir,
+        "input_format": "csv",
+        "metadata_file_path": import_metadata_yaml,
+    }
+    with pytest.raises(ValueError, match="must be provided together"):
+        MacauffArguments(**kwargs, right_ra_column="catwise_ra")
+    with pytest.raises(ValueError, match="partition_by_join_pixel requires"):
+        MacauffArguments(**kwargs, partition_by_join_pixel=True)
+    args = MacauffArguments(
+        **kwargs, right_ra_column="catwise_ra", right_dec_column="catwise_dec", partition_by_join_pixel=True
+    )
+    assert args.partition_by_join_pixel
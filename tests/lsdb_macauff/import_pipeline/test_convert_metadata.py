@@ -1,10 +1,19 @@
 import os
 from xml.etree.ElementTree import ParseError
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 from hats.io import file_io
+from hats_import.catalog.file_readers import CsvPyarrowReader, CsvReader
 
-from lsdb_macauff.import_pipeline.convert_metadata import from_xml, from_yaml
+from lsdb_macauff.import_pipeline.convert_metadata import (
+    apply_schema_to_reader,
+    from_xml,
+    from_yaml,
+    read_schema,
+)
 
 
 def test_from_xml(import_metadata_dir, tmp_path):
@@ -99,3 +108,51 @@ def test_from_yaml(import_metadata_dir, tmp_path):
     schema = single_metadata.schema.to_arrow_schema()
 
     assert len(schema) == 4
+
+
+def test_read_schema(import_metadata_dir, tmp_path):
+    """Test reading the schema of a cross-match file from each metadata format."""
+    xml_input_file = os.path.join(import_metadata_dir, "macauff_gaia_catwise_match.xml")
+    yaml_input_file = os.path.join(import_metadata_dir, "macauff_gaia_catwise_match_and_nonmatches.yaml")
+
+    assert len(read_schema(xml_input_file)) == 6
+
+    schema = read_schema(yaml_input_file)
+    assert schema.names[0] == "gaia_source_id"
+    assert schema.field("gaia_source_id").type == pa.int64()
+    assert len(read_schema(yaml_input_file, "macauff_GaiaDR3xCatWISE2020_gaia_nonmatches")) == 4
+    with pytest.raises(ValueError, match="table not_a_table not found"):
+        read_schema(yaml_input_file, "not_a_table")
+
+    from_yaml(yaml_input_file, tmp_path)
+    parquet_schema = read_schema(tmp_path / "macauff_GaiaDR3xCatWISE2020_matches.parquet")
+    assert parquet_schema.names == schema.names
+    assert parquet_schema.types == schema.types
+
+
+def test_apply_schema_to_reader(tmp_path):
+    """Test that CSV readers are given the column types of the schema."""
+    schema = pa.schema([("id", pa.string()), ("ra", pa.float64()), ("count", pa.int64())])
+
+    reader = CsvReader(header=None)
+    apply_schema_to_reader(reader, schema)
+    assert reader.kwargs["names"] == ["id", "ra", "count"]
+    assert reader.kwargs["dtype"]["count"] == pd.ArrowDtype(pa.int64())
+
+    reader = CsvReader(type_map={"id": "str"})
+    apply_schema_to_reader(reader, schema)
+    assert reader.kwargs["dtype"] == {"id": "str"}
+    assert "names" not in reader.kwargs
+
+    ## The types of the reader's own schema file are kept.
+    schema_file = tmp_path / "schema.parquet"
+    pq.write_table(pa.table({"id": ["a"], "ra": [1.0], "count": pa.array([1], pa.int32())}), schema_file)
+    reader = CsvReader(schema_file=schema_file, header=None)
+    reader_dtypes = dict(reader.kwargs["dtype"])
+    apply_schema_to_reader(reader, schema)
+    assert reader.kwargs["dtype"] == reader_dtypes
+    assert reader.kwargs["dtype"]["count"] == pd.ArrowDtype(pa.int32())
+
+    reader = CsvPyarrowReader()
+    apply_schema_to_reader(reader, schema)
+    assert reader.convert_options.column_types == {"id": pa.string(), "ra": pa.float64(), "count": pa.int64()}
@@ -0,0 +1,270 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from hats.io import paths
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from hats_import.catalog.file_readers import CsvPyarrowReader, CsvReader
+from hats_import.pipeline_resume_plan import get_pixel_cache_directory
+
+from lsdb_macauff.import_pipeline.convert_metadata import apply_schema_to_reader
+from lsdb_macauff.import_pipeline.map_reduce import (
+    ShardWriter,
+    _list_shards,
+    _sort_max_rows,
+    reduce_associations,
+    split_associations,
+    split_by_pixel,
+)
+from lsdb_macauff.import_pipeline.resume_plan import (
+    align_pixels,
+    read_pixel_alignment,
+    write_pixel_alignment,
+)
+
+
+def test_split_by_pixel():
+    pixels = np.array([HealpixPixel(1, 5), HealpixPixel(0, 2), HealpixPixel(1, 5), HealpixPixel(0, 2)])
+    data = pd.DataFrame({"id": [10, 11, 12, 13], "value": [0.5, 1.5, 2.5, 3.5]}, index=[7, 3, 9, 1])
+
+    groups = list(split_by_pixel(data, pixels))
+    assert [pixel for pixel, _ in groups] == [HealpixPixel(0, 2), HealpixPixel(1, 5)]
+    assert groups[0][1].to_pydict() == {"id": [11, 13], "value": [1.5, 3.5]}
+    assert groups[1][1].to_pydict() == {"id": [10, 12], "value": [0.5, 2.5]}
+    assert groups[0][1].schema.metadata is None
+
+    table_groups = list(split_by_pixel(pa.Table.from_pandas(data, preserve_index=False), pixels))
+    assert [table.to_pydict() for _, table in table_groups] == [table.to_pydict() for _, table in groups]
+    assert len(list(split_by_pixel(data.iloc[:0], pixels[:0]))) == 0
+
+
+def test_pixel_alignment(tmp_path):
+    left_pixels = [HealpixPixel(1, 5), HealpixPixel(0, 0), HealpixPixel(2, 25)]
+    alignment_file = tmp_path / "left_alignment.npy"
+    write_pixel_alignment(alignment_file, left_pixels, 2)
+    alignment = read_pixel_alignment(alignment_file)
+    assert isinstance(alignment, np.memmap)
+    assert read_pixel_alignment(alignment_file) is alignment
+
+    rows = align_pixels(alignment, [0, 15, 20, 23, 25])
+    aligned = [HealpixPixel(int(alignment[row, 2]), int(alignment[row, 3])) for row in rows]
+    assert aligned == [HealpixPixel(0, 0)] * 2 + [HealpixPixel(1, 5)] * 2 + [HealpixPixel(2, 25)]
+    with pytest.raises(ValueError, match="1 rows are outside"):
+        align_pixels(alignment, [0, 24])
+    with pytest.raises(ValueError, match="outside of the right catalog"):
+        align_pixels(alignment, [26], catalog_side="right")
+
+
+def test_shard_writer(tmp_path):
+    writer = ShardWriter(tmp_path, "split_0", max_rows=5, max_bytes=40)
+    chunk = pa.table({"id": np.arange(100, dtype=np.int64)})
+    writer.add(HealpixPixel(0, 1), chunk.slice(0, 3))
+    writer.add(HealpixPixel(0, 2), chunk.slice(3, 2))
+    assert len(list(tmp_path.rglob("*.parquet"))) == 0
+    ## Reaching max_rows writes the buffered rows of the pixel.
+    writer.add(HealpixPixel(0, 1), chunk.slice(5, 2))
+    pixel_dir = get_pixel_cache_directory(tmp_path, HealpixPixel(0, 1))
+    assert pq.read_table(pixel_dir / "shard_split_0_0.parquet")["id"].to_pylist() == [0, 1, 2, 5, 6]
+    ## Going over max_bytes writes the largest buffer.
+    writer.add(HealpixPixel(0, 1), chunk.slice(7, 1))
+    writer.add(HealpixPixel(0, 3), pa.table({"id": np.arange(200, 204, dtype=np.int64)}))
+    assert (get_pixel_cache_directory(tmp_path, HealpixPixel(0, 3)) / "shard_split_0_0.parquet").exists()
+    writer.close()
+    assert pq.read_table(pixel_dir / "shard_split_0_1.parquet")["id"].to_pylist() == [7]
+    pixel_dir = get_pixel_cache_directory(tmp_path, HealpixPixel(0, 2))
+    assert pq.read_table(pixel_dir)["id"].to_pylist() == [3, 4]
+    assert len(list(tmp_path.rglob("*.parquet"))) == 4
+
+
+def test_reduce_associations_row_groups(tmp_path):
+    pixel = HealpixPixel(0, 4)
+    writer = ShardWriter(tmp_path / "tmp", "split_0", max_rows=2, max_bytes=1 << 20)
+    for start in range(0, 7, 2):
+        ids = np.arange(start, min(start + 2, 7), dtype=np.int64)
+        writer.add(pixel, pa.table({"_healpix_29": ids + (4 << 58), "id": ids}))
+    writer.close()
+    (tmp_path / "tmp" / "reducing").mkdir()
+
+    reduce_associations(
+        pixel,
+        tmp_path / "tmp",
+        tmp_path / "catalog",
+        "0_4",
+        write_table_kwargs={"compression": "ZSTD", "use_dictionary": False},
+        row_group_kwargs={"num_rows": 3},
+    )
+    parquet_file = pq.ParquetFile(paths.pixel_catalog_file(tmp_path / "catalog", pixel).path)
+    assert [parquet_file.metadata.row_group(index).num_rows for index in range(3)] == [3, 3, 1]
+    assert parquet_file.metadata.row_group(0).column(0).compression == "ZSTD"
+    assert parquet_file.read()["id"].to_pylist() == list(range(7))
+
+
+def test_reduce_associations_external_sort(tmp_path):
+    pixel = HealpixPixel(0, 4)
+    rng = np.random.default_rng(7)
+    ## A dense sub-pixel, that is split into finer buckets than the rest of the pixel.
+    spatial_index = np.concatenate(
+        [rng.integers(4 << 58, 5 << 58, 300), rng.integers(4 << 58, (4 << 58) + (1 << 50), 700)]
+    )
+    ids = rng.permutation(len(spatial_index))
+    spatial_index[:10] = spatial_index[10]
+    writer = ShardWriter(tmp_path / "tmp", "split_0", max_rows=250, max_bytes=1 << 20)
+    for start in range(0, len(ids), 100):
+        batch = slice(start, start + 100)
+        writer.add(pixel, pa.table({"_healpix_29": spatial_index[batch], "id": ids[batch]}))
+    writer.close()
+    (tmp_path / "tmp" / "reducing").mkdir()
+
+    reduce_associations(
+        pixel, tmp_path / "tmp", tmp_path / "catalog", "0_4", left_id_column="id", sort_max_rows=100
+    )
+    parquet_file = pq.ParquetFile(paths.pixel_catalog_file(tmp_path / "catalog", pixel).path)
+    result = parquet_file.read().to_pandas()
+    expected = pd.DataFrame({"_healpix_29": spatial_index, "id": ids}).sort_values(["_healpix_29", "id"])
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
+    assert [column.column_index for column in parquet_file.metadata.row_group(0).sorting_columns] == [0, 1]
+    assert parquet_file.metadata.row_group(0).column(0).statistics.has_min_max
+    assert not (tmp_path / "tmp" / "sorting" / "0_4").exists()
+
+
+def test_reduce_associations_sort_max_bytes(tmp_path):
+    pixel = HealpixPixel(0, 4)
+    rng = np.random.default_rng(3)
+    spatial_index = rng.integers(4 << 58, 5 << 58, 1000)
+    writer = ShardWriter(tmp_path / "tmp", "split_0", max_rows=250, max_bytes=1 << 20)
+    for start in range(0, len(spatial_index), 100):
+        batch = slice(start, start + 100)
+        writer.add(pixel, pa.table({"_healpix_29": spatial_index[batch], "id": np.arange(1000)[batch]}))
+    writer.close()
+    (tmp_path / "tmp" / "reducing").mkdir()
+
+    ## Rows of two int64 columns, and their sorted copy, take 32 bytes and some overhead.
+    shard_files = _list_shards(get_pixel_cache_directory(tmp_path / "tmp", pixel))
+    assert 50 <= _sort_max_rows(shard_files, 3200) <= 100
+    assert _sort_max_rows(shard_files, 1) == 1
+
+    ## The pixel does not fit the budget, so is sorted externally.
+    reduce_associations(pixel, tmp_path / "tmp", tmp_path / "catalog", "0_4", sort_max_bytes=3200)
+    assert not (tmp_path / "tmp" / "sorting" / "0_4").exists()
+    result = pq.read_table(paths.pixel_catalog_file(tmp_path / "catalog", pixel).path)
+    assert result["_healpix_29"].to_pylist() == sorted(spatial_index.tolist())
+
+
+def test_reduce_associations_row_groups_across_sorted_tables(tmp_path):
+    pixel = HealpixPixel(0, 4)
+    rng = np.random.default_rng(5)
+    spatial_index = rng.integers(4 << 58, 5 << 58, 1000)
+    writer = ShardWriter(tmp_path / "tmp", "split_0", max_rows=250, max_bytes=1 << 20)
+    for start in range(0, len(spatial_index), 100):
+        writer.add(pixel, pa.table({"_healpix_29": spatial_index[start : start + 100]}))
+    writer.close()
+    (tmp_path / "tmp" / "reducing").mkdir()
+
+    ## The pixel is sorted as several tables, whose rows fill row groups across them.
+    reduce_associations(
+        pixel,
+        tmp_path / "tmp",
+        tmp_path / "catalog",
+        "0_4",
+        sort_max_rows=100,
+        row_group_kwargs={"num_rows": 64},
+    )
+    parquet_file = pq.ParquetFile(paths.pixel_catalog_file(tmp_path / "catalog", pixel).path)
+    row_group_rows = [
+        parquet_file.metadata.row_group(index).num_rows for index in range(parquet_file.num_row_groups)
+    ]
+    assert row_group_rows == [64] * 15 + [40]
+    assert parquet_file.read()["_healpix_29"].to_pylist() == sorted(spatial_index.tolist())
+
+
+def test_reduce_associations_by_join_pixel(tmp_path):
+    pixel = HealpixPixel(0, 4)
+    rng = np.random.default_rng(11)
+    num_rows = 500
+    join_pixels = rng.choice([(1, 17), (1, 16), (2, 72)], num_rows)
+    table = pa.table(
+        {
+            "_healpix_29": rng.integers(4 << 58, 5 << 58, num_rows),
+            "id": np.arange(num_rows),
+            "join_Norder": pa.array(join_pixels[:, 0], pa.uint8()),
+            "join_Npix": pa.array(join_pixels[:, 1], pa.uint64()),
+        }
+    )
+    writer = ShardWriter(tmp_path / "tmp", "split_0", max_rows=200, max_bytes=1 << 20)
+    for start in range(0, num_rows, 100):
+        writer.add(pixel, table.slice(start, 100))
+    writer.close()
+    (tmp_path / "tmp" / "reducing").mkdir()
+    (tmp_path / "tmp" / "join_info").mkdir()
+
+    reduce_associations(
+        pixel,
+        tmp_path / "tmp",
+        tmp_path / "catalog",
+        "0_4",
+        left_id_column="id",
+        sort_max_rows=100,
+        partition_by_join_pixel=True,
+    )
+    result = pq.read_table(paths.pixel_catalog_file(tmp_path / "catalog", pixel).path)
+    expected = table.sort_by(
+        [(column, "ascending") for column in ["join_Norder", "join_Npix", "_healpix_29"]]
+    )
+    assert result.equals(expected)
+    join_info = pd.read_csv(tmp_path / "tmp" / "join_info" / "0_4.csv")
+    assert join_info.to_numpy().tolist() == [[0, 4, 1, 16], [0, 4, 1, 17], [0, 4, 2, 72]]
+
+
+@pytest.mark.parametrize("file_reader", [CsvReader(), CsvPyarrowReader()])
+def test_split_associations_readers(file_reader, tmp_path):
+    """Pandas and Arrow readers split the same links into the same shards."""
+    rng = np.random.default_rng(5)
+    num_rows = 200
+    links = pd.DataFrame(
+        {
+            "left_id": [f"a_{index}" for index in range(num_rows)],
+            "left_ra": rng.uniform(0, 360, num_rows),
+            "left_dec": rng.uniform(-90, 90, num_rows),
+            "match_p": rng.random(num_rows),
+        }
+    )
+    links.to_csv(tmp_path / "links.csv", index=False)
+    schema = pa.schema(
+        [
+            ("left_id", pa.string()),
+            ("left_ra", pa.float64()),
+            ("left_dec", pa.float64()),
+            ("match_p", pa.float64()),
+        ]
+    )
+    apply_schema_to_reader(file_reader, schema)
+    with open(tmp_path / "reader.pickle", "wb") as pickle_file:
+        pickle.dump(file_reader, pickle_file)
+    left_pixels = [HealpixPixel(0, pixel) for pixel in range(12)]
+    write_pixel_alignment(tmp_path / "left_alignment.npy", left_pixels, 0)
+    (tmp_path / "tmp" / "splitting").mkdir(parents=True)
+
+    split_associations(
+        tmp_path / "links.csv",
+        tmp_path / "reader.pickle",
+        "split_0",
+        0,
+        tmp_path / "left_alignment.npy",
+        "left_ra",
+        "left_dec",
+        tmp_path / "tmp",
+        metadata_schema=schema,
+    )
+    shards = {}
+    for pixel in left_pixels:
+        shard_file = get_pixel_cache_directory(tmp_path / "tmp", pixel) / "shard_split_0_0.parquet"
+        if shard_file.exists():
+            shards[pixel] = pq.read_table(shard_file)
+            assert (shards[pixel]["_healpix_29"].to_numpy() >> 58 == pixel.pixel).all()
+    result = pa.concat_tables(shards.values())
+    assert result.schema.names == ["_healpix_29", *schema.names]
+    assert result.schema.field("left_id").type == pa.string()
+    assert sorted(result["left_id"].to_pylist()) == sorted(links["left_id"])
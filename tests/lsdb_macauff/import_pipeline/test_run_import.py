@@ -1,8 +1,12 @@
 import os
 
 import hats
+import lsdb
+import numpy as np
+import pandas as pd
 import pytest
-from hats.io import file_io
+from hats.io import file_io, paths
+from hats.pixel_math.spatial_index import SPATIAL_INDEX_ORDER, compute_spatial_index
 from hats_import.catalog.file_readers import CsvReader
 
 import lsdb_macauff.import_pipeline.run_import as runner
@@ -70,6 +74,7 @@ def test_object_to_object(
     assert catalog.catalog_info.total_rows == 40
 
     assert catalog.original_schema.names == [
+        "_healpix_29",
         "catalog_a_id",
         "catalog_a_ra",
         "catalog_a_dec",
@@ -78,3 +83,103 @@ def test_object_to_object(
         "catalog_b_dec",
         "match_p",
     ]
+    assert str(catalog.original_schema.field("catalog_a_id").type) == "string"
+    assert str(catalog.original_schema.field("match_p").type) == "double"
+    data = pd.read_parquet(paths.pixel_catalog_file(args.catalog_path, catalog.get_healpix_pixels()[0]))
+    assert data.sort_values(["_healpix_29", "catalog_a_id"]).index.equals(data.index)
+
+
+def test_object_to_object_join_pixels(
+    import_catalog_a,
+    import_catalog_b,
+    tmp_path,
+    import_metadata_yaml,
+    import_match_csv,
+    dask_client,
+):
+    """Association rows are assigned to the right partitions of their right positions."""
+
+    ## Re-partition the right catalog into pixels of different orders.
+    lsdb.from_dataframe(
+        lsdb.open_catalog(import_catalog_b).compute().reset_index(drop=True),
+        catalog_name="catalog_b",
+        lowest_order=4,
+        highest_order=8,
+        partition_rows=70,
+        drop_empty_siblings=False,
+        margin_threshold=None,
+    ).write_catalog(tmp_path / "catalog_b")
+    right_catalog_dir = lsdb.open_catalog(tmp_path / "catalog_b").hc_structure.catalog_path
+    right_pixels = hats.read_hats(right_catalog_dir).get_healpix_pixels()
+    assert [(pixel.order, pixel.pixel) for pixel in right_pixels] == [(7, 11194), (8, 44782), (8, 44783)]
+
+    from_yaml(import_metadata_yaml, tmp_path)
+    matches_schema_file = os.path.join(tmp_path, "catalog_a_b_matches.parquet")
+    single_metadata = file_io.read_parquet_metadata(matches_schema_file)
+    schema = single_metadata.schema.to_arrow_schema()
+
+    assert len(schema) == 7
+
+    args = MacauffArguments(
+        output_path=tmp_path,
+        output_artifact_name="object_to_object_join",
+        tmp_dir=tmp_path,
+        left_catalog_dir=import_catalog_a,
+        left_ra_column="catalog_a_ra",
+        left_dec_column="catalog_a_dec",
+        left_id_column="catalog_a_id",
+        left_assn_column="catalog_a_id",
+        right_catalog_dir=right_catalog_dir,
+        right_id_column="catalog_b_name",
+        right_assn_column="catalog_b_name",
+        right_ra_column="catalog_b_ra",
+        right_dec_column="catalog_b_dec",
+        partition_by_join_pixel=True,
+        sort_max_rows=10,
+        input_file_list=[import_match_csv],
+        input_format="csv",
+        file_reader=CsvReader(schema_file=matches_schema_file, header=None),
+        metadata_file_path=matches_schema_file,
+        progress_bar=False,
+    )
+
+    runner.run(args, dask_client)
+
+    catalog = hats.read_hats(args.catalog_path)
+    assert catalog.catalog_info.total_rows == 40
+    assert catalog.original_schema.names[-2:] == ["join_Norder", "join_Npix"]
+    left_pixel = catalog.get_healpix_pixels()[0]
+    data = pd.read_parquet(paths.pixel_catalog_file(args.catalog_path, left_pixel))
+
+    ## Each row lands in the right pixel that contains its right position.
+    spatial_index = compute_spatial_index(data["catalog_b_ra"].to_numpy(), data["catalog_b_dec"].to_numpy())
+    expected_pixels = pd.DataFrame(
+        [
+            next(
+                (pixel.order, pixel.pixel)
+                for pixel in right_pixels
+                if index >> (2 * (SPATIAL_INDEX_ORDER - pixel.order)) == pixel.pixel
+            )
+            for index in spatial_index
+        ],
+        columns=["join_Norder", "join_Npix"],
+    )
+    pd.testing.assert_frame_equal(
+        data[["join_Norder", "join_Npix"]].astype(np.int64), expected_pixels.astype(np.int64)
+    )
+    assert data.groupby(["join_Norder", "join_Npix"]).size().to_dict() == {
+        (7, 11194): 4,
+        (8, 44782): 30,
+        (8, 44783): 6,
+    }
+
+    ## The rows of each right pixel are contiguous, and sorted spatially within it.
+    sort_columns = ["join_Norder", "join_Npix", "_healpix_29"]
+    pd.testing.assert_frame_equal(data, data.sort_values(sort_columns, ignore_index=True))
+
+    join_info = pd.read_csv(args.catalog_path / "partition_join_info.csv")
+    assert join_info.to_numpy().tolist() == [
+        [left_pixel.order, left_pixel.pixel, 7, 11194],
+        [left_pixel.order, left_pixel.pixel, 8, 44782],
+        [left_pixel.order, left_pixel.pixel, 8, 44783],
+    ]
@@ -0,0 +1,62 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+from cdshealpix.nested import healpix_to_lonlat
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+from lsdb_macauff.astrometry import (
+    CORRECTIONS_FILE,
+    AstrometricCorrectionTable,
+    build_astrometric_corrections,
+)
+
+
+def _fit(region):
+    return 1.0 + region.pixel / 10, 0.01 * region.pixel
+
+
+def test_correction_table_lookup(tmp_path):
+    table = AstrometricCorrectionTable(2, [9, 3], [1.5, 1.1], [0.2, 0.0])
+    assert table.lookup(HealpixPixel(2, 9)) == (1.5, 0.2)
+    assert table.lookup(HealpixPixel(4, 3 * 16 + 2)) == (1.1, 0.0)
+    with pytest.raises(KeyError, match="No astrometric correction"):
+        table.lookup(HealpixPixel(2, 4))
+    with pytest.raises(ValueError, match="larger than"):
+        table.lookup(HealpixPixel(1, 0))
+
+    ## Each source uses the region that holds it, whatever the size of the chunk.
+    ra, dec = healpix_to_lonlat(np.array([9 * 16 + 5, 3 * 16], dtype=np.uint64), 4)
+    m, n = table.lookup_positions(ra.deg, dec.deg)
+    npt.assert_array_equal(m, [1.5, 1.1])
+    npt.assert_array_equal(n, [0.2, 0.0])
+    npt.assert_allclose(
+        table.correct_uncertainties(ra.deg, dec.deg, np.array([0.1, 0.3])),
+        np.sqrt((np.array([1.5, 1.1]) * np.array([0.1, 0.3])) ** 2 + np.array([0.2, 0.0]) ** 2),
+    )
+    ra, dec = healpix_to_lonlat(np.array([4], dtype=np.uint64), 2)
+    with pytest.raises(KeyError, match="No astrometric correction for region Order: 2, Pixel: 4"):
+        table.lookup_positions(np.array([ra.deg[0], 0.0]), np.array([dec.deg[0], 0.0]))
+
+    table.write(tmp_path / "corrections.parquet")
+    loaded = AstrometricCorrectionTable.read(tmp_path / "corrections.parquet")
+    assert loaded.order == 2
+    npt.assert_array_equal(loaded.pixels, [3, 9])
+    npt.assert_array_equal(loaded.m, [1.1, 1.5])
+
+
+def test_build_astrometric_corrections_is_resumable(tmp_path, dask_client):
+    fitted = []
+
+    def counting_fit(region):
+        fitted.append(region)
+        return _fit(region)
+
+    build_astrometric_corrections(tmp_path, 1, [2, 5], counting_fit)
+    assert fitted == [HealpixPixel(1, 2), HealpixPixel(1, 5)]
+    build_astrometric_corrections(tmp_path, 1, [2, 5], counting_fit)
+    assert len(fitted) == 2
+
+    table = build_astrometric_corrections(tmp_path, 1, [2, 5, 7], _fit, client=dask_client)
+    assert len(table) == 3
+    assert table.lookup(HealpixPixel(1, 7)) == _fit(HealpixPixel(1, 7))
+    assert len(AstrometricCorrectionTable.read(tmp_path / CORRECTIONS_FILE)) == 3
@@ -0,0 +1,191 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from cdshealpix.nested import healpix_to_lonlat
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+from lsdb_macauff.auf_cache import (
+    AufGridCache,
+    build_auf_cache,
+    grids_from_perturb_aufs,
+    perturb_auf_grids,
+    perturb_aufs_from_cache,
+)
+from lsdb_macauff.shared_arrays import SharedDataStore
+
+
+def _simulated_grids(region, catalog, filt):
+    """Small, deterministic stand-in for a perturbation simulation."""
+    num_nm = 3 if filt == "G" else 2
+    offset = region.pixel + (0 if catalog == "a" else 100)
+    return {
+        "N": np.full(num_nm, 5.0),
+        "mag": np.linspace(10, 20, num_nm),
+        "fourier": np.full((4, num_nm), offset, dtype=float),
+        "frac": np.full((2, num_nm), 0.1),
+        "flux": np.arange(num_nm, dtype=float),
+        "density_mag": np.array(18.0),
+    }
+
+
+def test_region_for(tmp_path):
+    cache = AufGridCache(tmp_path, order=2)
+    assert cache.region_for(HealpixPixel(2, 7)) == HealpixPixel(2, 7)
+    assert cache.region_for(HealpixPixel(4, 7 * 16 + 5)) == HealpixPixel(2, 7)
+    with pytest.raises(ValueError, match="larger than the AUF cache regions"):
+        cache.region_for(HealpixPixel(1, 0))
+    assert len(cache.regions()) == 192
+
+    assert cache.regions_for(HealpixPixel(4, 7 * 16 + 5)) == [HealpixPixel(2, 7)]
+    ## A batched ancestor pixel, larger than the regions, uses all of the regions in it.
+    assert cache.regions_for(HealpixPixel(1, 1)) == [HealpixPixel(2, pixel) for pixel in range(4, 8)]
+    assert len(cache.regions_for(HealpixPixel(0, 1))) == 16
+
+
+def test_write_and_read(tmp_path):
+    cache = AufGridCache(tmp_path, order=2)
+    region = HealpixPixel(2, 7)
+    assert not cache.contains(region, "a", "G")
+    with pytest.raises(KeyError):
+        cache.read(region, "a", "G")
+    with pytest.raises(ValueError, match="missing"):
+        cache.write(region, "a", "G", {"N": np.ones(3)})
+
+    cache.write(region, "a", "G", _simulated_grids(region, "a", "G"))
+    assert cache.contains(region, "a", "G")
+    assert (tmp_path / "Norder=2" / "Npix=7" / "catalog=a" / "filter=G" / "fourier.npy").exists()
+    grids = cache.read(region, "a", "G")
+    assert isinstance(grids["fourier"], np.memmap)
+    assert not grids["fourier"].flags.writeable
+    npt.assert_array_equal(grids["fourier"], _simulated_grids(region, "a", "G")["fourier"])
+
+
+def test_build_auf_cache_is_resumable(tmp_path, dask_client):
+    cache = AufGridCache(tmp_path, order=1)
+    regions = [HealpixPixel(1, 3), HealpixPixel(1, 4)]
+    filters = {"a": ["G", "BP"], "b": ["W1"]}
+    cache.write(regions[0], "a", "G", _simulated_grids(regions[0], "a", "G"))
+
+    built = build_auf_cache(cache, regions, filters, _simulated_grids, client=dask_client)
+    assert len(built) == 5
+    assert (regions[0], "a", "G") not in built
+    assert all(cache.contains(region, "b", "W1") for region in regions)
+    assert not build_auf_cache(cache, regions, filters, _simulated_grids)
+
+
+def test_perturb_aufs_from_cache(tmp_path):
+    cache = AufGridCache(tmp_path, order=2)
+    region = HealpixPixel(2, 7)
+    build_auf_cache(cache, [region], {"a": ["G", "BP"]}, _simulated_grids)
+
+    astro = np.array([[45.0, 10.0, 0.1], [45.0001, 10.0, 0.1], [45.0, 10.0001, 0.1]])
+    photo = np.array([[19.5, 10.5], [np.nan, 19.9], [10.2, 10.1]])
+    magref = np.array([0, 1, 0])
+    modelrefinds, outputs = perturb_aufs_from_cache(
+        cache, [region], "a", ["G", "BP"], astro, photo, magref, density_radius=0.25
+    )
+    npt.assert_array_equal(modelrefinds[1], magref)
+    npt.assert_array_equal(modelrefinds[2], [0, 0, 0])
+    ## Faint sources sit at the faint end of the grid, bright sources at the bright end.
+    npt.assert_array_equal(modelrefinds[0], [2, 1, 0])
+
+    npt.assert_array_equal(outputs["arraylengths"], [[3], [2]])
+    assert outputs["fourier_grid"].shape == (4, 3, 2, 1)
+    npt.assert_array_equal(outputs["fourier_grid"][:, :2, 1, 0], 7.0)
+    npt.assert_array_equal(outputs["fourier_grid"][:, 2, 1, 0], -1.0)
+    assert outputs["frac_grid"].shape == (2, 3, 2, 1)
+    npt.assert_array_equal(outputs["flux_grid"][:, 0, 0], [0, 1, 2])
+
+
+def test_perturb_aufs_from_cache_scales_density_and_magnitude(tmp_path):
+    cache = AufGridCache(tmp_path, order=2)
+    region = HealpixPixel(2, 7)
+    grids = _simulated_grids(region, "a", "G")
+    ## A lone source counts itself, for a density of 1 / (pi 0.25^2) ~ 5.1 per deg^2.
+    grids["N"] = np.array([5.6, 15.3, 5.1, np.nan])
+    grids["mag"] = np.array([12.0, 19.0, 25.0, 19.0])
+    grids["fourier"], grids["frac"] = np.zeros((4, 4)), np.zeros((2, 4))
+    grids["flux"] = np.zeros(4)
+    cache.write(region, "a", "G", grids)
+
+    astro = np.array([[45.0, 10.0, 0.1], [46.0, 10.0, 0.1]])
+    modelrefinds, _ = perturb_aufs_from_cache(
+        cache, [region], "a", ["G"], astro, np.array([[19.0], [24.8]]), np.zeros(2, int), density_radius=0.25
+    )
+    ## The density of the second combination is three times that of the first source,
+    ## but the others are 24 magnitude bins off; a plain difference picks the third.
+    npt.assert_array_equal(modelrefinds[0], [1, 2])
+
+
+def test_perturb_aufs_from_cache_over_several_regions(tmp_path):
+    cache = AufGridCache(tmp_path, order=2)
+    regions = cache.regions_for(HealpixPixel(1, 1))
+    build_auf_cache(cache, regions, {"a": ["G", "BP"]}, _simulated_grids)
+
+    ## One source at the center of each region.
+    ra, dec = healpix_to_lonlat(np.array([region.pixel for region in regions], dtype=np.uint64), 2)
+    astro = np.stack([ra.deg, dec.deg, np.full(4, 0.1)], axis=1)
+    photo = np.full((4, 2), 15.0)
+    magref = np.array([0, 1, 0, 1])
+    modelrefinds, outputs = perturb_aufs_from_cache(
+        cache, regions, "a", ["G", "BP"], astro, photo, magref, density_radius=0.25
+    )
+    npt.assert_array_equal(modelrefinds[2], [0, 1, 2, 3])
+    npt.assert_array_equal(modelrefinds[1], magref)
+    npt.assert_array_equal(outputs["arraylengths"], [[3, 3, 3, 3], [2, 2, 2, 2]])
+    assert outputs["fourier_grid"].shape == (4, 3, 2, 4)
+    for point, region in enumerate(regions):
+        npt.assert_array_equal(outputs["fourier_grid"][:, :3, 0, point], region.pixel)
+
+
+def test_perturb_auf_grids_shared(tmp_path):
+    cache = AufGridCache(tmp_path / "cache", order=2)
+    regions = cache.regions_for(HealpixPixel(1, 1))
+    with pytest.raises(KeyError):
+        cache.grids_key(regions, "a", ["G"])
+    build_auf_cache(cache, regions, {"a": ["G", "BP"]}, _simulated_grids)
+    key = cache.grids_key(regions, "a", ["G", "BP"])
+    assert key == cache.grids_key(regions, "a", ["G", "BP"])
+    assert key != cache.grids_key(regions[:2], "a", ["G", "BP"])
+
+    ## The grids of a set of regions are assembled once, and mapped by the other processes.
+    store = SharedDataStore(tmp_path / "shared")
+    grids = store.get_or_make(key, lambda: perturb_auf_grids(cache, regions, "a", ["G", "BP"]))
+    other = SharedDataStore(tmp_path / "shared").get_or_make(key, lambda: pytest.fail("made again"))
+    assert isinstance(other["fourier_grid"], np.memmap) and other["fourier_grid"].flags.f_contiguous
+    npt.assert_array_equal(other["fourier_grid"], grids["fourier_grid"])
+    assert store.makes == 1
+
+    ## Entries simulated again make a new key.
+    entry_done = cache.entry_path(regions[0], "a", "G") / "done"
+    os.utime(entry_done, ns=(0, entry_done.stat().st_mtime_ns + 1))
+    assert cache.grids_key(regions, "a", ["G", "BP"]) != key
+
+
+def test_grids_from_perturb_aufs():
+    num_rho = 5
+    perturb_auf_outputs = {
+        "fourier_grid": np.arange(num_rho * 3 * 2, dtype=float).reshape(num_rho, 3, 2, 1),
+        "frac_grid": np.full((2, 3, 2, 1), 0.1),
+        "flux_grid": np.arange(6, dtype=float).reshape(3, 2, 1),
+        "arraylengths": np.array([[3], [0]]),
+    }
+    astro = np.array([[45.0, 10.0, 0.1], [45.0001, 10.0, 0.1], [45.0, 10.0001, 0.1], [45.0, 10.0, 0.1]])
+    photo = np.array([[19.0, np.nan], [19.0, np.nan], [12.0, np.nan], [np.nan, np.nan]])
+    ## The two faint sources share the last combination, the bright one the first; none uses the second.
+    modelrefinds = np.array([[2, 2, 0, 0], [0, 0, 0, 1], [0, 0, 0, 0]])
+
+    grids = grids_from_perturb_aufs(modelrefinds, perturb_auf_outputs, 0, astro, photo, 0.25)
+    npt.assert_array_equal(grids["fourier"], perturb_auf_outputs["fourier_grid"][:, :, 0, 0])
+    npt.assert_array_equal(grids["flux"], [0, 2, 4])
+    npt.assert_array_equal(grids["mag"], [12.0, np.nan, 19.0])
+    assert np.isnan(grids["N"][1])
+    assert grids["N"][0] > 0 and grids["N"][2] > 0
+    assert grids["density_mag"].ndim == 0
+
+    ## A filter without sources keeps macauff's single unperturbed combination.
+    grids = grids_from_perturb_aufs(modelrefinds, perturb_auf_outputs, 1, astro, photo, 0.25)
+    assert grids["fourier"].shape == (num_rho, 1)
+    assert grids["density_mag"] == -np.inf
@@ -0,0 +1,80 @@
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from lsdb.core.crossmatch.crossmatch_args import CrossmatchArgs
+
+from lsdb_macauff.batching import aligned_pixel, group_sparse_pairs, merge_pairs, scatter_matches
+
+
+def _pair(order, pixel, left_df, right_df, right_order=None):
+    return CrossmatchArgs(
+        left_df=left_df,
+        right_df=right_df,
+        left_order=order,
+        left_pixel=pixel,
+        right_order=order if right_order is None else right_order,
+        right_pixel=pixel if right_order is None else pixel >> (2 * (order - right_order)),
+        left_catalog_info=None,
+        right_catalog_info=None,
+        right_margin_catalog_info=None,
+    )
+
+
+def _frame(index, ra, dec):
+    return pd.DataFrame({"ra": np.asarray(ra, dtype=float), "dec": np.asarray(dec, dtype=float)}, index=index)
+
+
+def test_aligned_pixel():
+    assert aligned_pixel(
+        _pair(5, 1234, _frame([], [], []), _frame([], [], []), right_order=3)
+    ) == HealpixPixel(5, 1234)
+
+
+def test_group_sparse_pairs():
+    small = _frame([1, 2], [0, 1], [0, 1])
+    large = _frame(np.arange(20), np.arange(20), np.arange(20))
+    pairs = [
+        _pair(4, 16, small, small),
+        _pair(4, 17, small, small),
+        _pair(4, 18, large, small),
+        _pair(4, 19, small, small),
+        _pair(4, 32, small, small),
+        _pair(1, 2, small, small),
+    ]
+    groups = group_sparse_pairs(pairs, max_rows=10, depth=2)
+    assert groups == [
+        (HealpixPixel(2, 1), [0, 1]),
+        (None, [2]),
+        (HealpixPixel(2, 1), [3]),
+        (HealpixPixel(2, 2), [4]),
+        (None, [5]),
+    ]
+
+
+def test_merge_and_scatter_matches():
+    shared_right = _frame([10, 11], [1.0, 2.0], [1.0, 2.0])
+    pairs = [
+        _pair(4, 16, _frame([1, 2], [0.0, 0.5], [0.0, 0.5]), shared_right),
+        _pair(4, 17, _frame([3], [3.0], [3.0]), pd.concat([shared_right, _frame([12], [3.1], [3.1])])),
+    ]
+    merged = merge_pairs(pairs, ra_column=0, dec_column=1)
+    assert len(merged.left_df) == 3
+    npt.assert_array_equal(merged.left_offsets, [0, 2, 3])
+    npt.assert_array_equal(merged.right_df.index, [10, 11, 12])
+
+    ## The last match pairs a left source of the first pair with a right source
+    ## that is only in the second pair's partition. It is kept by the first pair,
+    ## with its right source located in the second pair's partition.
+    left_indices = np.array([0, 1, 2, 2, 0])
+    right_indices = np.array([0, 1, 1, 2, 2])
+    scattered = scatter_matches(merged, left_indices, right_indices)
+    assert len(scattered) == 2
+    npt.assert_array_equal(scattered[0][0], [0, 1, 4])
+    npt.assert_array_equal(scattered[0][1], [0, 1, 0])
+    npt.assert_array_equal(scattered[0][2], [0, 0, 1])
+    npt.assert_array_equal(scattered[0][3], [0, 1, 2])
+    npt.assert_array_equal(scattered[1][0], [2, 3])
+    npt.assert_array_equal(scattered[1][1], [0, 0])
+    npt.assert_array_equal(scattered[1][2], [1, 1])
+    npt.assert_array_equal(scattered[1][3], [1, 2])
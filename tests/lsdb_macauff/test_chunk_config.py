@@ -0,0 +1,69 @@
+import pickle
+
+import numpy as np
+import pytest
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+from lsdb_macauff.chunk_config import ChunkConfigCache, chunk_config_key, process_chunk_config_cache
+
+
+def test_chunk_config_cache_lru():
+    cache = ChunkConfigCache(maxsize=2)
+    assert cache.get(HealpixPixel(0, 1)) is None
+
+    cache.put(HealpixPixel(0, 1), {"chunk_id": "1"})
+    cache.put(HealpixPixel(0, 2), {"chunk_id": "2"})
+    assert cache.get(HealpixPixel(0, 1)) == {"chunk_id": "1"}
+
+    ## Pixel 2 is now the least recently used, and is evicted.
+    cache.put(HealpixPixel(0, 3), {"chunk_id": "3"})
+    assert cache.get(HealpixPixel(0, 2)) is None
+    assert cache.get(HealpixPixel(0, 3)) == {"chunk_id": "3"}
+
+    assert cache.cache_info() == (2, 2, 2, 2)
+
+    cache.clear()
+    assert cache.cache_info() == (0, 0, 2, 0)
+
+
+def test_chunk_config_cache_disabled():
+    cache = ChunkConfigCache(maxsize=0)
+    cache.put(HealpixPixel(0, 1), {"chunk_id": "1"})
+    assert cache.get(HealpixPixel(0, 1)) is None
+    assert cache.cache_info() == (0, 1, 0, 0)
+
+    with pytest.raises(ValueError, match="maxsize"):
+        ChunkConfigCache(maxsize=-1)
+
+
+def test_chunk_config_cache_pickle():
+    cache = ChunkConfigCache(maxsize=5)
+    cache.put(HealpixPixel(0, 1), {"chunk_id": "1"})
+    cache.get(HealpixPixel(0, 1))
+
+    unpickled = pickle.loads(pickle.dumps(cache))
+    assert unpickled.cache_info() == (0, 0, 5, 0)
+    unpickled.put(HealpixPixel(0, 1), {"chunk_id": "1"})
+    assert unpickled.get(HealpixPixel(0, 1)) == {"chunk_id": "1"}
+
+
+def test_process_chunk_config_cache():
+    cache = process_chunk_config_cache(maxsize=7)
+    assert process_chunk_config_cache(maxsize=7) is cache
+    assert process_chunk_config_cache(maxsize=8) is not cache
+    assert pickle.loads(pickle.dumps(cache)) is not cache
+
+
+def test_chunk_config_key():
+    joint = {"pos_corr_dist": 11, "chunk_id_list": np.array(["0"]), "cf_region_points_per_chunk": [[1]]}
+    cat_a = {"filt_names": ["G"], "auf_region_points_per_chunk": np.array([[1.0, 1.0, 1, 2.0, 2.0, 1]])}
+    cat_b = {"filt_names": ["W1"], "dens_dist": 0.25}
+    key = chunk_config_key(joint, cat_a, cat_b)
+
+    ## The per-chunk entries, which differ between pixels, do not change the key.
+    other_pixel = dict(cat_a, auf_region_points_per_chunk=np.array([[5.0, 5.0, 1, 6.0, 6.0, 1]]))
+    assert chunk_config_key(dict(joint, chunk_id_list=np.array(["1"])), other_pixel, cat_b) == key
+
+    assert chunk_config_key(dict(joint, pos_corr_dist=12), cat_a, cat_b) != key
+    assert chunk_config_key(joint, cat_b, cat_a) != key
+    assert chunk_config_key(joint, cat_a, dict(cat_b, dens_dist=np.array([0.25]))) != key
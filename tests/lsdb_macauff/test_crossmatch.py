@@ -1,8 +1,28 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from functools import partial
+
+import numpy as np
 import numpy.testing as npt
 import pandas as pd
+import pyarrow as pa
+import pytest
+from astropy.coordinates import SkyCoord
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from lsdb.core.crossmatch.crossmatch_args import CrossmatchArgs
 from macauff import CrossMatch
 
-from lsdb_macauff.macauff_crossmatch import MacauffCrossmatch
+from lsdb_macauff.astrometry import AstrometricCorrectionTable, MacauffAstrometryFit
+from lsdb_macauff.auf_cache import AufGridCache, MacauffAufSimulator, build_auf_cache
+from lsdb_macauff.columns import column_to_numpy, columns_to_numpy, to_arrow_columns
+from lsdb_macauff.instrumentation import STAGES, load_instrumentation
+from lsdb_macauff.macauff_crossmatch import (
+    WITHOUT_PHOTOMETRY_SUFFIX,
+    MacauffCrossmatch,
+    _merge_photometry_variants,
+)
+from lsdb_macauff.result_cache import ResultCache
 
 
 def test_macauff_setup_loading(gaia_params_path, wise_params_path, gaia_wise_joint_params_path):
@@ -15,7 +35,151 @@ def test_macauff_setup_loading(gaia_params_path, wise_params_path, gaia_wise_joi
     npt.assert_equal(lsdb_macauff.cat_b_params_dict, macauff_crossmatch.cat_b_params_dict)
 
 
+def _perturbed_joint_params(tmp_path, gaia_wise_joint_params_path):
+    joint_params_path = tmp_path / "joint_params.yaml"
+    with open(gaia_wise_joint_params_path, encoding="utf-8") as joint_params:
+        joint_params_path.write_text(
+            joint_params.read().replace("include_perturb_auf: False", "include_perturb_auf: True")
+        )
+    return joint_params_path
+
+
+def test_macauff_perturbations_require_auf_cache(
+    tmp_path, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    joint_params_path = _perturbed_joint_params(tmp_path, gaia_wise_joint_params_path)
+    with pytest.raises(NotImplementedError, match="AUF cache"):
+        MacauffCrossmatch(joint_params_path, gaia_params_path, wise_params_path)
+    auf_cache = AufGridCache(tmp_path / "auf_cache", order=2)
+    lsdb_macauff = MacauffCrossmatch(
+        joint_params_path, gaia_params_path, wise_params_path, auf_cache=auf_cache
+    )
+    assert lsdb_macauff.auf_cache is auf_cache
+
+
 # pylint: disable=unused-argument
+def _unperturbed_grids(num_fourier, region, catalog, filt):
+    """The grids of a single N-m combination without any perturbation, as macauff makes them."""
+    return {
+        "N": np.ones(1),
+        "mag": np.ones(1),
+        "fourier": np.ones((num_fourier, 1)),
+        "frac": np.zeros((2, 1)),
+        "flux": np.zeros(1),
+        "density_mag": np.array(0.0),
+    }
+
+
+def test_macauff_xmatch_with_auf_cache(
+    tmp_path,
+    gaia_cat,
+    catwise_cat,
+    gaia_params_path,
+    wise_params_path,
+    gaia_wise_joint_params_path,
+    expected_gaia_wise_xmatch_df,
+    dask_client,
+):
+    with pytest.raises(ValueError, match="include_perturb_auf"):
+        MacauffAufSimulator(
+            MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_path, wise_params_path),
+            gaia_cat,
+            catwise_cat,
+        )
+    joint_params_path = _perturbed_joint_params(tmp_path, gaia_wise_joint_params_path)
+    ## Regions deeper than the partitions, so every pair spans several AUF pointings.
+    auf_cache = AufGridCache(tmp_path / "auf_cache", order=5)
+    macauff_algo = MacauffCrossmatch(
+        joint_params_path, gaia_params_path, wise_params_path, auf_cache=auf_cache
+    )
+    regions = {region for pixel in gaia_cat.get_healpix_pixels() for region in auf_cache.regions_for(pixel)}
+    num_fourier = int(macauff_algo.crossmatch_params_dict["four_hankel_points"]) - 1
+    build_auf_cache(
+        auf_cache,
+        sorted(regions),
+        {
+            "a": macauff_algo.cat_a_params_dict["filt_names"],
+            "b": macauff_algo.cat_b_params_dict["filt_names"],
+        },
+        partial(_unperturbed_grids, num_fourier),
+    )
+    assert max(pixel.order for pixel in gaia_cat.get_healpix_pixels()) < auf_cache.order
+
+    xmatch = gaia_cat.crossmatch(catwise_cat, algorithm=macauff_algo, suffixes=("_gaia", "_wise"))
+    result = xmatch.compute()
+    ## Cached grids without perturbations match like macauff without perturbations.
+    test_df = result.sort_values(by="source_id_gaia").reset_index(drop=True)[
+        expected_gaia_wise_xmatch_df.columns
+    ]
+    expected_df = expected_gaia_wise_xmatch_df.sort_values(by="source_id_gaia").reset_index(drop=True)
+    pd.testing.assert_frame_equal(test_df, expected_df)
+
+
+def test_macauff_astrometry_requires_precomputed_corrections(
+    tmp_path, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    gaia_params_corrected_path = tmp_path / "gaia_params.yaml"
+    with open(gaia_params_path, encoding="utf-8") as gaia_params:
+        gaia_params_corrected_path.write_text(
+            gaia_params.read().replace("correct_astrometry: False", "correct_astrometry: True")
+        )
+    with pytest.raises(NotImplementedError, match="Astrometric corrections"):
+        MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_corrected_path, wise_params_path)
+    corrections = AstrometricCorrectionTable(0, np.arange(12), np.ones(12), np.zeros(12))
+    lsdb_macauff = MacauffCrossmatch(
+        gaia_wise_joint_params_path,
+        gaia_params_corrected_path,
+        wise_params_path,
+        cat_a_astrometric_corrections=corrections,
+    )
+    assert lsdb_macauff.cat_a_astrometric_corrections is corrections
+
+
+def test_macauff_xmatch_with_astrometric_corrections(
+    tmp_path,
+    gaia_cat,
+    catwise_cat,
+    gaia_params_path,
+    wise_params_path,
+    gaia_wise_joint_params_path,
+    expected_gaia_wise_xmatch_df,
+    dask_client,
+):
+    with pytest.raises(ValueError, match="catalog must be"):
+        MacauffAstrometryFit(None, "c", gaia_cat, catwise_cat, tmp_path)
+    wise_params_corrected_path = tmp_path / "wise_params.yaml"
+    with open(wise_params_path, encoding="utf-8") as wise_params:
+        wise_params_corrected_path.write_text(
+            wise_params.read().replace("correct_astrometry: False", "correct_astrometry: True")
+        )
+    ## Regions deeper than the partitions, so every chunk spans several corrections.
+    order = 5
+    num_regions = 12 * 4**order
+    assert max(pixel.order for pixel in catwise_cat.get_healpix_pixels()) < order
+
+    def crossmatch(m, n):
+        corrections = AstrometricCorrectionTable(
+            order, np.arange(num_regions), np.full(num_regions, m), np.full(num_regions, n)
+        )
+        macauff_algo = MacauffCrossmatch(
+            gaia_wise_joint_params_path,
+            gaia_params_path,
+            wise_params_corrected_path,
+            cat_b_astrometric_corrections=corrections,
+        )
+        xmatch = gaia_cat.crossmatch(catwise_cat, algorithm=macauff_algo, suffixes=("_gaia", "_wise"))
+        return xmatch.compute().sort_values(by="source_id_gaia").reset_index(drop=True)
+
+    expected_df = expected_gaia_wise_xmatch_df.sort_values(by="source_id_gaia").reset_index(drop=True)
+    ## The identity correction leaves the matches as they are.
+    pd.testing.assert_frame_equal(crossmatch(1.0, 0.0)[expected_gaia_wise_xmatch_df.columns], expected_df)
+    ## Inflated uncertainties change the match probabilities.
+    inflated = crossmatch(1.5, 0.5)
+    common = expected_df.merge(inflated, on=["source_id_gaia", "cntr_wise"], suffixes=("", "_inflated"))
+    assert len(common) > 0
+    assert not np.allclose(common["p"], common["p_inflated"])
+
+
 def test_macauff_xmatch(
     gaia_cat,
     catwise_cat,
@@ -33,3 +197,510 @@ def test_macauff_xmatch(
     ]
     expected_df = expected_gaia_wise_xmatch_df.sort_values(by="source_id_gaia").reset_index(drop=True)
     pd.testing.assert_frame_equal(test_df, expected_df)
+
+
+def _make_crossmatch_args(left_cat, right_cat, left_df, right_df):
+    left_pixel = left_cat.get_healpix_pixels()[0]
+    right_pixel = right_cat.get_healpix_pixels()[0]
+    return CrossmatchArgs(
+        left_df=left_df,
+        right_df=right_df,
+        left_order=left_pixel.order,
+        left_pixel=left_pixel.pixel,
+        right_order=right_pixel.order,
+        right_pixel=right_pixel.pixel,
+        left_catalog_info=left_cat.hc_structure.catalog_info,
+        right_catalog_info=right_cat.hc_structure.catalog_info,
+        right_margin_catalog_info=None,
+    )
+
+
+def test_macauff_concurrent_pairs_match_serial(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    macauff_algo = MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_path, wise_params_path)
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    ## Overlapping pairs: every left subset is matched against the same right partition.
+    pairs = [_make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)] + [
+        _make_crossmatch_args(gaia_cat, catwise_cat, left_df.iloc[start::3], right_df) for start in range(3)
+    ]
+
+    serial_results = [macauff_algo.perform_crossmatch(pair) for pair in pairs]
+    with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+        concurrent_results = list(executor.map(macauff_algo.perform_crossmatch, pairs))
+
+    for serial, concurrent in zip(serial_results, concurrent_results):
+        npt.assert_array_equal(serial[0], concurrent[0])
+        npt.assert_array_equal(serial[1], concurrent[1])
+        pd.testing.assert_frame_equal(serial[2], concurrent[2], check_exact=True)
+    assert len(macauff_algo.cat_a_params_dict["chunk_id_list"]) == 0
+
+
+def test_macauff_chunk_config_cache(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    macauff_algo = MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_path, wise_params_path)
+    macauff_algo.chunk_config_cache.clear()
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+    ## The same partitions, aligned to one of the children of the pixel.
+    pixels = [HealpixPixel(3, 512), HealpixPixel(4, 2049)]
+    pairs = [pair, replace(pair, left_order=4, left_pixel=2049, right_order=4, right_pixel=2049)]
+
+    ## The configuration depends on the parameters only, so it is reused across pixels,
+    ## and by other algorithms with the same parameters in this process.
+    first = macauff_algo.perform_crossmatch(pairs[0])
+    pickled_algo = pickle.loads(pickle.dumps(macauff_algo))
+    second = pickled_algo.perform_crossmatch(pairs[1])
+    assert macauff_algo.cache_info() == (1, 1, 128, 1)
+
+    uncached_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path, chunk_config_cache_size=0
+    )
+    for pair, cached in zip(pairs, [first, second]):
+        uncached = uncached_algo.perform_crossmatch(pair)
+        npt.assert_array_equal(cached[0], uncached[0])
+        npt.assert_array_equal(cached[1], uncached[1])
+        pd.testing.assert_frame_equal(cached[2], uncached[2], check_exact=True)
+    assert uncached_algo.cache_info().currsize == 0
+
+    ## Every pair context gets its own parameter dictionaries and region points.
+    contexts = [macauff_algo._make_pair_context(pair.left_df, pair.right_df) for pair in pairs]
+    for context, pixel in zip(contexts, pixels):
+        macauff_algo._configure_chunk(context, pixel)
+    assert contexts[0].cat_a_params_dict is not contexts[1].cat_a_params_dict
+    assert not np.array_equal(contexts[0].a_auf_region_points, contexts[1].a_auf_region_points)
+    assert not np.array_equal(
+        contexts[0].cat_a_params_dict["auf_region_points_per_chunk"],
+        contexts[1].cat_a_params_dict["auf_region_points_per_chunk"],
+    )
+
+
+def test_column_extraction_from_arrow_buffers():
+    partition = pa.table(
+        {
+            "ra": [1.0, 2.0, 3.0],
+            "dec": [-1.0, -2.0, -3.0],
+            "mag": [10.0, None, 12.0],
+            "best_mag": [0, 1, 0],
+            "in_overlap": [True, False, None],
+        }
+    ).to_pandas(types_mapper=pd.ArrowDtype)
+
+    astro = columns_to_numpy(partition, [0, 1], np.float64)
+    npt.assert_array_equal(astro, [[1.0, -1.0], [2.0, -2.0], [3.0, -3.0]])
+    assert astro.flags.c_contiguous
+
+    ## Clean primitive columns are read in place from the Arrow buffers.
+    ra_values = column_to_numpy(partition.iloc[:, 0], np.float64)
+    assert not ra_values.flags.owndata
+    npt.assert_array_equal(column_to_numpy(partition.iloc[:, 3], np.int64), [0, 1, 0])
+
+    ## Nulls are converted to the requested value.
+    npt.assert_array_equal(column_to_numpy(partition.iloc[:, 2], np.float64), [10.0, np.nan, 12.0])
+    in_overlaps = column_to_numpy(partition.iloc[:, 4], bool, na_value=False)
+    npt.assert_array_equal(in_overlaps, [True, False, False])
+    assert in_overlaps.dtype == bool
+
+
+def test_result_columns_built_as_arrow():
+    num_matches = 5
+    values = {name: np.arange(num_matches, dtype=np.float64) for name in MacauffCrossmatch.extra_columns}
+    contamination = np.arange(2 * num_matches, dtype=np.float64).reshape(2, num_matches)
+    values["a_cont_f10"] = contamination[1]
+
+    extra_columns = to_arrow_columns(values, MacauffCrossmatch.extra_columns)
+
+    pd.testing.assert_series_equal(extra_columns.dtypes, MacauffCrossmatch.extra_columns.dtypes)
+    npt.assert_array_equal(extra_columns["a_cont_f10"].to_numpy(), contamination[1])
+    ## Contiguous result arrays are used by Arrow without a copy.
+    arrow_buffer = pa.array(extra_columns["p"].array).buffers()[1]
+    assert np.shares_memory(np.frombuffer(arrow_buffer, dtype=np.float64), values["p"])
+
+
+def test_result_columns_nan_as_null():
+    values = {name: np.arange(3, dtype=np.float64) for name in MacauffCrossmatch.extra_columns}
+    values["eta"] = np.array([1.0, np.nan, 3.0])
+    values["xi"] = np.ma.masked_array([np.nan, 2.0, 3.0], mask=[False, False, True])
+
+    extra_columns = to_arrow_columns(values, MacauffCrossmatch.extra_columns)
+
+    assert extra_columns["eta"].isna().tolist() == [False, True, False]
+    assert extra_columns["xi"].isna().tolist() == [True, False, True]
+    assert extra_columns["p"].isna().sum() == 0
+
+
+def test_macauff_sub_chunks_match_single_chunk(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+
+    single_algo = MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_path, wise_params_path)
+    single = _sorted_result(*single_algo.perform_crossmatch(pair))
+
+    for workers in [1, 4]:
+        sub_chunk_algo = MacauffCrossmatch(
+            gaia_wise_joint_params_path,
+            gaia_params_path,
+            wise_params_path,
+            max_chunk_rows=4000,
+            sub_chunk_workers=workers,
+        )
+        sub_chunked = _sorted_result(*sub_chunk_algo.perform_crossmatch(pair))
+        npt.assert_array_equal(sub_chunked[0], single[0])
+        npt.assert_array_equal(sub_chunked[1], single[1])
+        pd.testing.assert_frame_equal(sub_chunked[2], single[2], check_exact=True)
+
+
+def test_macauff_sub_chunk_halo_at_least_pos_corr_dist(
+    gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    with pytest.raises(ValueError, match="pos_corr_dist"):
+        MacauffCrossmatch(
+            gaia_wise_joint_params_path,
+            gaia_params_path,
+            wise_params_path,
+            max_chunk_rows=4000,
+            sub_chunk_halo_arcsec=0.1,
+        )
+
+
+def _sorted_result(left_indices, right_indices, extra_columns):
+    order = np.lexsort((right_indices, left_indices))
+    return left_indices[order], right_indices[order], extra_columns.iloc[order].reset_index(drop=True)
+
+
+def test_macauff_batch_of_sparse_pairs_matches_single_pair(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    macauff_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path,
+        gaia_params_path,
+        wise_params_path,
+        sparse_batch_rows=len(left_df) + 16 * len(right_df),
+        sparse_batch_depth=2,
+    )
+    single = _sorted_result(
+        *macauff_algo.perform_crossmatch(_make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df))
+    )
+
+    ## Split the left partition into its order 5 descendants, all paired with the
+    ## whole right partition. They coalesce back into a single chunk for (3, 512).
+    left_pixels = left_df.index.to_numpy() >> (2 * (29 - 5))
+    pairs, left_rows = [], []
+    for pixel in np.unique(left_pixels):
+        rows = np.nonzero(left_pixels == pixel)[0]
+        pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df.iloc[rows], right_df)
+        pair.left_order, pair.left_pixel = 5, int(pixel)
+        pairs.append(pair)
+        left_rows.append(rows)
+
+    results = macauff_algo.perform_crossmatch_batch(pairs)
+    assert len(results) == len(pairs)
+    assert all((result[3] == position).all() for position, result in enumerate(results))
+    batched = _sorted_result(
+        np.concatenate([rows[result[0]] for rows, result in zip(left_rows, results)]),
+        np.concatenate([result[1] for result in results]),
+        pd.concat([result[2] for result in results], ignore_index=True),
+    )
+    npt.assert_array_equal(batched[0], single[0])
+    npt.assert_array_equal(batched[1], single[1])
+    pd.testing.assert_frame_equal(batched[2], single[2])
+
+
+def test_macauff_batch_keeps_matches_across_pairs(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    macauff_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path,
+        gaia_params_path,
+        wise_params_path,
+        sparse_batch_rows=len(left_df) + len(right_df),
+        sparse_batch_depth=2,
+    )
+    single = _sorted_result(
+        *macauff_algo.perform_crossmatch(_make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df))
+    )
+
+    ## Split both partitions into their order 5 descendants, without margins, so that
+    ## sources near the edges of the pairs are matched to right sources of other pairs.
+    left_pixels = left_df.index.to_numpy() >> (2 * (29 - 5))
+    right_pixels = right_df.index.to_numpy() >> (2 * (29 - 5))
+    pairs, left_rows, right_rows = [], [], []
+    for pixel in np.unique(left_pixels):
+        left_rows.append(np.nonzero(left_pixels == pixel)[0])
+        right_rows.append(np.nonzero(right_pixels == pixel)[0])
+        pair = _make_crossmatch_args(
+            gaia_cat, catwise_cat, left_df.iloc[left_rows[-1]], right_df.iloc[right_rows[-1]]
+        )
+        pair.left_order, pair.left_pixel = 5, int(pixel)
+        pair.right_order, pair.right_pixel = 5, int(pixel)
+        pairs.append(pair)
+
+    results = macauff_algo.perform_crossmatch_batch(pairs)
+    assert any((result[3] != position).any() for position, result in enumerate(results))
+    batched = _sorted_result(
+        np.concatenate([rows[result[0]] for rows, result in zip(left_rows, results)]),
+        np.concatenate(
+            [
+                np.array(
+                    [right_rows[pair][index] for pair, index in zip(result[3], result[1])], dtype=np.int64
+                )
+                for result in results
+            ]
+        ),
+        pd.concat([result[2] for result in results], ignore_index=True),
+    )
+    npt.assert_array_equal(batched[0], single[0])
+    npt.assert_array_equal(batched[1], single[1])
+    pd.testing.assert_frame_equal(batched[2], single[2])
+
+
+def test_merge_photometry_variants():
+    with_photometry = (np.array([0, 2]), np.array([1, 0]), {"p": np.array([0.9, 0.8])})
+    without_photometry = (np.array([0, 3]), np.array([1, 4]), {"p": np.array([0.7, 0.6])})
+    left_indices, right_indices, values = _merge_photometry_variants(with_photometry, without_photometry)
+    npt.assert_array_equal(left_indices, [0, 2, 3])
+    npt.assert_array_equal(right_indices, [1, 0, 4])
+
+    schema = pd.DataFrame(
+        {
+            name: pd.Series(dtype=pd.ArrowDtype(pa.float64()))
+            for name in ["p", f"p{WITHOUT_PHOTOMETRY_SUFFIX}"]
+        }
+    )
+    result = to_arrow_columns(values, schema)
+    assert result["p"].tolist() == [0.9, 0.8, None]
+    assert result[f"p{WITHOUT_PHOTOMETRY_SUFFIX}"].tolist() == [0.7, None, 0.6]
+
+
+def test_macauff_with_and_without_photometry_in_one_pass(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+
+    with_photometry = MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_path, wise_params_path)
+    both = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path, include_without_photometry=True
+    )
+    assert list(both.extra_columns.columns) == list(with_photometry.extra_columns.columns) + [
+        f"{name}{WITHOUT_PHOTOMETRY_SUFFIX}" for name in with_photometry.extra_columns.columns
+    ]
+    assert list(MacauffCrossmatch.extra_columns.columns) == list(with_photometry.extra_columns.columns)
+
+    left_indices, right_indices, extra_columns = both.perform_crossmatch(pair)
+    assert list(extra_columns.columns) == list(both.extra_columns.columns)
+    matched_with_photometry = extra_columns["p"].notna().to_numpy()
+    assert extra_columns[f"p{WITHOUT_PHOTOMETRY_SUFFIX}"].notna().any()
+    expected = _sorted_result(*with_photometry.perform_crossmatch(pair))
+    result = _sorted_result(
+        left_indices[matched_with_photometry],
+        right_indices[matched_with_photometry],
+        extra_columns[list(with_photometry.extra_columns.columns)][matched_with_photometry],
+    )
+    npt.assert_array_equal(result[0], expected[0])
+    npt.assert_array_equal(result[1], expected[1])
+    pd.testing.assert_frame_equal(result[2], expected[2])
+
+
+def test_macauff_instrumentation(
+    tmp_path, gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    macauff_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path,
+        gaia_params_path,
+        wise_params_path,
+        instrumentation_dir=tmp_path / "instrumentation",
+    )
+    left_indices, _, _ = macauff_algo.perform_crossmatch(
+        _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+    )
+
+    records = load_instrumentation(tmp_path / "instrumentation").set_index("stage")
+    assert set(records.index) == set(STAGES)
+    assert (records["Norder"] == 3).all() and (records["Npix"] == 512).all()
+    assert (records["left_rows"] == len(left_df)).all()
+    assert records.loc["_postprocess_chunk", "output_rows"] == len(left_indices)
+    assert records["peak_memory"].notna().all()
+
+
+def test_macauff_pairs_without_possible_matches(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    far_right_df = right_df.copy()
+    far_right_df["ra"] = (far_right_df["ra"] + 180) % 360
+    macauff_algo = MacauffCrossmatch(gaia_wise_joint_params_path, gaia_params_path, wise_params_path)
+
+    pairs = [
+        _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df.iloc[:0]),
+        _make_crossmatch_args(gaia_cat, catwise_cat, left_df.iloc[:0], right_df),
+        _make_crossmatch_args(gaia_cat, catwise_cat, left_df, far_right_df),
+    ]
+    lookups = macauff_algo.cache_info()
+    for left_indices, right_indices, extra_columns in [
+        macauff_algo.perform_crossmatch(pair) for pair in pairs
+    ]:
+        assert len(left_indices) == len(right_indices) == len(extra_columns) == 0
+        pd.testing.assert_series_equal(extra_columns.dtypes, macauff_algo.extra_columns.dtypes)
+    assert macauff_algo.cache_info()[:2] == lookups[:2]
+    for left_indices, right_indices, extra_columns, right_pairs in macauff_algo.perform_crossmatch_batch(
+        pairs
+    ):
+        assert len(left_indices) == len(right_indices) == len(extra_columns) == len(right_pairs) == 0
+
+    ## Sources within each other's bounding boxes, but farther apart than pos_corr_dist,
+    ## are only told apart by the exact precheck.
+    interleaved_left_df = left_df.iloc[[0, 1]].copy()
+    interleaved_left_df["ra"] = [10.0, 10.1]
+    interleaved_left_df["dec"] = [0.0, 0.1]
+    interleaved_right_df = right_df.iloc[[0]].copy()
+    interleaved_right_df["ra"] = 10.05
+    interleaved_right_df["dec"] = 0.05
+    assert macauff_algo._has_possible_matches(interleaved_left_df, interleaved_right_df)
+    exact_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path, exact_match_precheck=True
+    )
+    assert not exact_algo._has_possible_matches(interleaved_left_df, interleaved_right_df)
+    assert exact_algo._has_possible_matches(left_df, right_df)
+
+
+def test_macauff_trimmed_right_partition(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+    macauff_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path, trim_right_partition=True
+    )
+    assert len(macauff_algo._matchable_right_rows(left_df, right_df)) < len(right_df)
+
+    left_indices, right_indices, _ = macauff_algo.perform_crossmatch(pair)
+    assert len(left_indices) > 0
+    ## The right indices point into the untrimmed partition, so the pairs are close on the sky.
+    left_coords = SkyCoord(
+        left_df["ra"].to_numpy()[left_indices], left_df["dec"].to_numpy()[left_indices], unit="deg"
+    )
+    right_coords = SkyCoord(
+        right_df["ra"].to_numpy()[right_indices], right_df["dec"].to_numpy()[right_indices], unit="deg"
+    )
+    pos_corr_dist = float(macauff_algo.crossmatch_params_dict["pos_corr_dist"])
+    assert (left_coords.separation(right_coords).arcsec <= pos_corr_dist).all()
+
+
+def test_macauff_result_cache(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path, tmp_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    result_cache = ResultCache(tmp_path / "results")
+    macauff_algo = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path, result_cache=result_cache
+    )
+    expected = macauff_algo.perform_crossmatch(
+        _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+    )
+
+    matched = []
+    original = macauff_algo._find_crossmatch_indices
+
+    def counting_find(crossmatch_args):
+        matched.append(crossmatch_args)
+        return original(crossmatch_args)
+
+    macauff_algo._find_crossmatch_indices = counting_find
+    cached = macauff_algo.perform_crossmatch(_make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df))
+    assert len(matched) == 0
+    npt.assert_array_equal(cached[0], expected[0])
+    npt.assert_array_equal(cached[1], expected[1])
+    pd.testing.assert_frame_equal(cached[2], expected[2])
+
+    ## Only the pair whose inputs changed is matched again.
+    moved_df = left_df.assign(ra=left_df["ra"] + 1e-6)
+    macauff_algo.perform_crossmatch_batch(
+        [
+            _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df),
+            _make_crossmatch_args(gaia_cat, catwise_cat, moved_df, right_df),
+        ]
+    )
+    assert len(matched) == 1
+
+
+def test_macauff_significance_thresholds(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+    left_indices, right_indices, extra_columns = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path
+    ).perform_crossmatch(pair)
+    thresholded = MacauffCrossmatch(
+        gaia_wise_joint_params_path,
+        gaia_params_path,
+        wise_params_path,
+        min_match_probability=0.9,
+        max_separation_arcsec=1,
+    ).perform_crossmatch(pair)
+
+    keep = ((extra_columns["p"] >= 0.9) & (extra_columns["sep"] <= 1)).to_numpy()
+    assert 0 < keep.sum() < len(keep)
+    npt.assert_array_equal(thresholded[0], left_indices[keep])
+    npt.assert_array_equal(thresholded[1], right_indices[keep])
+    pd.testing.assert_frame_equal(thresholded[2], extra_columns[keep].reset_index(drop=True))
+
+
+class _ChunkArraysCrossmatch(MacauffCrossmatch):
+    """Records the types of the chunk arrays that the macauff stages get."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_array_types = []
+
+    def make_shared_data(self, *args, **kwargs):
+        self.chunk_array_types.append({name: type(getattr(self, name)) for name in ["a_astro", "b_photo"]})
+        super().make_shared_data(*args, **kwargs)
+
+
+def test_macauff_shared_arrays(
+    gaia_cat, catwise_cat, gaia_params_path, wise_params_path, gaia_wise_joint_params_path, tmp_path
+):
+    left_df = gaia_cat.get_partition(3, 512).compute()
+    right_df = catwise_cat.get_partition(3, 512).compute()
+    pair = _make_crossmatch_args(gaia_cat, catwise_cat, left_df, right_df)
+    expected = MacauffCrossmatch(
+        gaia_wise_joint_params_path, gaia_params_path, wise_params_path
+    ).perform_crossmatch(pair)
+    algorithm = _ChunkArraysCrossmatch(
+        gaia_wise_joint_params_path,
+        gaia_params_path,
+        wise_params_path,
+        shared_array_dir=tmp_path / "shared",
+    )
+    for _ in range(2):
+        left_indices, right_indices, extra_columns = algorithm.perform_crossmatch(pair)
+        npt.assert_array_equal(left_indices, expected[0])
+        npt.assert_array_equal(right_indices, expected[1])
+        pd.testing.assert_frame_equal(extra_columns, expected[2])
+    ## macauff's make_shared_data sets the Hankel grids, which are made once and kept on disk.
+    assert algorithm.shared_data_store.makes == 1
+    shared_data = algorithm.shared_data_store.get_or_make(algorithm.chunk_config_key, pytest.fail)
+    assert {"r", "dr", "rho", "drho"} <= set(shared_data)
+    assert len(list(algorithm.shared_data_store.entry_dir(algorithm.chunk_config_key).glob("*.npy"))) > 0
+    ## The astrometry and photometry of each chunk are memory-mapped, and removed once it is done.
+    assert algorithm.chunk_array_types == [{"a_astro": np.memmap, "b_photo": np.memmap}] * 2
+    assert [path.name for path in (tmp_path / "shared").iterdir()] == [algorithm.chunk_config_key]
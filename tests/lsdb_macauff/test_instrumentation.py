@@ -0,0 +1,143 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+from lsdb_macauff import instrumentation
+from lsdb_macauff.instrumentation import STAGES, StageRecorder, load_instrumentation
+
+## Allocations this large are always mapped afresh, so they raise the resident set.
+ASTRO_BYTES = 48_000_000
+SHARED_BYTES = 96_000_000
+
+requires_peak_reset = pytest.mark.skipif(
+    not Path("/proc/self/clear_refs").exists(), reason="the peak resident set can only be reset on Linux"
+)
+
+
+class _FakeChunk:
+    """Calls its stages in the same order as macauff, allocating some memory in each."""
+
+    def __init__(self):
+        self.ac = np.empty(0)
+        self.astro = None
+        self.shared = None
+
+    def _initialise_chunk(self):
+        self.astro = np.ones(ASTRO_BYTES // 8)
+        self.make_shared_data()
+
+    def make_shared_data(self):
+        self.shared = np.ones(SHARED_BYTES // 8)
+
+    def create_perturb_auf(self):
+        pass
+
+    def group_sources(self):
+        pass
+
+    def calculate_phot_like(self):
+        pass
+
+    def pair_sources(self):
+        self.ac = np.arange(7)
+
+    def _postprocess_chunk(self):
+        self.ac = self.ac[:5]
+
+    def process(self):
+        self._initialise_chunk()
+        for stage in ["create_perturb_auf", "group_sources", "calculate_phot_like", "pair_sources"]:
+            getattr(self, stage)()
+        self._postprocess_chunk()
+
+
+@requires_peak_reset
+def test_stage_recorder(tmp_path):
+    for pixel, left_rows in [(HealpixPixel(3, 512), 10), (HealpixPixel(4, 7), 20)]:
+        chunk = _FakeChunk()
+        recorder = StageRecorder(pixel, left_rows, 30)
+        recorder.instrument(chunk)
+        chunk.process()
+        recorder.finish()
+        recorder.write(tmp_path / "instrumentation")
+    assert not instrumentation._OPEN_STAGES
+
+    records = load_instrumentation(tmp_path / "instrumentation")
+    assert len(records) == 2 * len(STAGES)
+    assert records["peak_memory"].notna().all()
+    for npix in [512, 7]:
+        chunk_records = records[records["Npix"] == npix].set_index("stage")
+        assert set(chunk_records.index) == set(STAGES)
+        assert chunk_records.loc["make_shared_data", "peak_memory"] >= 0.9 * SHARED_BYTES
+        assert chunk_records.loc["_initialise_chunk", "peak_memory"] >= 0.9 * (ASTRO_BYTES + SHARED_BYTES)
+        assert chunk_records.loc["pair_sources", "peak_memory"] < 0.1 * ASTRO_BYTES
+    first = records[records["Npix"] == 512].set_index("stage")
+    assert (first["left_rows"] == 10).all()
+    assert (first["right_rows"] == 30).all()
+    assert first.loc["pair_sources", "output_rows"] == 7
+    assert first.loc["_postprocess_chunk", "output_rows"] == 5
+    assert first["output_rows"].isna().sum() == len(STAGES) - 2
+    assert first.loc["_initialise_chunk", "wall_time"] >= first.loc["make_shared_data", "wall_time"]
+
+
+@requires_peak_reset
+def test_stage_recorder_overlapping_chunks():
+    first_chunk, second_chunk = _FakeChunk(), _FakeChunk()
+    ## The second chunk runs while a stage of the first one is open, as concurrent pairs do.
+    first_chunk.group_sources = second_chunk.process
+    first = StageRecorder(HealpixPixel(3, 512), 10, 30)
+    first.instrument(first_chunk)
+    second = StageRecorder(HealpixPixel(3, 513), 10, 30)
+    second.instrument(second_chunk)
+    first_chunk.process()
+    second.finish()
+    first.finish()
+    assert not instrumentation._OPEN_STAGES
+
+    first_peaks = dict(
+        zip(first.to_table()["stage"].to_pylist(), first.to_table()["peak_memory"].to_pylist())
+    )
+    second_peaks = dict(
+        zip(second.to_table()["stage"].to_pylist(), second.to_table()["peak_memory"].to_pylist())
+    )
+    ## Every stage gets its peak, and the memory of the process includes the other chunk's.
+    assert first_peaks["_initialise_chunk"] >= 0.9 * (ASTRO_BYTES + SHARED_BYTES)
+    assert first_peaks["group_sources"] >= 0.9 * (ASTRO_BYTES + SHARED_BYTES)
+    assert first_peaks["create_perturb_auf"] < 0.1 * ASTRO_BYTES
+    assert second_peaks["_initialise_chunk"] >= 0.9 * (ASTRO_BYTES + SHARED_BYTES)
+    assert second_peaks["make_shared_data"] >= 0.9 * SHARED_BYTES
+
+
+def test_stage_recorder_failed_stage():
+    chunk = _FakeChunk()
+
+    def failing_stage():
+        raise RuntimeError("failed")
+
+    chunk.group_sources = failing_stage
+    recorder = StageRecorder(HealpixPixel(3, 512), 10, 30)
+    recorder.instrument(chunk)
+    with pytest.raises(RuntimeError):
+        chunk.process()
+    recorder.finish()
+    assert not instrumentation._OPEN_STAGES
+    assert recorder.to_table()["stage"].to_pylist() == [
+        "make_shared_data",
+        "_initialise_chunk",
+        "create_perturb_auf",
+    ]
+
+
+def test_stage_recorder_output_rows():
+    chunk = _FakeChunk()
+    recorder = StageRecorder(HealpixPixel(3, 512), 10, 30)
+    recorder.instrument(chunk, count_output_rows=lambda: 2 * len(chunk.ac))
+    chunk.process()
+    recorder.finish()
+    output_rows = dict(
+        zip(recorder.to_table()["stage"].to_pylist(), recorder.to_table()["output_rows"].to_pylist())
+    )
+    assert output_rows["pair_sources"] == 14
+    assert output_rows["_postprocess_chunk"] == 10
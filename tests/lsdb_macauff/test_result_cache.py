@@ -0,0 +1,119 @@
+import os
+
+import lsdb
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pyarrow as pa
+from hats.io import paths
+from lsdb.core.crossmatch.crossmatch_args import CrossmatchArgs
+
+from lsdb_macauff.result_cache import ResultCache, file_stamp, params_hash, referenced_files
+
+
+def _crossmatch_args(left_df, right_df, right_pixel=512, order=3, left_pixel=512):
+    return CrossmatchArgs(
+        left_df=left_df,
+        right_df=right_df,
+        left_order=order,
+        left_pixel=left_pixel,
+        right_order=order,
+        right_pixel=right_pixel,
+        left_catalog_info=None,
+        right_catalog_info=None,
+        right_margin_catalog_info=None,
+    )
+
+
+def test_result_cache(tmp_path):
+    left_df = pd.DataFrame({"ra": [1.0, 2.0, 3.0], "dec": [0.0, 0.5, 1.0]})
+    right_df = pd.DataFrame({"ra": [1.0, 3.0], "dec": [0.0, 1.0]})
+    extra_columns = pd.DataFrame({"p": pd.Series(dtype=pd.ArrowDtype(pa.float64()))})
+    result = (
+        np.array([0, 2]),
+        np.array([0, 1]),
+        pd.DataFrame({"p": pd.Series([0.9, 0.8], dtype=pd.ArrowDtype(pa.float64()))}),
+    )
+
+    cache = ResultCache(tmp_path / "results")
+    key = cache.result_key(_crossmatch_args(left_df, right_df), params_hash("params"))
+    assert cache.read(key, extra_columns) is None
+    cache.write(key, result)
+    assert cache.contains(key)
+    left_indices, right_indices, values = cache.read(key, extra_columns)
+    npt.assert_array_equal(left_indices, result[0])
+    npt.assert_array_equal(right_indices, result[1])
+    pd.testing.assert_frame_equal(values, result[2])
+
+    assert key == cache.result_key(_crossmatch_args(left_df.copy(), right_df), params_hash("params"))
+    changed_df = left_df.assign(dec=[0.0, 0.5, 1.1])
+    assert key != cache.result_key(_crossmatch_args(changed_df, right_df), params_hash("params"))
+    assert key != cache.result_key(_crossmatch_args(left_df, right_df, 513), params_hash("params"))
+    assert key != cache.result_key(_crossmatch_args(left_df, right_df), params_hash("other"))
+
+
+def test_params_hash_reads_files(tmp_path):
+    params_path = tmp_path / "params.yaml"
+    params_path.write_text("pos_corr_dist: 11")
+    first_hash = params_hash(params_path, np.array([1.0, 2.0]))
+    assert first_hash == params_hash(params_path, np.array([1.0, 2.0]))
+    assert first_hash != params_hash(params_path, np.array([1.0, 2.5]))
+    params_path.write_text("pos_corr_dist: 12")
+    assert first_hash != params_hash(params_path, np.array([1.0, 2.0]))
+
+
+def test_referenced_files(tmp_path):
+    (tmp_path / "dd_params.npy").write_bytes(b"dd")
+    (tmp_path / "folder").mkdir()
+    params_dict = {
+        "dd_params_path": "dd_params.npy",
+        "tri_model_mags_location": ["None", str(tmp_path / "missing.npy")],
+        "auf_file_path": str(tmp_path / "folder"),
+        "pos_corr_dist": 11,
+        "cat_name": "dd_params.npy",
+    }
+    assert referenced_files(params_dict, tmp_path) == [tmp_path / "dd_params.npy"]
+
+    stamp = file_stamp(tmp_path / "dd_params.npy")
+    assert stamp == file_stamp(str(tmp_path / "dd_params.npy"))
+    (tmp_path / "dd_params.npy").write_bytes(b"new dd")
+    assert stamp != file_stamp(tmp_path / "dd_params.npy")
+    assert file_stamp(tmp_path / "missing.npy").endswith("missing")
+
+
+def test_result_cache_catalog_files(tmp_path):
+    rng = np.random.default_rng(11)
+    frame = pd.DataFrame(
+        {"id": np.arange(100), "ra": rng.uniform(0, 10, 100), "dec": rng.uniform(0, 10, 100)}
+    )
+    for name in ["left", "right"]:
+        lsdb.from_dataframe(
+            frame, ra_column="ra", dec_column="dec", catalog_name=name, margin_threshold=None
+        ).write_catalog(tmp_path / name)
+    left_catalog = lsdb.open_catalog(tmp_path / "left")
+    pixel = left_catalog.get_healpix_pixels()[0]
+    left_df = left_catalog.get_partition(pixel.order, pixel.pixel).compute()
+    right_catalog = lsdb.open_catalog(tmp_path / "right")
+    right_df = right_catalog.get_partition(pixel.order, pixel.pixel).compute()
+
+    cache = ResultCache(tmp_path / "results", tmp_path / "left", tmp_path / "right")
+
+    def key(left, right):
+        return cache.result_key(
+            _crossmatch_args(left, right, pixel.pixel, pixel.order, pixel.pixel), "params"
+        )
+
+    first_key = key(left_df, right_df)
+    assert first_key == key(left_df.copy(), right_df)
+    ## The values are not read: the files stand for them.
+    assert first_key == key(left_df.assign(ra=left_df["ra"] + 1), right_df)
+    assert first_key != key(left_df.iloc[1:], right_df)
+    assert first_key != key(left_df[["ra", "dec"]], right_df)
+    assert first_key != ResultCache(tmp_path / "results").result_key(
+        _crossmatch_args(left_df, right_df, pixel.pixel, pixel.order, pixel.pixel), "params"
+    )
+
+    right_file = paths.pixel_catalog_file(right_catalog.hc_structure.catalog_path, pixel)
+    stat = os.stat(right_file)
+    os.utime(right_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert first_key != key(left_df, right_df)
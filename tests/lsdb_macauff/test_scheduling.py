@@ -0,0 +1,242 @@
+import copy
+import threading
+import time
+
+import dask
+import lsdb
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+from dask.distributed import Client, LocalCluster
+from distributed.diagnostics.plugin import SchedulerPlugin
+from hats.pixel_math.healpix_pixel import HealpixPixel
+from lsdb.core.crossmatch.kdtree_match import KdTreeCrossmatch
+
+from lsdb_macauff.scheduling import (
+    PairCostModel,
+    SparsePairBatches,
+    batch_sparse_pairs,
+    crossmatch_operation,
+    crossmatch_pair_rows,
+    pair_cost_annotations,
+    partition_row_counts,
+)
+
+
+def _records(left_rows, right_rows, wall_times, peak_memories):
+    return pd.DataFrame(
+        {
+            "chunk": np.repeat([f"chunk{index}" for index in range(len(left_rows))], 2),
+            "stage": ["_initialise_chunk", "make_shared_data"] * len(left_rows),
+            "wall_time": np.stack([wall_times, np.full(len(left_rows), 100.0)], axis=1).ravel(),
+            "peak_memory": np.stack([peak_memories, peak_memories / 2], axis=1).ravel(),
+            "left_rows": np.repeat(left_rows, 2),
+            "right_rows": np.repeat(right_rows, 2),
+        }
+    )
+
+
+def test_pair_cost_model_fit():
+    rng = np.random.default_rng(3)
+    left_rows = rng.integers(10, 100_000, 20)
+    right_rows = rng.integers(10, 100_000, 20)
+    wall_times = 1e-3 * (left_rows + 1) ** 0.8 * (right_rows + 1) ** 0.3
+    peak_memories = 50.0 * (left_rows + 1) ** 0.2 * (right_rows + 1)
+
+    model = PairCostModel.fit(_records(left_rows, right_rows, wall_times, peak_memories))
+    npt.assert_allclose(model.time_coefficients, [np.log(1e-3), 0.8, 0.3], atol=1e-8)
+    npt.assert_allclose(model.memory_coefficients, [np.log(50.0), 0.2, 1.0], atol=1e-8)
+    predicted_times, predicted_memories = model.predict(left_rows, right_rows)
+    npt.assert_allclose(predicted_times, wall_times)
+    npt.assert_allclose(predicted_memories, peak_memories)
+
+    ## Chunks with a stage that has no peak memory are left out.
+    records = _records(
+        np.append(left_rows, 10),
+        np.append(right_rows, 10),
+        np.append(wall_times, 1e6),
+        np.append(peak_memories, 1.0),
+    )
+    records.loc[records["chunk"] == "chunk20", "peak_memory"] = np.nan
+    npt.assert_allclose(PairCostModel.fit(records).time_coefficients, model.time_coefficients)
+
+    too_few = PairCostModel.fit(_records(left_rows[:2], right_rows[:2], wall_times[:2], peak_memories[:2]))
+    assert too_few.time_coefficients == PairCostModel().time_coefficients
+
+
+def test_partition_row_counts(gaia_dir, catwise_dir, gaia_cat, catwise_cat):
+    assert partition_row_counts(gaia_dir) == {HealpixPixel(3, 512): 13128}
+    xmatch = gaia_cat.crossmatch(catwise_cat, algorithm=KdTreeCrossmatch(radius_arcsec=1))
+    left_rows, right_rows = crossmatch_pair_rows(crossmatch_operation(xmatch))
+    npt.assert_array_equal(left_rows, [13128])
+    npt.assert_array_equal(right_rows, [partition_row_counts(catwise_dir)[HealpixPixel(3, 512)]])
+
+
+class _BatchedKdTreeCrossmatch(KdTreeCrossmatch):
+    """Matches a batch of pairs one by one."""
+
+    def crossmatch_batch(self, crossmatch_args_list, how, suffixes, suffix_method="all_columns"):
+        return [self.crossmatch(args, how, suffixes, suffix_method) for args in crossmatch_args_list]
+
+
+def _write_sparse_catalogs(base_dir, num_sources=2000):
+    rng = np.random.default_rng(7)
+    ra, dec = rng.uniform(40, 50, num_sources), rng.uniform(0, 10, num_sources)
+    frames = {
+        "left": pd.DataFrame({"id": np.arange(num_sources), "ra": ra, "dec": dec}),
+        "right": pd.DataFrame({"id": np.arange(num_sources), "ra": ra + 1e-5, "dec": dec}),
+    }
+    for name, frame in frames.items():
+        lsdb.from_dataframe(
+            frame,
+            ra_column="ra",
+            dec_column="dec",
+            catalog_name=name,
+            partition_rows=100,
+            margin_threshold=None,
+        ).write_catalog(base_dir / name)
+    return lsdb.open_catalog(base_dir / "left"), lsdb.open_catalog(base_dir / "right")
+
+
+def test_batch_sparse_pairs(tmp_path):
+    left_catalog, right_catalog = _write_sparse_catalogs(tmp_path)
+    algorithm = _BatchedKdTreeCrossmatch(radius_arcsec=1)
+    xmatch = left_catalog.crossmatch(right_catalog, algorithm=algorithm, suffix_method="all_columns")
+
+    batched = batch_sparse_pairs(xmatch, max_rows=1000, depth=1)
+    batches = batched._operation.batches
+    assert isinstance(batched._operation, SparsePairBatches)
+    assert len(batches) > 0 and all(len(batch) > 1 for batch in batches)
+    left_rows, right_rows = crossmatch_pair_rows(batched._operation.crossmatch_operation)
+    assert all((left_rows[batch] + right_rows[batch]).sum() <= 1000 for batch in batches)
+    assert batched.get_healpix_pixels() == xmatch.get_healpix_pixels()
+
+    graph = batched._operation.build().graph
+    assert sum(1 for key in graph if key[0].endswith("-batch")) == len(batches)
+    result = batched.compute()
+    expected = xmatch.compute()
+    pd.testing.assert_frame_equal(result.sort_values("id_left"), expected.sort_values("id_left"))
+
+    ## Pairs that are too large to share a batch are matched on their own.
+    assert batch_sparse_pairs(xmatch, max_rows=10, depth=1)._operation.batches == []
+    with pytest.raises(ValueError, match="crossmatch"):
+        batch_sparse_pairs(left_catalog)
+
+
+def test_batch_sparse_pairs_checks_task_layout(tmp_path, monkeypatch):
+    left_catalog, right_catalog = _write_sparse_catalogs(tmp_path)
+    algorithm = _BatchedKdTreeCrossmatch(radius_arcsec=1)
+    xmatch = left_catalog.crossmatch(right_catalog, algorithm=algorithm, suffix_method="all_columns")
+    batched = batch_sparse_pairs(xmatch, max_rows=1000, depth=1)
+    operation = batched._operation.crossmatch_operation
+
+    ## A version of lsdb that passes one more argument to perform_crossmatch.
+    catalog_infos = type(operation).catalog_infos
+    monkeypatch.setattr(
+        type(operation), "catalog_infos", property(lambda self: catalog_infos.fget(self) + [None])
+    )
+    with pytest.raises(ValueError, match="not supported"):
+        batched._operation.build()
+    monkeypatch.undo()
+
+    with_kwargs = copy.copy(operation)
+    with_kwargs.kwargs = {"extra": True}
+    with pytest.raises(ValueError, match="not supported"):
+        SparsePairBatches(with_kwargs, batched._operation.batches).build()
+
+
+def test_pair_cost_annotations(tmp_path):
+    left_catalog, right_catalog = _write_sparse_catalogs(tmp_path)
+    xmatch = left_catalog.crossmatch(
+        right_catalog, algorithm=KdTreeCrossmatch(radius_arcsec=1), suffix_method="all_columns"
+    )
+    annotations = pair_cost_annotations(xmatch)
+    assert set(annotations) == {"priority"}
+
+    ## The heaviest pairs, and the partitions they read, come first.
+    operation = crossmatch_operation(xmatch)
+    wall_times, _ = PairCostModel().predict(*crossmatch_pair_rows(operation))
+    built = operation.build()
+    priorities = [annotations["priority"](built.pixel_to_key_map[pixel]) for pixel in operation.output_pixels]
+    assert sorted(priorities) == list(range(1, len(priorities) + 1))
+    assert np.all(np.diff(np.asarray(wall_times)[np.argsort(priorities)]) >= 0)
+    for key in built.pixel_to_key_map.values():
+        for dependency in built.graph[key].dependencies:
+            assert annotations["priority"](dependency) >= annotations["priority"](key)
+    assert annotations["priority"](("other-task", 0)) == 0
+
+    ## Batched pairs are scheduled by their batch task.
+    batched = batch_sparse_pairs(xmatch, max_rows=1000, depth=1)
+    batched_annotations = pair_cost_annotations(batched)
+    batch_keys = [key for key in batched._operation.build().graph if key[0].endswith("-batch")]
+    assert len(batch_keys) > 0
+    assert all(batched_annotations["priority"](key) > 0 for key in batch_keys)
+
+    with pytest.raises(ValueError, match="crossmatch"):
+        pair_cost_annotations(left_catalog)
+
+
+class _ResourcesPlugin(SchedulerPlugin):
+    """Records the resources that the tasks of a graph claim."""
+
+    name = "pair-resources"
+
+    def __init__(self):
+        self.resources = {}
+
+    def update_graph(self, scheduler, *, annotations, **kwargs):
+        self.resources.update(
+            (key, resources) for key, resources in annotations.get("resources", {}).items() if resources
+        )
+
+
+_RUNNING = {"now": 0, "most": 0, "lock": threading.Lock()}
+
+
+class _CountingKdTreeCrossmatch(KdTreeCrossmatch):
+    """Counts how many pairs are matched at once, by the threads of an in-process cluster."""
+
+    def crossmatch(self, crossmatch_args, how, suffixes, suffix_method="all_columns"):
+        with _RUNNING["lock"]:
+            _RUNNING["now"] += 1
+            _RUNNING["most"] = max(_RUNNING["most"], _RUNNING["now"])
+        try:
+            time.sleep(0.01)
+            return super().crossmatch(crossmatch_args, how, suffixes, suffix_method)
+        finally:
+            with _RUNNING["lock"]:
+                _RUNNING["now"] -= 1
+
+
+@pytest.mark.dask
+def test_pair_cost_annotations_with_memory_resource(dask_client, tmp_path):
+    left_catalog, right_catalog = _write_sparse_catalogs(tmp_path)
+    xmatch = left_catalog.crossmatch(
+        right_catalog, algorithm=_CountingKdTreeCrossmatch(radius_arcsec=1), suffix_method="all_columns"
+    )
+    with pytest.raises(ValueError, match="resource"):
+        pair_cost_annotations(xmatch, dask_client)
+    expected = xmatch.compute()
+
+    ## Every pair is predicted to need more memory than the worker has, so each
+    ## claims all of it, and the pairs run one at a time on the four threads.
+    cost_model = PairCostModel(memory_coefficients=(np.log(1e9), 0, 0))
+    with (
+        LocalCluster(
+            n_workers=1,
+            threads_per_worker=4,
+            processes=False,
+            resources={"MEMORY": 1e6},
+            dashboard_address=":0",
+        ) as cluster,
+        Client(cluster) as client,
+    ):
+        client.register_plugin(_ResourcesPlugin())
+        with dask.annotate(**pair_cost_annotations(xmatch, client, cost_model)):
+            result = xmatch.compute()
+        plugin = cluster.scheduler.plugins[_ResourcesPlugin.name]
+    assert len(plugin.resources) == len(xmatch.get_healpix_pixels())
+    assert all(resources == {"MEMORY": 1e6} for resources in plugin.resources.values())
+    assert _RUNNING["most"] == 1
+    pd.testing.assert_frame_equal(result.sort_values("id_left"), expected.sort_values("id_left"))
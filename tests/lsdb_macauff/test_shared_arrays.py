@@ -0,0 +1,133 @@
+import threading
+import tracemalloc
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+from lsdb_macauff.shared_arrays import SharedDataStore, arrays_key, process_shared_data_store
+
+
+def _make_grids(size=10_000):
+    """The attributes that macauff's ``make_shared_data`` sets: Hankel grids, and no Bessel values yet."""
+
+    def make():
+        r, rho = np.linspace(0, 11, size), np.linspace(0, 100, size)
+        return {"r": r, "dr": np.diff(r), "rho": rho, "drho": np.diff(rho), "j0s": None, "j1s": None}
+
+    return make
+
+
+def _chunk_arrays(num_sources=500_000, seed=0):
+    """Astrometry and photometry of a dense chunk, as `MacauffCrossmatch._initialise_chunk` reads them."""
+    rng = np.random.default_rng(seed)
+    return {"astro": rng.uniform(0, 1, (num_sources, 3)), "photo": rng.uniform(10, 20, (num_sources, 2))}
+
+
+def test_shared_data_store():
+    store = SharedDataStore()
+    values = store.get_or_make("key", _make_grids())
+    assert store.makes == 1
+    assert store.get_or_make("key", _make_grids()) is values
+    assert store.makes == 1
+    assert values["j1s"] is None
+    with pytest.raises(ValueError, match="read-only"):
+        values["rho"][0] = 1
+    store.get_or_make("other key", _make_grids())
+    assert store.makes == 2
+
+    store.clear()
+    assert store.get_or_make("key", _make_grids()) is not values
+    assert store.makes == 1
+    assert process_shared_data_store() is process_shared_data_store(None)
+
+
+def test_shared_data_store_memory():
+    """Chunks after the first share the arrays, and allocate next to nothing."""
+    store = SharedDataStore()
+    tracemalloc.start()
+    try:
+        store.get_or_make("key", _make_grids())
+        _, first_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        chunks = [store.get_or_make("key", _make_grids()) for _ in range(16)]
+        _, chunks_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert first_peak >= 300_000
+    assert chunks_peak < first_peak + 50_000
+    assert all(chunk["rho"] is chunks[0]["rho"] for chunk in chunks)
+
+
+def test_shared_data_store_threads():
+    store = SharedDataStore()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(store.get_or_make("key", _make_grids())))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.makes == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_shared_data_store_directory(tmp_path):
+    store = SharedDataStore(tmp_path / "shared")
+    values = store.get_or_make("key", _make_grids())
+    assert isinstance(values["rho"], np.memmap)
+    assert (store.entry_dir("key") / "drho.npy").exists()
+    assert len(list((tmp_path / "shared").iterdir())) == 1
+
+    ## Another process of the node maps the files instead of making the data.
+    other = SharedDataStore(tmp_path / "shared")
+    mapped = other.get_or_make("key", _make_grids(10))
+    assert other.makes == 0
+    assert isinstance(mapped["dr"], np.memmap)
+    assert mapped["j0s"] is None and mapped["j1s"] is None
+    npt.assert_array_equal(mapped["rho"], np.linspace(0, 100, 10_000))
+    with pytest.raises(ValueError, match="read-only"):
+        mapped["r"][0] = 1
+
+
+def test_shared_data_store_maxsize():
+    store = SharedDataStore(maxsize=2)
+    first = store.get_or_make("first", _make_grids(10))
+    store.get_or_make("second", _make_grids(10))
+    assert store.get_or_make("first", _make_grids(10)) is first
+    store.get_or_make("third", _make_grids(10))
+    assert store.makes == 3
+    ## The least recently used key was dropped, and is made again.
+    store.get_or_make("second", _make_grids(10))
+    assert store.makes == 4
+    assert store.get_or_make("first", _make_grids(10)) is not first
+
+
+def test_share_arrays(tmp_path):
+    arrays = _chunk_arrays()
+    key = arrays_key(arrays)
+    assert key == arrays_key(_chunk_arrays())
+    assert key != arrays_key(_chunk_arrays(seed=1))
+    assert SharedDataStore().share_arrays(key, arrays) == (arrays, False)
+
+    ## The first chunk writes the arrays, and the chunks of other processes map them.
+    store = SharedDataStore(tmp_path / "shared")
+    shared, wrote = store.share_arrays(key, arrays)
+    assert wrote
+    other, other_wrote = SharedDataStore(tmp_path / "shared").share_arrays(key, _chunk_arrays())
+    assert not other_wrote
+    for name, array in arrays.items():
+        assert isinstance(shared[name], np.memmap) and isinstance(other[name], np.memmap)
+        assert shared[name].filename == other[name].filename
+        npt.assert_array_equal(other[name], array)
+    with pytest.raises(ValueError, match="read-only"):
+        other["astro"][0, 0] = 0
+    assert store.makes == 0
+
+    ## Once the writer is done, the files go, but the chunks that mapped them keep the data.
+    store.remove(key)
+    assert not store.entry_dir(key).exists()
+    npt.assert_array_equal(other["photo"], arrays["photo"])
+    assert store.share_arrays(key, arrays)[1]
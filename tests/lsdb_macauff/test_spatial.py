@@ -0,0 +1,133 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+from hats.pixel_math import healpix_shim as hp
+from hats.pixel_math.healpix_pixel import HealpixPixel
+
+from lsdb_macauff.spatial import (
+    MAX_SUB_CHUNK_DEPTH,
+    any_within,
+    arcsec_to_chord,
+    boxes_within,
+    chord_to_arcsec,
+    pixel_bounding_circles,
+    radec_to_xyz,
+    rows_within,
+    split_into_sub_chunks,
+)
+
+
+def _points_in_pixel(pixel, num_points, seed=0):
+    """Random points in a HEALPix pixel, found by rejection sampling around its center."""
+    rng = np.random.default_rng(seed)
+    centers, radii = pixel_bounding_circles(pixel.order, [pixel.pixel])
+    center_dec = np.degrees(np.arcsin(centers[0, 2]))
+    center_ra = np.degrees(np.arctan2(centers[0, 1], centers[0, 0]))
+    spread = radii[0] / 3600
+    ra = center_ra + rng.uniform(-spread, spread, 20 * num_points) / np.cos(np.radians(center_dec))
+    dec = np.clip(center_dec + rng.uniform(-spread, spread, 20 * num_points), -90, 90)
+    in_pixel = hp.radec2pix(pixel.order, ra, dec) == pixel.pixel
+    return ra[in_pixel][:num_points], dec[in_pixel][:num_points]
+
+
+def test_unit_conversions():
+    npt.assert_allclose(radec_to_xyz([0, 90], [0, 0]), [[1, 0, 0], [0, 1, 0]], atol=1e-15)
+    npt.assert_allclose(chord_to_arcsec(arcsec_to_chord([1.0, 3600.0])), [1.0, 3600.0])
+
+
+def test_pixel_bounding_circles():
+    pixel = HealpixPixel(5, 1234)
+    ra, dec = _points_in_pixel(pixel, 1000)
+    centers, radii = pixel_bounding_circles(pixel.order, [pixel.pixel])
+    separations = chord_to_arcsec(np.linalg.norm(radec_to_xyz(ra, dec) - centers[0], axis=1))
+    assert np.all(separations <= radii[0] * 1.001)
+
+
+def test_split_into_sub_chunks():
+    pixel = HealpixPixel(3, 512)
+    left_ra, left_dec = _points_in_pixel(pixel, 2000, seed=1)
+    right_ra, right_dec = _points_in_pixel(pixel, 3000, seed=2)
+
+    sub_chunks = split_into_sub_chunks(
+        pixel, left_ra, left_dec, right_ra, right_dec, max_rows=500, halo_arcsec=60
+    )
+
+    assert len(sub_chunks) > 1
+    ## Every left row is in the core of exactly one sub-chunk, and every right row in at most one.
+    core_rows = np.concatenate([sub_chunk.left_rows[~sub_chunk.left_halo] for sub_chunk in sub_chunks])
+    npt.assert_array_equal(np.sort(core_rows), np.arange(len(left_ra)))
+    right_core_rows = np.concatenate(
+        [sub_chunk.right_rows[~sub_chunk.right_halo] for sub_chunk in sub_chunks]
+    )
+    assert len(np.unique(right_core_rows)) == len(right_core_rows)
+
+    left_xyz = radec_to_xyz(left_ra, left_dec)
+    right_xyz = radec_to_xyz(right_ra, right_dec)
+    linked = np.linalg.norm(left_xyz[:, np.newaxis, :] - right_xyz[np.newaxis, :, :], axis=-1) <= (
+        arcsec_to_chord(60)
+    )
+    for sub_chunk in sub_chunks:
+        assert sub_chunk.pixel.order > pixel.order
+        assert np.sum(~sub_chunk.left_halo) + np.sum(~sub_chunk.right_halo) <= 500
+        sub_pixels = hp.radec2pix(sub_chunk.pixel.order, right_ra, right_dec)
+        npt.assert_array_equal(
+            sub_chunk.right_halo, sub_pixels[sub_chunk.right_rows] != sub_chunk.pixel.pixel
+        )
+        assert np.all(np.isin(np.nonzero(sub_pixels == sub_chunk.pixel.pixel)[0], sub_chunk.right_rows))
+        ## The sub-chunk holds every source linked to any of its sources, so its islands are whole.
+        linked_right = np.nonzero(linked[sub_chunk.left_rows].any(axis=0))[0]
+        linked_left = np.nonzero(linked[:, sub_chunk.right_rows].any(axis=1))[0]
+        assert np.all(np.isin(linked_right, sub_chunk.right_rows))
+        assert np.all(np.isin(linked_left, sub_chunk.left_rows))
+
+
+def test_split_into_sub_chunks_empty_right():
+    pixel = HealpixPixel(3, 512)
+    left_ra, left_dec = _points_in_pixel(pixel, 100)
+    sub_chunks = split_into_sub_chunks(pixel, left_ra, left_dec, [], [], max_rows=50, halo_arcsec=10)
+    assert len(sub_chunks) > 1
+    assert all(len(sub_chunk.right_rows) == 0 for sub_chunk in sub_chunks)
+
+
+def test_split_into_sub_chunks_too_dense():
+    pixel = HealpixPixel(3, 512)
+    left_ra, left_dec = _points_in_pixel(pixel, 1)
+    ## Sources at the same position can never be split apart.
+    left_ra, left_dec = np.repeat(left_ra, 20), np.repeat(left_dec, 20)
+    with pytest.warns(UserWarning, match="max_rows=10"):
+        sub_chunks = split_into_sub_chunks(
+            pixel, left_ra, left_dec, left_ra, left_dec, max_rows=10, halo_arcsec=10
+        )
+    assert len(sub_chunks) == 1
+    assert sub_chunks[0].pixel.order == pixel.order + MAX_SUB_CHUNK_DEPTH
+    npt.assert_array_equal(sub_chunks[0].left_rows, np.arange(20))
+
+
+def test_any_within():
+    left_ra, left_dec = np.array([10.0, 20.0]), np.array([0.0, 0.0])
+    assert any_within(left_ra, left_dec, np.array([20.0 + 1 / 3600]), np.array([0.0]), radius_arcsec=2)
+    assert not any_within(left_ra, left_dec, np.array([20.0 + 3 / 3600]), np.array([0.0]), radius_arcsec=2)
+    many_ra, many_dec = np.linspace(30, 40, 1000), np.zeros(1000)
+    assert not any_within(many_ra, many_dec, left_ra, left_dec, radius_arcsec=60)
+    assert any_within(many_ra, many_dec, np.array([35.0]), np.array([0.0]), radius_arcsec=60)
+    assert not any_within(left_ra, left_dec, np.empty(0), np.empty(0), radius_arcsec=2)
+    ## Between the left sources, within their bounding box, but far from both.
+    assert not any_within(left_ra, left_dec, np.array([15.0]), np.array([0.0]), radius_arcsec=2)
+    assert any_within(left_ra, left_dec, np.array([15.0]), np.array([0.0]), radius_arcsec=2, exact=False)
+    assert not any_within(many_ra, many_dec, left_ra, left_dec, radius_arcsec=60, exact=False)
+
+
+def test_boxes_within():
+    left_xyz = radec_to_xyz(np.array([10.0, 20.0]), np.array([0.0, 0.0]))
+    right_xyz = radec_to_xyz(np.array([20.0 + 3 / 3600]), np.array([0.0]))
+    assert not boxes_within(left_xyz, right_xyz, arcsec_to_chord(2))
+    assert boxes_within(left_xyz, right_xyz, arcsec_to_chord(4))
+    assert boxes_within(right_xyz, left_xyz, arcsec_to_chord(4))
+
+
+def test_rows_within():
+    reference_ra, reference_dec = np.array([10.0, 20.0]), np.array([0.0, 0.0])
+    query_ra = np.array([20.0, 10.0 + 3 / 3600, 10.0 + 1 / 3600, 15.0])
+    query_dec = np.zeros(4)
+    npt.assert_array_equal(rows_within(query_ra, query_dec, reference_ra, reference_dec, 2), [0, 2])
+    assert len(rows_within(query_ra, query_dec, np.empty(0), np.empty(0), 2)) == 0